@@ -0,0 +1,89 @@
+"""
+Anytime solving: schedules published while the solver runs.
+
+The engines report every improving MIP solution (see
+v4matrix.solve_inprocess) to a Reporter, which forwards it through a
+queue from the solve worker to the API process. There, Publication
+publishes the first feasible schedule at once and the later ones only
+when peakhigh - peaklow improved by `threshold` (relative), so devices
+get a schedule within seconds whatever the difficulty of the MILP. The
+final schedule is published as usual when the solve ends.
+"""
+from datetime import datetime
+import threading
+import logging
+import metrics
+import queue
+
+logger = logging.getLogger("api")
+
+
+class Reporter(object):
+    """Incumbent callback of the engines putting them on a queue"""
+    def __init__(self, updates):
+        self.updates = updates
+
+    def __call__(self, results, info):
+        self.updates.put((results, info))
+
+
+class Publication(threading.Thread):
+    """
+    Publish the incumbents of one solve.
+    Inputs:
+        - updates (queue): (results, info) put by a Reporter
+        - publish (function): publish(results) returns the version
+        - threshold (float): relative improvement of the objective
+          needed to publish another incumbent
+        - progress (function): called with the list of incumbents seen
+          (objective, mipgap, seconds, version if published)
+    """
+    def __init__(self, updates, publish, threshold=0.01, progress=None):
+        threading.Thread.__init__(self, name='incumbent-publication',
+                                  daemon=True)
+        self.updates = updates
+        self.publish = publish
+        self.threshold = threshold
+        self.progress = progress
+        self.incumbents = []
+        self.published = None
+        self.started = datetime.now()
+
+    def run(self):
+        while True:
+            update = self.updates.get()
+            # Only the latest of the incumbents received meanwhile matters
+            try:
+                while update is not None:
+                    update = self.updates.get_nowait()
+            except queue.Empty:
+                pass
+            if update is None:
+                return
+            self.consider(*update)
+
+    def consider(self, results, info):
+        objective = float(results['peakhigh'] - results['peaklow'])
+        incumbent = {'objective': objective,
+                     'mipgap': info.get('mipgap'),
+                     'seconds': info.get('seconds'),
+                     'received': (datetime.now() -
+                                  self.started).total_seconds(),
+                     'version': None}
+        if self.published is None or objective < self.published - (
+                self.threshold * max(abs(self.published), 1e-9)):
+            try:
+                incumbent['version'] = self.publish(results)
+                self.published = objective
+            except Exception:
+                logger.exception('Incumbent schedule not published')
+        self.incumbents.append(incumbent)
+        metrics.incumbents.inc(
+            published=str(incumbent['version'] is not None).lower())
+        if self.progress is not None:
+            self.progress(list(self.incumbents))
+
+    def stop(self):
+        """Ignore the incumbents not handled yet and wait for the thread"""
+        self.updates.put(None)
+        self.join()
@@ -0,0 +1,304 @@
+"""
+Local archive of the versioned total demand snapshots.
+
+Each /savetotaldemand snapshot (24h of contr) is appended as one
+compressed columnar chunk to a segment file of its day, instead of
+being written to InfluxDB with a version tag (one series per version).
+A chunk is a fixed header followed by the zlib of its times (first time
+and step, or the deltas when irregular) and of its float64 values (byte
+shuffled, which compresses much better):
+
+    magic b'CSCA', format, step of the downsampling (minutes),
+    version, first time, step (ms, 0 if irregular), points, bytes
+
+Segments are only appended to, except by the downsampling (segments
+older than downsample_after are rewritten with coarser snapshots) and
+deleted by the retention, both applied by a background thread. They are
+read through mmap.
+"""
+from datetime import datetime, timedelta
+import threading
+import logging
+import struct
+import mmap
+import zlib
+import glob
+import os
+import numpy
+import pandas
+
+logger = logging.getLogger("api")
+
+MAGIC = b'CSCA'
+FORMAT = 1
+HEADER = struct.Struct('<4sHHqqqII')
+
+
+def encode_chunk(version, series, downsampled=0):
+    """
+    Compressed chunk of one snapshot.
+    Inputs:
+        - version (int): milliseconds since epoch
+        - series (Series): values by time (tz aware or UTC)
+        - downsampled (int): minutes per point if downsampled
+    Outputs:
+        - chunk (bytes)
+    """
+    index = pandas.DatetimeIndex(series.index)
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    times = ((index - pandas.Timestamp(0)) //
+             pandas.Timedelta(milliseconds=1)).to_numpy(dtype='<i8')
+    deltas = numpy.diff(times)
+    step = int(deltas[0]) if len(deltas) and (deltas == deltas[0]).all() \
+        else 0
+    values = numpy.ascontiguousarray(series.values, dtype='<f8')
+    payload = values.view(numpy.uint8).reshape(-1, 8).T.tobytes()
+    if step == 0 and len(times) > 1:
+        payload = deltas.tobytes() + payload
+    payload = zlib.compress(payload, 6)
+    return HEADER.pack(MAGIC, FORMAT, downsampled, int(version),
+                       int(times[0]) if len(times) else 0, step,
+                       len(times), len(payload)) + payload
+
+
+def decode_chunk(header, payload):
+    """Series (UTC times) of a chunk header (tuple) and payload"""
+    magic, fmt, downsampled, version, first, step, n, size = header
+    raw = zlib.decompress(payload)
+    if step == 0 and n > 1:
+        deltas = numpy.frombuffer(raw, dtype='<i8', count=n - 1)
+        times = first + numpy.concatenate([[0], numpy.cumsum(deltas)])
+        raw = raw[8 * (n - 1):]
+    else:
+        times = first + step * numpy.arange(n, dtype=numpy.int64)
+    values = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(8, n).T
+    values = numpy.ascontiguousarray(values).view('<f8').ravel()
+    return pandas.Series(values, index=pandas.to_datetime(
+        times, unit='ms', utc=True), name='contr')
+
+
+def scan(path):
+    """
+    Chunks of a segment.
+    Outputs:
+        - chunks (list): (header, payload offset) of the valid chunks
+        - end (int): end of the last valid chunk
+    """
+    chunks, end = [], 0
+    size = os.path.getsize(path)
+    if size == 0:
+        return chunks, end
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ) as m:
+        while end + HEADER.size <= size:
+            header = HEADER.unpack_from(m, end)
+            if header[0] != MAGIC or header[1] != FORMAT or \
+                    end + HEADER.size + header[7] > size:
+                # Partial write (crash), later appends overwrite it
+                logger.warning('Archive {} truncated at {}'.format(path,
+                                                                   end))
+                break
+            chunks.append((header, end + HEADER.size))
+            end += HEADER.size + header[7]
+    return chunks, end
+
+
+class SnapshotArchive(object):
+    """
+    Versioned snapshots in directory, one segment per day of version.
+    Inputs:
+        - directory (str)
+        - retention (timedelta): snapshots older are deleted (None keeps
+          everything)
+        - downsample_after (timedelta): snapshots older are downsampled
+        - downsample_step (int): minutes per point once downsampled
+    """
+    def __init__(self, directory, retention=timedelta(days=365),
+                 downsample_after=timedelta(days=7), downsample_step=60):
+        self.directory = directory
+        self.retention = retention
+        self.downsample_after = downsample_after
+        self.downsample_step = downsample_step
+        self.index = {}
+        self._ends = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+        for path in sorted(glob.glob(os.path.join(directory, '*.seg'))):
+            self._load(path)
+
+    def _segment(self, version):
+        day = datetime.utcfromtimestamp(version / 1000).strftime('%Y%m%d')
+        return os.path.join(self.directory, day + '.seg')
+
+    def _load(self, path):
+        for version in [v for v, c in self.index.items() if c[0] == path]:
+            del self.index[version]
+        chunks, self._ends[path] = scan(path)
+        for header, offset in chunks:
+            self.index[header[3]] = (path, offset, header)
+
+    def append(self, version, series):
+        """Archive a snapshot (replaces a previous one of the version)"""
+        chunk = encode_chunk(version, series)
+        path = self._segment(version)
+        with self._lock:
+            with open(path, 'ab') as f:
+                # Drop a partial chunk left by a crash
+                f.truncate(self._ends.get(path, 0))
+                f.seek(self._ends.get(path, 0))
+                f.write(chunk)
+                offset = f.tell() - len(chunk) + HEADER.size
+            self._ends[path] = offset + len(chunk) - HEADER.size
+            self.index[int(version)] = (path, offset,
+                                        HEADER.unpack_from(chunk))
+
+    def versions(self, start=None, end=None):
+        """Archived versions (ms) between start and end (ms)"""
+        with self._lock:
+            versions = sorted(self.index)
+        return [v for v in versions if (start is None or v >= start) and
+                (end is None or v <= end)]
+
+    def read(self, version):
+        """Snapshot of a version (Series) or None"""
+        with self._lock:
+            entry = self.index.get(int(version))
+            if entry is None:
+                return None
+            path, offset, header = entry
+            with open(path, 'rb') as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                payload = m[offset:offset + header[7]]
+        return decode_chunk(header, payload)
+
+    def snapshots(self, start, end, lead=timedelta(hours=24)):
+        """
+        Snapshots with points between start and end.
+        Inputs:
+            - start, end (Timestamp): time range (UTC)
+            - lead (timedelta): longest time covered by a snapshot after
+              its version
+        Outputs:
+            - snapshots (list): (version, Series within the range)
+        """
+        snapshots = []
+        for version in self.versions(
+                int((start - lead).timestamp() * 1000),
+                int(end.timestamp() * 1000)):
+            series = self.read(version)
+            series = series[(series.index >= start) &
+                            (series.index <= end)]
+            if len(series):
+                snapshots.append((version, series))
+        return snapshots
+
+    def compare(self, start=None, end=None):
+        """
+        Forecast versus actual: every snapshot compared with the actual
+        total demand, i.e. for each time the value of the latest
+        snapshot taken before it (the closest to real time).
+        Inputs:
+            - start, end (int): versions in milliseconds
+        Outputs:
+            - DataFrame by version: points compared, bias, mean absolute
+              and maximum error, and lead time (hours) of the last point
+        """
+        # Actual values from every later snapshot (its first point after
+        # it was taken)
+        snapshots = [(v, self.read(v)) for v in self.versions(start)]
+        actual = {}
+        for version, series in snapshots:
+            taken = pandas.Timestamp(version, unit='ms', tz='UTC')
+            after = series[series.index >= taken]
+            if len(after):
+                actual[after.index[0]] = after.iloc[0]
+        actual = pandas.Series(actual, dtype=float).sort_index()
+        rows = []
+        for version, series in snapshots:
+            if end is not None and version > end:
+                break
+            taken = pandas.Timestamp(version, unit='ms', tz='UTC')
+            # Forecast only: the first point is the actual itself
+            series = series[series.index >= taken].iloc[1:]
+            error = (series - actual.reindex(series.index)).dropna()
+            rows.append({
+                'version': version, 'points': len(error),
+                'bias': float(error.mean()) if len(error) else None,
+                'mae': float(error.abs().mean()) if len(error) else None,
+                'max': float(error.abs().max()) if len(error) else None,
+                'lead_hours': (float((error.index[-1] - taken) /
+                                     pandas.Timedelta(hours=1))
+                               if len(error) else None)})
+        return pandas.DataFrame(rows, columns=[
+            'version', 'points', 'bias', 'mae', 'max', 'lead_hours'])
+
+    def maintain(self, now=None):
+        """
+        Apply the retention (delete old segments) and the downsampling
+        (rewrite old segments with coarser snapshots).
+        """
+        now = now or datetime.utcnow()
+        with self._lock:
+            for path in sorted(glob.glob(os.path.join(self.directory,
+                                                      '*.seg'))):
+                day = datetime.strptime(os.path.basename(path)[:8],
+                                        '%Y%m%d')
+                age = now - day - timedelta(days=1)
+                if self.retention is not None and age > self.retention:
+                    os.remove(path)
+                    self._ends.pop(path, None)
+                    for version in [v for v, c in self.index.items()
+                                    if c[0] == path]:
+                        del self.index[version]
+                elif self.downsample_after is not None and \
+                        age > self.downsample_after:
+                    self._downsample(path)
+
+    def start(self, interval=3600):
+        """Apply maintain every interval seconds in a background thread"""
+        def run():
+            while True:
+                try:
+                    self.maintain()
+                except Exception:
+                    logger.exception('Archive maintenance failed')
+                if self._stopped.wait(interval):
+                    return
+
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=run, name='archive-maintenance', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background maintenance"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _downsample(self, path):
+        entries = [(v, c) for v, c in sorted(self.index.items())
+                   if c[0] == path]
+        if all(c[2][2] >= self.downsample_step for v, c in entries):
+            return
+        chunks = []
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0,
+                                              access=mmap.ACCESS_READ) as m:
+            for version, (p, offset, header) in entries:
+                payload = m[offset:offset + header[7]]
+                if header[2] >= self.downsample_step:
+                    chunks.append(HEADER.pack(*header) + payload)
+                    continue
+                series = decode_chunk(header, payload).resample(
+                    '{}min'.format(self.downsample_step)).mean().dropna()
+                chunks.append(encode_chunk(version, series,
+                                           self.downsample_step))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(b''.join(chunks))
+        os.replace(path + '.tmp', path)
+        self._load(path)
@@ -0,0 +1,201 @@
+"""
+Benchmark of maximize_self_consumption on synthetic fleets.
+
+Every run generates N orders of each kind (randomorders) and an
+uncontrolled demand over the horizon, solves them with one engine and
+solver and records the time spent to build the model, solve it and
+extract the results. The runs are saved as JSON; compared with a
+previous file, the runs that became slower are reported.
+
+    python benchmark.py --orders 10 100 --hours 24 48 \
+        --engines matrix persistent --solvers highs glpk \
+        --output benchmark.json --baseline previous.json
+"""
+from datetime import datetime
+import multiprocessing
+import subprocess
+import platform
+import argparse
+import json
+import os
+import sys
+import numpy
+import pandas
+import v4norminf
+import v4matrix
+import persistent
+import decomposition
+import randomorders
+import orderbook
+import timegrid
+
+# Optimization timestep (5min)
+TIMESTEP = 12
+
+# Engines as in main, persistent starts from an empty model every run
+ENGINES = {'pyomo': v4norminf.maximize_self_consumption,
+           'matrix': v4matrix.maximize_self_consumption,
+           'persistent': lambda *args, **kwargs: (
+               persistent.PersistentModel().maximize_self_consumption(
+                   *args, **kwargs)),
+           'decomposition': decomposition.maximize_self_consumption}
+
+# Fields identifying a run in two benchmark files
+KEY = ['engine', 'solver', 'orders', 'hours', 'grid']
+
+
+def fleet(orders, hours, seed=0):
+    """
+    Synthetic inputs of maximize_self_consumption.
+    Inputs:
+        - orders (int): number of orders of each kind
+        - hours (float): horizon
+        - seed (int): random seed
+    Outputs:
+        - uncontrollable, dfbatteries, dfshapeables, dfdeferrables
+    """
+    rng = numpy.random.RandomState(seed)
+    start = datetime(2020, 6, 1)
+    uncontr = randomorders.random_uncontrollable(
+        start, hours, 60 // TIMESTEP, rng)
+    uncontrollable = pandas.DataFrame({'p': uncontr['uncontr'].values})
+    books = [
+        randomorders.random_battery_orderbooks(orders, start, hours, rng),
+        randomorders.random_shapeable_orderbooks(orders, start, hours, rng),
+        randomorders.random_deferrable_orderbooks(
+            orders, 60 / TIMESTEP, start, hours, rng)]
+    return [uncontrollable] + [
+        orderbook.normalize(book, start, 60 / TIMESTEP) for book in books]
+
+
+def run(engine, solver, orders, hours, grid=None, seed=0, repeat=1,
+        timelimit=5*60, mipgap=None):
+    """
+    Benchmark one configuration.
+    Outputs:
+        - record (dict): configuration, size of the model and median
+          seconds spent to build, solve and extract (and in total)
+    """
+    record = {'engine': engine, 'solver': solver, 'orders': orders,
+              'hours': hours, 'grid': grid, 'seed': seed,
+              'repeat': repeat, 'timelimit': timelimit, 'mipgap': mipgap,
+              'status': 'ok'}
+    uncontrollable, dfbatteries, dfshapeables, dfdeferrables = fleet(
+        orders, hours, seed)
+    if grid is not None:
+        uncontrollable = timegrid.coarsen(
+            uncontrollable, timegrid.time_grid(len(uncontrollable), *grid))
+    record['steps'] = len(uncontrollable)
+
+    timings = []
+    try:
+        for i in range(repeat):
+            tic = datetime.now()
+            results = ENGINES[engine](
+                uncontrollable, dfbatteries, dfshapeables, dfdeferrables,
+                timestep=1/TIMESTEP, solver=solver, timelimit=timelimit,
+                mipgap=mipgap)
+            timing = dict(results['timings'])
+            timing['total'] = (datetime.now() - tic).total_seconds()
+            timings.append(timing)
+    except Exception as e:
+        record.update(status='failed', error=repr(e))
+        return record
+
+    for phase in ['build', 'solve', 'extract', 'total']:
+        record[phase] = float(numpy.median([t[phase] for t in timings]))
+    record['objective'] = float(results['peakhigh'] - results['peaklow'])
+    if 'presolve' in results:
+        record['rows'] = results['presolve']['rows'][1]
+        record['columns'] = results['presolve']['columns'][1]
+    return record
+
+
+def environment():
+    """Machine and versions the benchmark ran with"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        commit = None
+    versions = {}
+    for name in ['numpy', 'scipy', 'pandas', 'pyomo', 'highspy']:
+        try:
+            versions[name] = getattr(__import__(name), '__version__', None)
+        except ImportError:
+            versions[name] = None
+    return {'date': datetime.now().isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'machine': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'versions': versions}
+
+
+def regressions(runs, baseline, threshold=1.5):
+    """Runs slower than threshold x the same run of the baseline"""
+    previous = dict((tuple(json.dumps(r[k]) for k in KEY), r)
+                    for r in baseline if r.get('status') == 'ok')
+    slower = []
+    for r in runs:
+        old = previous.get(tuple(json.dumps(r[k]) for k in KEY))
+        if r['status'] != 'ok' or old is None:
+            continue
+        ratio = r['total'] / max(old['total'], 1e-9)
+        if ratio > threshold:
+            slower.append(dict(r, baseline=old['total'], ratio=ratio))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--orders', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--hours', type=float, nargs='+', default=[24])
+    parser.add_argument('--engines', nargs='+', default=['matrix'],
+                        choices=sorted(ENGINES))
+    parser.add_argument('--solvers', nargs='+', default=['highs'])
+    parser.add_argument('--grid', type=int, nargs=2, default=None,
+                        help='fine and coarse timesteps (see timegrid)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timelimit', type=float, default=5*60)
+    parser.add_argument('--mipgap', type=float, default=None)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--threshold', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    runs = []
+    for hours in args.hours:
+        for orders in args.orders:
+            for engine in args.engines:
+                for solver in args.solvers:
+                    record = run(engine, solver, orders, hours, args.grid,
+                                 args.seed, args.repeat, args.timelimit,
+                                 args.mipgap)
+                    runs.append(record)
+                    if record['status'] == 'ok':
+                        print('{engine:>13} {solver:>6} {orders:>5} orders '
+                              '{hours:>4}h: build {build:.3f}s solve '
+                              '{solve:.3f}s extract {extract:.3f}s '
+                              'objective {objective:.4f}'.format(**record))
+                    else:
+                        print('{engine:>13} {solver:>6} {orders:>5} orders '
+                              '{hours:>4}h: {error}'.format(**record))
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'runs': runs}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slower = regressions(runs, json.load(f)['runs'], args.threshold)
+        for r in slower:
+            print('Regression: {engine} {solver} {orders} orders {hours}h '
+                  '{total:.3f}s instead of {baseline:.3f}s'.format(**r))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
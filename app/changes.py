@@ -0,0 +1,147 @@
+"""
+Change detection of the forecast updates.
+
+Most hourly forecasts barely differ from the uncontrolled demand the
+last schedule was computed with. An update is compared with that demand
+over the optimization horizon: identical payloads (same hash) are
+skipped, small deviations (energy and peaks within tolerance) defer the
+re-optimization, which still happens once the deferral is too old, and
+larger ones ask for it right away. Deferred changes are also checked
+periodically (watch), so they do not wait for the next update.
+"""
+from datetime import datetime, timedelta
+import threading
+import hashlib
+import numpy
+import pandas
+
+
+class ForecastChanges(object):
+    """
+    Decide whether a forecast update needs a re-optimization.
+    Inputs:
+        - energy (float): tolerated deviation of the energy (kWh, sum of
+          the absolute differences over the horizon)
+        - peak (float): tolerated change of the highest and lowest
+          uncontrolled demand over the horizon (kW)
+        - max_delay (timedelta): re-optimize once small changes were
+          deferred for this long
+        - timestep (float): timestep of the demand (one is hourly)
+    """
+    def __init__(self, energy=5.0, peak=1.0, max_delay=timedelta(hours=3),
+                 timestep=1/12):
+        self.energy = energy
+        self.peak = peak
+        self.max_delay = max_delay
+        self.timestep = timestep
+        self.reference = None
+        self.last_hash = None
+        self.deferred_since = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def use(self, uncontr):
+        """Uncontrolled demand (Series) a solve was started with"""
+        with self._lock:
+            self.reference = uncontr.astype(float)
+            self.deferred_since = None
+
+    def check(self, values, start, end):
+        """
+        Inputs:
+            - values (Series): incoming demand by time (as stored, naive
+              times are UTC)
+            - start, end (Timestamp): optimization horizon
+        Outputs:
+            - decision (dict): solve (bool), reason (str) and the
+              deviations (energy, peak, new points)
+        """
+        digest = hashlib.sha1(
+            numpy.asarray(values.index.asi8).tobytes() +
+            numpy.asarray(values.values, dtype=float).tobytes()).hexdigest()
+        if values.index.tz is None:
+            values = values.tz_localize('UTC')
+        with self._lock:
+            repeated, self.last_hash = digest == self.last_hash, digest
+            decision = {'solve': True, 'reason': None, 'energy': None,
+                        'peak': None, 'new_points': None}
+            if self.reference is None:
+                decision['reason'] = 'no schedule to compare with'
+                return decision
+            if repeated and self.deferred_since is None:
+                return dict(decision, solve=False,
+                            reason='same forecast as the previous update')
+
+            new = values[(values.index >= start) & (values.index <= end)]
+            old = self.reference.reindex(new.index)
+            known = old.notna()
+            current = self.reference[(self.reference.index >= start) &
+                                     (self.reference.index <= end)]
+            merged = pandas.concat([current[~current.index.isin(new.index)],
+                                    new])
+            decision['energy'] = float(numpy.abs(
+                new[known] - old[known]).sum() * self.timestep)
+            decision['peak'] = (float(max(
+                abs(merged.max() - current.max()),
+                abs(merged.min() - current.min())))
+                if len(current) else 0.0)
+            decision['new_points'] = int((~known).sum())
+
+            if len(new) and not known.any():
+                decision['reason'] = 'no overlap with the last schedule'
+            elif decision['energy'] > self.energy:
+                decision['reason'] = 'energy deviation {:.3f} kWh > {}'.format(
+                    decision['energy'], self.energy)
+            elif decision['peak'] > self.peak:
+                decision['reason'] = 'peak deviation {:.3f} kW > {}'.format(
+                    decision['peak'], self.peak)
+            elif (decision['energy'] == 0 and decision['new_points'] == 0
+                  and self.deferred_since is None):
+                decision.update(solve=False, reason='no change over the '
+                                'optimization horizon')
+            else:
+                # Small change, picked up by the next solve
+                now = datetime.now()
+                if self.deferred_since is None:
+                    self.deferred_since = now
+                if now - self.deferred_since >= self.max_delay:
+                    decision['reason'] = 'changes deferred since {}'.format(
+                        self.deferred_since)
+                else:
+                    decision.update(solve=False, reason='deviation within '
+                                    'tolerance, deferred')
+            return decision
+
+    def due(self, now=None):
+        """Reason to solve the deferred changes now (None if not due)"""
+        now = now or datetime.now()
+        with self._lock:
+            if (self.deferred_since is None or
+                    now - self.deferred_since < self.max_delay):
+                return None
+            return 'changes deferred since {}'.format(self.deferred_since)
+
+    def watch(self, solve, interval=60):
+        """
+        Call solve(reason) whenever deferred changes are due, checked
+        every interval seconds by a background thread (started once)
+        """
+        def run():
+            while not self._stopped.wait(interval):
+                reason = self.due()
+                if reason is not None:
+                    solve(reason)
+
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=run, name='forecast-deferral', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background checks"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,140 @@
+"""
+Single-flight solve coordinator.
+
+Endpoints only mark the order book dirty, one background thread runs at
+most one solve at a time and folds every request that arrived during a
+solve into the next one of the same engine. With a JobManager, each
+solve is a job shared by all the requests it folds.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import threading
+import logging
+
+logger = logging.getLogger("api")
+
+
+class SolveCoordinator(object):
+    """
+    Run `solve` in the background, coalescing concurrent requests for
+    the same engine (passed to solve, `engine` if none is asked for)
+    """
+    def __init__(self, solve, jobs=None, engine=None):
+        self.solve = solve
+        self.jobs = jobs
+        self.engine = engine
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        # Job of each engine asked for, in the order of the requests
+        self.pending = OrderedDict()
+        self.running_job = None
+        self.running_engine = None
+        self.running = False
+        self.requests = 0
+        self.solves = 0
+        self.last_request = None
+        self.last_started = None
+        self.last_finished = None
+        self.last_duration = None
+        self.last_error = None
+
+    def start(self):
+        """Start the background worker (once)"""
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='solve-coordinator', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the background worker: no new solve is started, the running
+        one has timeout seconds to finish before its job is cancelled
+        (see JobManager.cancel)
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is None:
+            return
+        thread.join(timeout)
+        if thread.is_alive() and self.jobs is not None:
+            self.jobs.cancel()
+        thread.join()
+
+    def request(self, engine=None):
+        """Mark the order book dirty and return the current state"""
+        engine = engine or self.engine
+        with self._condition:
+            if engine not in self.pending:
+                self.pending[engine] = (
+                    None if self.jobs is None else
+                    self.jobs.create('optimization'))
+            self.requests += 1
+            self.last_request = datetime.now()
+            self._condition.notify()
+            return self._status(engine)
+
+    def status(self):
+        """Pending/running state and counters"""
+        with self._condition:
+            return self._status()
+
+    def _status(self, engine=None):
+        # Job of the engine (the next one to run by default)
+        job = self.pending.get(
+            engine, next(iter(self.pending.values()), None))
+        return {'pending': bool(self.pending),
+                'running': self.running,
+                'job': job,
+                'engines': list(self.pending),
+                'running_job': self.running_job,
+                'running_engine': self.running_engine,
+                'requests': self.requests,
+                'solves': self.solves,
+                'coalesced': self.requests - self.solves - len(self.pending),
+                'last_request': self.last_request,
+                'last_started': self.last_started,
+                'last_finished': self.last_finished,
+                'last_duration': self.last_duration,
+                'last_error': self.last_error}
+
+    def _run(self):
+        while True:
+            # Wait for a change, everything received so far is
+            # handled by this single solve
+            with self._condition:
+                while not self.pending and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                engine, self.running_job = self.pending.popitem(last=False)
+                self.running = True
+                self.running_engine = engine
+                self.solves += 1
+                self.last_started = datetime.now()
+
+            result, error = None, None
+            kwargs = {} if engine is None else {'engine': engine}
+            try:
+                if self.jobs is None:
+                    self.solve(**kwargs)
+                else:
+                    self.jobs.start(self.running_job)
+                    result = self.solve(self.running_job, **kwargs)
+            except Exception as e:
+                logger.exception('Optimization failed')
+                error = repr(e)
+            if self.jobs is not None:
+                self.jobs.finish(self.running_job, result=result, error=error)
+
+            with self._condition:
+                self.running = False
+                self.running_job = None
+                self.running_engine = None
+                self.last_finished = datetime.now()
+                self.last_duration = (
+                    self.last_finished - self.last_started).total_seconds()
+                self.last_error = error
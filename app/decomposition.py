@@ -0,0 +1,247 @@
+"""
+Per-asset decomposition of maximize_self_consumption for large fleets.
+
+Assets are only coupled through the community demand. The coordinator
+broadcasts a price signal (the community demand, i.e. the gradient of
+the valley-filling objective sum(demand**2) / 2) and every battery or
+shapeable load solves its own small LP (v4matrix with only that asset)
+in parallel worker processes. Their answers are blended with an exact
+line search (Frank-Wolfe), which keeps every schedule feasible.
+Deferrable loads are placed exactly against the community peak by
+enumerating their feasible start times, and the schedule with the best
+peakhigh - peaklow over the iterations is returned.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from v4norminf import grid_placements, step_lengths
+from results import Results
+from datetime import datetime
+import multiprocessing
+import contextlib
+import v4matrix
+import logging
+import pandas
+import numpy
+
+logger = logging.getLogger("api")
+
+# Result keys of each kind of asset
+KIND_KEYS = {'battery': ['batteryin', 'batteryout', 'batteryenergy'],
+             'shapeable': ['demandshape'],
+             'deferrable': ['demanddeferr', 'deferrschedule']}
+
+
+def community_objective(demand):
+    """peakhigh - peaklow of a community demand (with 0 <= peakhigh)"""
+    return max(numpy.max(demand), 0) - min(numpy.min(demand), 0)
+
+
+def best_response(kind, book, price, timestep, solver='gurobi',
+                  solver_path=None, timelimit=5*60, steps=None):
+    """
+    Cheapest schedule of one battery or shapeable load for a price
+    signal (the local problem of the decomposition).
+    Inputs:
+        - kind (str): battery or shapeable
+        - book (DataFrame): one row order book
+        - price (array): price of the net demand at each step (T,)
+        - steps (array): base timesteps of each step (None if uniform)
+    Outputs:
+        - values (dict): result key -> array (T,)
+        - demand (array): net demand of the asset (T,)
+    """
+    books = {'battery': pandas.DataFrame(),
+             'shapeable': pandas.DataFrame(),
+             'deferrable': pandas.DataFrame()}
+    books[kind] = book
+    T = len(price)
+    uncontrollable = pandas.DataFrame({'p': numpy.zeros(T)})
+    if steps is not None:
+        uncontrollable['steps'] = steps
+    problem = v4matrix.build_problem(
+        uncontrollable, books['battery'],
+        books['shapeable'], books['deferrable'], timestep)
+
+    # Price on demand_controllable instead of the peaks
+    problem.c[:] = 0
+    problem.c[:T] = price
+    x = v4matrix.solve_problem(problem, solver=solver,
+                               solver_path=solver_path, timelimit=timelimit)
+    result = v4matrix.extract_results(problem, x)
+    values = dict((key, result.array(key)[0][:, 0]) for key in KIND_KEYS[kind])
+    return values, result['demand_controllable']
+
+
+def maximize_self_consumption(uncontrollable, dfbatteries,
+                              dfshapeables, dfdeferrables,
+                              timestep, solver='gurobi',
+                              verbose=False, solver_path=None,
+                              timelimit=5*60, initial=None,
+                              max_iterations=50, tolerance=1e-4,
+                              workers=None, mipgap=None, executor=None):
+    """
+    Decomposed (approximate) version of
+    v4norminf.maximize_self_consumption for fleets too large for a
+    single MILP.
+    Inputs:
+        - same as v4norminf.maximize_self_consumption, the time limit
+          applies to the whole coordination (initial and mipgap are
+          ignored, the per-asset problems are LPs)
+        - max_iterations (int): coordination rounds
+        - tolerance (float): stop on a relative Frank-Wolfe gap below
+        - workers (int): worker processes (default: number of cores)
+          of the pool created for the call when executor is None
+        - executor (Executor or JobManager): runs the per-asset
+          problems through its map (e.g. the shared pool of the jobs)
+    Outputs:
+        - same dictionary as v4norminf.maximize_self_consumption
+    """
+    tic = datetime.now()
+    horizon = uncontrollable.index.tolist()
+    T = len(horizon)
+    u = numpy.asarray(uncontrollable.p.values, dtype=float)
+    steps = step_lengths(uncontrollable)
+
+    # Assets solved by the workers
+    assets = []
+    for kind, book in [('battery', dfbatteries),
+                       ('shapeable', dfshapeables)]:
+        assets += [(kind, i, book.loc[[i]]) for i in book.index]
+    values = [None] * len(assets)
+    demand = numpy.zeros((len(assets), T))
+
+    # Deferrables placed by enumeration
+    deferrables = []
+    for i in dfdeferrables.index:
+        order = dfdeferrables.loc[i]
+        starts, placements = grid_placements(
+            steps, order['startby'], order['endby'], order['duration'],
+            order['profile_kw'])
+        deferrables.append([i, starts, placements, None])
+
+    def place_deferrables(total):
+        # Gauss-Seidel: each load takes its best start given the others
+        for deferrable in deferrables:
+            i, starts, placements, choice = deferrable
+            if len(starts) == 0:
+                raise ValueError('Deferrable {} has no feasible start'
+                                 .format(i))
+            if choice is not None:
+                total = total - placements[choice]
+            candidates = total[None, :] + placements
+            objective = (numpy.maximum(candidates.max(axis=1), 0) -
+                         numpy.minimum(candidates.min(axis=1), 0))
+            deferrable[3] = int(numpy.argmin(objective))
+            total = total + placements[deferrable[3]]
+        return total
+
+    def responses(executor, price):
+        n = len(assets)
+        chunksize = max(1, n // (4 * (workers or 4)))
+        return list(executor.map(
+            best_response, [a[0] for a in assets], [a[2] for a in assets],
+            [price] * n, [timestep] * n, [solver] * n, [solver_path] * n,
+            [timelimit] * n, [steps] * n, chunksize=chunksize))
+
+    def snapshot():
+        return ([dict((k, v.copy()) for k, v in x.items()) for x in values],
+                [x[3] for x in deferrables], total.copy())
+
+    timings = {'build': (datetime.now() - tic).total_seconds()}
+    solve = datetime.now()
+    if executor is None:
+        executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+        owned = executor
+    else:
+        owned = contextlib.nullcontext()
+    with owned:
+        # Feasible start: cheapest schedules for the uncontrollable demand
+        total = u.copy()
+        if assets:
+            for a, (v, d) in enumerate(responses(executor, u)):
+                if not numpy.isfinite(d).all():
+                    raise ValueError('No feasible schedule for {} {}'.format(
+                        assets[a][0], assets[a][1]))
+                values[a], demand[a] = v, d
+            total = u + demand.sum(axis=0)
+        total = place_deferrables(total)
+        objective = community_objective(total)
+        best = snapshot()
+
+        # Solver statistics of the coordination
+        statistics = {'status': 'maxiterations', 'mipgap': None,
+                      'nodes': None, 'timelimit': False, 'iterations': 0}
+        for iteration in range(max_iterations):
+            if not assets:
+                statistics['status'] = 'optimal'
+                break
+            if (datetime.now() - tic).total_seconds() > timelimit:
+                logger.info('Decomposition stopped on the time limit')
+                statistics.update(status='timelimit', timelimit=True)
+                break
+            statistics['iterations'] = iteration + 1
+
+            # Price signal: gradient of the valley-filling surrogate
+            # sum(steps * total**2) / 2, each asset answers with its
+            # cheapest schedule (an asset whose solve failed keeps its
+            # schedule)
+            price = total * steps
+            new = [(v, d) if numpy.isfinite(d).all() else (values[a],
+                                                           demand[a])
+                   for a, (v, d) in enumerate(responses(executor, price))]
+            change = numpy.sum([d for v, d in new], axis=0) - demand.sum(
+                axis=0)
+
+            # Frank-Wolfe gap and exact line search on the surrogate
+            gap = -price.dot(change)
+            curvature = change.dot(steps * change)
+            if gap <= tolerance * price.dot(total) or curvature == 0:
+                statistics['status'] = 'converged'
+                break
+            step = min(1.0, gap / curvature)
+            for a, (v, d) in enumerate(new):
+                for key in v:
+                    values[a][key] = ((1 - step) * values[a][key] +
+                                      step * v[key])
+                demand[a] = (1 - step) * demand[a] + step * d
+            total = place_deferrables(u + demand.sum(axis=0) + sum(
+                x[2][x[3]] for x in deferrables))
+
+            # Keep the best schedule for the real objective
+            if community_objective(total) < objective:
+                objective = community_objective(total)
+                best = snapshot()
+            if verbose:
+                print('Iteration {}: step {:.3f}, objective {:.4f}'.format(
+                    iteration, step, community_objective(total)))
+
+    values, choices, total = best
+    for x, choice in zip(deferrables, choices):
+        x[3] = choice
+
+    #################################################### Results
+    timings['solve'] = (datetime.now() - solve).total_seconds()
+    extract = datetime.now()
+    results = Results(horizon, timestep * steps)
+    for kind in ['shapeable', 'battery']:
+        index = [a for a in range(len(assets)) if assets[a][0] == kind]
+        for key in KIND_KEYS[kind]:
+            if index:
+                results.set_array(key, numpy.column_stack(
+                    [values[a][key] for a in index]),
+                    [assets[a][1] for a in index])
+    if deferrables:
+        ids = [x[0] for x in deferrables]
+        schedule = numpy.zeros((T, len(ids)))
+        for d, x in enumerate(deferrables):
+            schedule[x[1][x[3]], d] = 1
+        results.set_array('demanddeferr', numpy.column_stack(
+            [x[2][x[3]] for x in deferrables]), ids)
+        results.set_array('deferrschedule', schedule, ids)
+
+    results.set_community(u, total - u, max(float(total.max()), 0),
+                          min(float(total.min()), 0))
+    timings['extract'] = (datetime.now() - extract).total_seconds()
+    results['timings'] = timings
+    results['solver'] = statistics
+    return results
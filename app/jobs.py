@@ -0,0 +1,225 @@
+"""
+Optimization jobs run on process pools.
+
+Solves run in worker processes so that the API stays responsive and
+several cores can be used. Live solves go to a single dedicated worker
+(which keeps the persistent model warm), other jobs to a shared pool.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from datetime import datetime
+import multiprocessing
+import itertools
+import threading
+import signal
+import uuid
+import time
+import os
+
+
+def _chunk(fn, arguments):
+    """Run fn on each tuple of arguments in a worker"""
+    return [fn(*args) for args in arguments]
+
+
+def _report(pids):
+    """Worker initializer: tell the manager which process to stop"""
+    pids.put(os.getpid())
+
+
+def _call(fn, args, kwargs):
+    """Run fn in a worker and time it there"""
+    started = time.time()
+    result = fn(*args, **kwargs)
+    return result, started, time.time()
+
+
+class JobManager(object):
+    """Keep track of the last `history` jobs and of their timings"""
+    def __init__(self, max_workers=None, history=100):
+        self.max_workers = max_workers
+        self.history = history
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._live = None
+        self._pool = None
+        self._manager = None
+        self._closed = False
+
+    def _executor(self, live):
+        # Spawned workers: forking a threaded server is not safe
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Job manager shut down')
+            if live and self._live is None:
+                self._live = self._create(1)
+            if not live and self._pool is None:
+                self._pool = self._create(self.max_workers)
+            return self._live if live else self._pool
+
+    def _create(self, max_workers):
+        context = multiprocessing.get_context('spawn')
+        pids = context.SimpleQueue()
+        executor = ProcessPoolExecutor(max_workers, mp_context=context,
+                                       initializer=_report,
+                                       initargs=(pids,))
+        # Worker processes (see _report) and futures not done yet
+        executor.pids = pids
+        executor.pending = set()
+        return executor
+
+    def _discard(self, executor):
+        """Forget a broken or shut down executor, the next job gets a
+        new one"""
+        with self._lock:
+            if self._live is executor:
+                self._live = None
+            elif self._pool is executor:
+                self._pool = None
+            else:
+                return
+        executor.shutdown(wait=False)
+
+    def queue(self):
+        """Queue the workers can put on (e.g. incumbent schedules)"""
+        with self._lock:
+            if self._manager is None:
+                self._manager = multiprocessing.get_context(
+                    'spawn').Manager()
+            return self._manager.Queue()
+
+    def create(self, kind):
+        """Register a new pending job and return its id"""
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self.jobs[job_id] = {'id': job_id,
+                                 'kind': kind,
+                                 'status': 'pending',
+                                 'submitted': datetime.now(),
+                                 'started': None,
+                                 'finished': None,
+                                 'timings': {},
+                                 'result': None,
+                                 'error': None}
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        return job_id
+
+    def update(self, job_id, **fields):
+        """Update the record of a job (ignored once it is forgotten)"""
+        with self._lock:
+            if job_id in self.jobs:
+                timings = fields.pop('timings', {})
+                self.jobs[job_id].update(fields)
+                self.jobs[job_id]['timings'].update(timings)
+
+    def get(self, job_id):
+        """Copy of a job record or None"""
+        with self._lock:
+            if job_id not in self.jobs:
+                return None
+            job = dict(self.jobs[job_id])
+            job['timings'] = dict(job['timings'])
+            return job
+
+    def start(self, job_id):
+        """Mark a job as running"""
+        with self._lock:
+            if job_id in self.jobs and self.jobs[job_id]['started'] is None:
+                self.jobs[job_id].update(status='running',
+                                         started=datetime.now())
+
+    def submit(self, job_id, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) for job_id in a worker process and
+        return its future, live=True uses the dedicated single worker.
+        """
+        live = kwargs.pop('live', False)
+        self.start(job_id)
+        queued = time.time()
+        future = self._submit(live, _call, fn, args, kwargs)
+        future.queued = queued
+        return future
+
+    def _submit(self, live, fn, *args):
+        """Submit to the executor, replaced once if broken or shut down"""
+        executor = self._executor(live)
+        try:
+            future = executor.submit(fn, *args)
+        except (BrokenProcessPool, RuntimeError):
+            self._discard(executor)
+            executor = self._executor(live)
+            future = executor.submit(fn, *args)
+        executor.pending.add(future)
+        future.add_done_callback(
+            lambda future: self._done(executor, future))
+        return future
+
+    def _done(self, executor, future):
+        executor.pending.discard(future)
+        if not future.cancelled() and \
+                isinstance(future.exception(), BrokenProcessPool):
+            self._discard(executor)
+
+    def map(self, fn, *iterables, chunksize=1):
+        """
+        Executor.map on the shared pool, e.g. for the subproblems of a
+        solve coordinated in this process (chunksize calls per task)
+        """
+        arguments = list(zip(*iterables))
+        futures = [self._submit(False, _chunk, fn,
+                                arguments[i:i + chunksize])
+                   for i in range(0, len(arguments), chunksize)]
+        return itertools.chain.from_iterable(
+            future.result() for future in futures)
+
+    def wait(self, job_id, future, phase='solve'):
+        """Result of a submitted future, its timings are added to job_id"""
+        result, started, finished = future.result()
+        self.update(job_id, timings={phase + '_queue': started - future.queued,
+                                     phase: finished - started})
+        return result
+
+    def run(self, job_id, fn, *args, **kwargs):
+        """submit() and wait() for the result"""
+        phase = kwargs.pop('phase', 'solve')
+        return self.wait(job_id, self.submit(job_id, fn, *args, **kwargs),
+                         phase)
+
+    def finish(self, job_id, result=None, error=None):
+        """Mark a job as done (or failed)"""
+        self.update(job_id, status='failed' if error else 'done',
+                    finished=datetime.now(), result=result, error=error)
+
+    def cancel(self):
+        """
+        Cancel the queued jobs and stop the workers of the running ones
+        (their futures fail), no job can be submitted afterwards
+        """
+        with self._lock:
+            self._closed = True
+            executors = [e for e in [self._live, self._pool]
+                         if e is not None]
+        for executor in executors:
+            for future in list(executor.pending):
+                future.cancel()
+            executor.shutdown(wait=False)
+            while not executor.pids.empty():
+                pid = executor.pids.get()
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass  # already gone
+
+    def shutdown(self):
+        """Stop the workers (see cancel), then the queue manager"""
+        with self._lock:
+            executors = [e for e in [self._live, self._pool]
+                         if e is not None]
+        self.cancel()
+        for executor in executors:
+            executor.shutdown(wait=True)
+        if self._manager is not None:
+            self._manager.shutdown()
+
@@ -1,13 +1,36 @@
-from typing import List
-from fastapi import FastAPI
-from pydantic import BaseModel
-from influxdb import DataFrameClient
+from typing import List, Optional, Union
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field, ValidationError
 from datetime import datetime, timedelta
-from v4norminf import maximize_self_consumption
+from dateutil.tz import tzlocal
+import v4norminf
+import v4matrix
+from coordinator import SolveCoordinator
+from changes import ForecastChanges
+from solvecache import SolveCache
+from archive import SnapshotArchive
+from results import Results
+import solvecache
+import anytime
+from jobs import JobManager
+from storage import Storage
+from publication import Publisher
+from orderbook import OrderBook
+import orderbook
+import persistent
+import decomposition
 import randomorders
+import timegrid
+import profiles
+import transport
+import metrics
+import functools
 import logging
 import pandas
-import time
+import queue
+import numpy
 import json
 
 # Solving Pyomo problem of threads
@@ -18,16 +41,106 @@ pyutilib.subprocess.GlobalData.DEFINE_SIGNAL_HANDLERS_DEFAULT = False
 # Contact j.coignard@lancey.fr
 # Note: struggled with timezone this is built for CEST (+2h)
 
+# Solver (cbc, gurobi and highs are warm started from the previous
+# schedule), glpk, cbc and gurobi run through Pyomo, highs is opt-in and
+# solves in-process without LP files (needed by anytime solving)
+solver = 'glpk'
+mipgap = None  # relative MIP gap, solver default if None
+
+# Optimization timestep
+TIMESTEP = 12  # 5min interval (60/5)
+
+# Optimization horizon, and its time grid as (base timesteps kept at
+# 5 min, base timesteps per step afterwards): e.g. (24, 6) is 5 min for
+# 2h then 30 min, None keeps 5 min over the whole horizon
+horizon_hours = 24
+grid = None
+
 # Influxdb connection
 host='influxdb'
 port=8086
 user = 'root'
 password = 'root'
 dbname = 'csc'
+timeout = 10  # seconds per request
+retries = 3
+pool_size = 10
+
+# Shared client (keep-alive connection pool) used by every endpoint
+db = Storage(host, port, user, password, dbname,
+             timeout=timeout, retries=retries, pool_size=pool_size)
+
+# Forecast updates re-optimize when the uncontrolled demand over the
+# horizon moved by more than forecast_energy (kWh) or its peaks by more
+# than forecast_peak (kW), smaller changes wait up to forecast_delay
+# (checked every forecast_check seconds)
+forecast_energy = 5.0
+forecast_peak = 1.0
+forecast_delay = timedelta(hours=3)
+forecast_check = 60
+forecast_changes = ForecastChanges(forecast_energy, forecast_peak,
+                                   forecast_delay, 1 / TIMESTEP)
+
+# Anytime solving: the first incumbent schedule found by highs is
+# published at once, later ones when peakhigh - peaklow improved by
+# anytime_improvement (relative), None only publishes the final one
+anytime_improvement = 0.02
+ANYTIME_ENGINES = ['matrix', 'persistent']
+
+# Results of the last cache_size solves, also saved to cache_directory
+# if not None
+cache_size = 32
+cache_directory = None
+solve_cache = SolveCache(cache_size, cache_directory)
+
+# Total demand snapshots (/savetotaldemand) archived in
+# archive_directory, deleted after archive_retention and downsampled to
+# archive_step minutes after archive_downsample, checked every
+# archive_maintenance seconds (the Grafana dashboard reads them from
+# /totaldemand/grafana, versioncontr is still written to influxdb if
+# archive_influxdb)
+archive_directory = 'archive'
+archive_retention = timedelta(days=365)
+archive_downsample = timedelta(days=7)
+archive_step = 60
+archive_maintenance = 3600
+archive_influxdb = False
+archive = SnapshotArchive(archive_directory, archive_retention,
+                          archive_downsample, archive_step)
+
+# Versioned schedules, the last `keep` versions are kept
+publisher = Publisher(db, keep=2)
+
+# Order books kept in memory, written through to the database
+orderbooks = dict((name, OrderBook(db, name))
+                  for name in ['bbook', 'sbook', 'dbook'])
 
 app = FastAPI()
 logger = logging.getLogger("api")
 
+# Model builders returning the same results, the others are opt-in
+# (/optimize?engine=...): persistent keeps its model between calls and
+# rebuilds changes only, decomposition solves per-asset problems in
+# parallel for large fleets
+ENGINES = {'pyomo': v4norminf.maximize_self_consumption,
+           'matrix': v4matrix.maximize_self_consumption,
+           'persistent': persistent.maximize_self_consumption,
+           'decomposition': decomposition.maximize_self_consumption}
+DEFAULT_ENGINE = 'pyomo'
+
+# Engines coordinating their solve from the API process, their
+# subproblems run on the job pool (see JobManager.map)
+POOLED_ENGINES = ['decomposition']
+
+# Last solution, shifted to warm start the next solve
+last_solution = {}
+RESULT_KINDS = {'demandshape': 'shapeable',
+                'batteryin': 'battery',
+                'batteryout': 'battery',
+                'batteryenergy': 'battery',
+                'demanddeferr': 'deferrable',
+                'deferrschedule': 'deferrable'}
+
 class BatteryOrder(BaseModel):
     startby: str
     endby: str
@@ -48,7 +161,104 @@ class DeferrableOrder(BaseModel):
     startby: str
     endby: str
     duration: int
-    profile_kw: str
+    profile_kw: Union[str, List[float]]
+
+# Columnar (one list per field) orders of the bulk endpoint
+class BatteryOrders(BaseModel):
+    startby: List[str]
+    endby: List[str]
+    min_kw: List[float]
+    max_kw: List[float]
+    max_kwh: List[float]
+    initial_kwh: List[float]
+    end_kwh: List[float]
+    eta: List[float]
+
+class ShapeableOrders(BaseModel):
+    startby: List[str]
+    endby: List[str]
+    max_kw: List[float]
+    end_kwh: List[float]
+
+class DeferrableOrders(BaseModel):
+    startby: List[str]
+    endby: List[str]
+    duration: List[int]
+    profile_kw: List[Union[str, List[float]]]
+
+class BulkOrders(BaseModel):
+    batteries: Optional[BatteryOrders] = None
+    shapeables: Optional[ShapeableOrders] = None
+    deferrables: Optional[DeferrableOrders] = None
+
+class Forecast(BaseModel):
+    times: List[str]
+    values: List[float]
+
+# Query of the Grafana JSON datasource (SimpleJSON protocol)
+class GrafanaRange(BaseModel):
+    start: datetime = Field(..., alias='from')
+    end: datetime = Field(..., alias='to')
+
+class GrafanaTarget(BaseModel):
+    target: str = ''
+
+class GrafanaQuery(BaseModel):
+    range: GrafanaRange
+    targets: List[GrafanaTarget] = []
+
+class Scenario(BaseModel):
+    name: str
+    # Orders added to the (base) order books
+    batteries: List[BatteryOrder] = []
+    shapeables: List[ShapeableOrder] = []
+    deferrables: List[DeferrableOrder] = []
+    # Order times left out of the base order books (as /remove...order),
+    # every base order if base is False
+    remove_batteries: List[str] = []
+    remove_shapeables: List[str] = []
+    remove_deferrables: List[str] = []
+    base: bool = True
+    # Uncontrolled demand replacing the forecast at these times
+    forecast: Optional[Forecast] = None
+
+class Scenarios(BaseModel):
+    scenarios: List[Scenario]
+    engine: str = 'matrix'
+    timelimit: float = 60
+
+
+@app.on_event("startup")
+def start_coordinator():
+    # Upcoming orders only, the others can not be optimized anymore
+    for book in orderbooks.values():
+        try:
+            book.load(since=datetime.now().timestamp() * 1000)
+        except Exception:
+            logger.exception('Order book {} not loaded'.format(
+                book.measurement))
+    coordinator.start()
+    forecast_changes.watch(solve_deferred, forecast_check)
+    archive.start(archive_maintenance)
+
+
+def solve_deferred(reason):
+    # Deferred forecast changes too old (no update came since)
+    metrics.forecast_updates.inc(decision='solve')
+    coordinator.request()
+    logger.info('Forecast update: ' + reason)
+
+
+@app.on_event("shutdown")
+def stop_jobs():
+    # Background checks and coordinator first (a running solve has
+    # shutdown_timeout seconds to finish, then it is cancelled), then the
+    # workers and the manager
+    forecast_changes.stop()
+    archive.stop()
+    coordinator.stop(shutdown_timeout)
+    jobs.shutdown()
+    db.close()
 
 
 @app.get("/ping")
@@ -57,51 +267,169 @@ def ping():
 
 
 @app.post("/optimize")
-def optimize():
-    optimization()
-    return {"status": "sucess"}
+def optimize(engine: str = DEFAULT_ENGINE):
+    # Solves run in a worker process, poll /jobs/{job_id} (requests for
+    # the same engine share one solve)
+    if engine not in ENGINES:
+        raise HTTPException(status_code=400, detail="Unknown engine")
+    return {"status": "sucess", "engine": engine,
+            "job": coordinator.request(engine)['job']}
+
+
+@app.get("/storagestats")
+def storage_stats():
+    return {"status": "sucess", "storage": db.stats()}
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+@app.get("/optimizationstatus")
+def optimization_status():
+    return {"status": "sucess", "optimization": coordinator.status()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    # Phase durations and solver statistics (Prometheus text format)
+    return PlainTextResponse(metrics.registry.render(),
+                             media_type="text/plain; version=0.0.4")
+
+
+@app.post("/scenarios")
+def scenarios(request: Scenarios):
+    # What-if solves on copies of the current inputs, solved in parallel
+    # on the job pool, nothing is written
+    if request.engine not in ENGINES:
+        raise HTTPException(status_code=400, detail="Unknown engine")
+    uncontr, books = snapshot()
+    cases = [('base', uncontr, books)] + [
+        (s.name,) + scenario_inputs(uncontr, books, s)
+        for s in request.scenarios]
+
+    job = jobs.create('scenarios')
+    kwargs = dict(timestep=1/TIMESTEP, solver=solver, verbose=False,
+                  timelimit=request.timelimit, mipgap=mipgap)
+    futures = []
+    for name, case_uncontr, case_books in cases:
+        args = problem_inputs(case_uncontr, case_books)
+        if grid is not None:
+            args[0] = timegrid.coarsen(
+                args[0], timegrid.time_grid(len(args[0]), *grid))
+        key = solve_key(request.engine, args, kwargs)
+        result = cached(key)
+        if result is not None:
+            futures.append((key, result))
+        elif request.engine in POOLED_ENGINES:
+            # Solved when waited for (its subproblems use the pool)
+            futures.append((key, functools.partial(
+                pooled_solve, job, request.engine, args, kwargs, name)))
+        else:
+            futures.append((key, jobs.submit(
+                job, ENGINES[request.engine], *args, **kwargs)))
+
+    outcomes = []
+    for (name, case_uncontr, case_books), (key, future) in zip(cases,
+                                                                futures):
+        outcome = {'name': name,
+                   'orders': dict((n, len(b)) for n, b in
+                                  case_books.items())}
+        try:
+            if isinstance(future, Results):
+                result = future
+            elif callable(future):
+                result = future()
+            else:
+                result = jobs.wait(job, future, phase=name)
+                if cacheable(result):
+                    solve_cache.put(key, result)
+            if grid is not None:
+                opt = problem_inputs(case_uncontr, case_books)
+                result = timegrid.expand_results(
+                    result, *opt, timestep=1/TIMESTEP,
+                    steps=timegrid.time_grid(len(opt[0]), *grid))
+            outcome.update(
+                status=result.get('solver', {}).get('status', 'done'),
+                peakhigh=float(result['peakhigh']),
+                peaklow=float(result['peaklow']),
+                total_community_import=float(
+                    result['total_community_import']))
+        except Exception as e:
+            logger.exception('Scenario {} failed'.format(name))
+            outcome.update(status='failed', error=repr(e))
+        outcomes.append(outcome)
+
+    # Difference with the base case
+    base = outcomes[0]
+    for outcome in outcomes[1:]:
+        if 'peakhigh' in outcome and 'peakhigh' in base:
+            outcome['difference'] = dict(
+                (k, outcome[k] - base[k]) for k in
+                ['peakhigh', 'peaklow', 'total_community_import'])
+    jobs.finish(job, result={'scenarios': len(outcomes)})
+    return {"status": "sucess", "job": job, "engine": request.engine,
+            "base": base, "scenarios": outcomes[1:]}
 
 
 @app.put("/forecast")
-def forecast(times: List[str], values: List[float]):
-    df = pandas.DataFrame(
-        index=pandas.DatetimeIndex(times).round('5T'),
-        data={'uncontr': values})
-
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'uncontr')
-    client.close()
-
-    # Run optimization
-    optimization()
-    return {"status": "sucess"}
+async def forecast(request: Request):
+    # JSON lists of times and values or columnar binary (see transport)
+    body = await request.body()
+    try:
+        if request.headers.get('content-type', '').startswith(
+                transport.CONTENT_TYPE):
+            times, values = transport.decode_forecast(body)
+        else:
+            data = Forecast(**json.loads(body))
+            if len(data.times) != len(data.values):
+                raise ValueError('{} times but {} values'.format(
+                    len(data.times), len(data.values)))
+            times, values = pandas.DatetimeIndex(data.times), data.values
+        df = pandas.DataFrame(index=times.round('5min'),
+                              data={'uncontr': values})
+    except (ValueError, TypeError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    # Write to DB
+    await run_in_threadpool(db.write_points, df, 'uncontr')
+
+    # Ask for a re-optimization (coalesced in the background) unless the
+    # horizon barely changed since the last solve
+    now = datetime.now()
+    decision = forecast_changes.check(
+        df['uncontr'],
+        pandas.Timestamp(now + timedelta(minutes=5)).tz_localize('UTC'),
+        pandas.Timestamp(now + timedelta(hours=horizon_hours)).tz_localize(
+            'UTC'))
+    metrics.forecast_updates.inc(
+        decision='solve' if decision['solve'] else 'skip')
+    if decision['solve']:
+        coordinator.request()
+    logger.info('Forecast update: ' + decision['reason'])
+    return {"status": "sucess", "optimization": decision}
 
 
 @app.put("/batteryorder")
 def battery_order(order: BatteryOrder):
-    # Convert start and end time in second since epoch
-    # minus 2 hours is a work around #@?! timezone
-    # times 1000 for milliseconds
-    order.startby = (datetime.strptime(
-        order.startby, '%Y-%m-%dT%H:%M:%SZ') -
-        timedelta(hours=2)).timestamp() * 1000
-    order.endby = (datetime.strptime(
-        order.endby, '%Y-%m-%dT%H:%M:%SZ') -
-        timedelta(hours=2)).timestamp() * 1000
+    # Convert start and end time in milliseconds since epoch
+    order.startby = order_time(order.startby)
+    order.endby = order_time(order.endby)
 
     # Create a dataframe to be saved to influxdb
     df = pandas.DataFrame(
         index=[datetime.now().replace(second=0, microsecond=0)],
         data=json.loads(order.json()))
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'bbook')
-    client.close()
+    # Write to DB
+    orderbooks['bbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
@@ -110,13 +438,11 @@ def random_battery_order():
     # Retrieve random order
     df = randomorders.random_battery_orderbook()
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'bbook')
-    client.close()
+    # Write to DB
+    orderbooks['bbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
@@ -128,46 +454,32 @@ def remove_battery_order(t: str):
             'max_kwh': [0.0],
             'initial_kwh': [0.0],
             'end_kwh': [0.0]}
-    # minus 2 hours is a work around #@?! timezone
-    df = pandas.DataFrame(
-        index=[datetime.strptime(t, '%Y-%m-%d %H:%M:%S') -
-               timedelta(hours=2)],
-        data=data)
+    df = pandas.DataFrame(index=[removal_time(t)], data=data)
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'bbook')
-    client.close()
+    # Write to DB
+    orderbooks['bbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
 @app.put("/shapeableorder")
 def shapeable_order(order: ShapeableOrder):
-    # Convert start and end time in second since epoch
-    # minus 2 hours is a work around #@?! timezone
-    # times 1000 for milliseconds
-    order.startby = (datetime.strptime(
-        order.startby, '%Y-%m-%dT%H:%M:%SZ') -
-        timedelta(hours=2)).timestamp() * 1000
-    order.endby = (datetime.strptime(
-        order.endby, '%Y-%m-%dT%H:%M:%SZ') -
-        timedelta(hours=2)).timestamp() * 1000
+    # Convert start and end time in milliseconds since epoch
+    order.startby = order_time(order.startby)
+    order.endby = order_time(order.endby)
 
     # Create a dataframe to be saved to influxdb
     df = pandas.DataFrame(
         index=[datetime.now().replace(second=0, microsecond=0)],
         data=json.loads(order.json()))
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'sbook')
-    client.close()
+    # Write to DB
+    orderbooks['sbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
@@ -176,13 +488,11 @@ def random_shapeable_order():
     # Retrieve random order
     df = randomorders.random_shapeable_orderbook()
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'sbook')
-    client.close()
+    # Write to DB
+    orderbooks['sbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
@@ -191,84 +501,96 @@ def remove_shapeable_order(t: str):
     # Create fake order with 0
     data = {'max_kw': [0.0],
             'end_kwh': [0.0]}
-    # minus 2 hours is a work around #@?! timezone
-    df = pandas.DataFrame(
-        index=[datetime.strptime(t, '%Y-%m-%d %H:%M:%S') -
-               timedelta(hours=2)],
-        data=data)
+    df = pandas.DataFrame(index=[removal_time(t)], data=data)
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'sbook')
-    client.close()
+    # Write to DB
+    orderbooks['sbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
 @app.put("/deferrableorder")
 def deferrable_order(order: DeferrableOrder):
-    # Convert start and end time in second since epoch
-    # minus 2 hours is a work around #@?! timezone
-    # times 1000 for milliseconds
-    order.startby = (datetime.strptime(
-        order.startby, '%Y-%m-%dT%H:%M:%SZ') -
-        timedelta(hours=2)).timestamp() * 1000
-    order.endby = (datetime.strptime(
-        order.endby, '%Y-%m-%dT%H:%M:%SZ') -
-        timedelta(hours=2)).timestamp() * 1000
+    # Convert start and end time in milliseconds since epoch
+    order.startby = order_time(order.startby)
+    order.endby = order_time(order.endby)
+
+    # Power profile stored as packed floats (list or stringified list)
+    order.profile_kw = profiles.encode_profile(order.profile_kw)
 
     # Create a dataframe to be saved to influxdb
     df = pandas.DataFrame(
         index=[datetime.now().replace(second=0, microsecond=0)],
         data=json.loads(order.json()))
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'dbook')
-    client.close()
+    # Write to DB
+    orderbooks['dbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
 @app.post("/randomdeferrableorder")
 def random_deferrable_order():
     # Retrieve random order
-    TIMESTEP = 12
     df = randomorders.random_deferrable_orderbook(
         timestep=60/TIMESTEP)
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'dbook')
-    client.close()
+    # Write to DB
+    orderbooks['dbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
+@app.put("/bulkorders")
+def bulk_orders(orders: BulkOrders):
+    # Every order of the payload is validated, then written in one
+    # request and a single re-optimization is asked for
+    frames, errors, keys = [], [], {}
+    for name, kind, columns in [('bbook', 'batteries', orders.batteries),
+                                ('sbook', 'shapeables', orders.shapeables),
+                                ('dbook', 'deferrables', orders.deferrables)]:
+        if columns is None:
+            continue
+        df, problems = order_frame(kind, json.loads(columns.json()))
+        errors += problems
+        if not problems and len(df) > 0:
+            df.index = orderbooks[name].new_keys(len(df))
+            frames.append((orderbooks[name], df))
+            # Times to remove the orders (see /remove...order)
+            keys[kind] = list((df.index + timedelta(hours=2)).strftime(
+                '%Y-%m-%d %H:%M:%S.%f'))
+    if errors:
+        raise HTTPException(status_code=422, detail=errors[:100])
+
+    # Write to DB
+    if frames:
+        orderbook.write_books(db, frames)
+
+        # Ask for a re-optimization (coalesced in the background)
+        coordinator.request()
+    return {"status": "sucess",
+            "orders": dict((k, len(v)) for k, v in keys.items()),
+            "keys": keys}
+
+
 @app.post("/removedeferrableorder")
 def remove_deferrable_order(t: str):
     # Create fake order with 0
     data = {'duration': [1],
-            'profile_kw': [[0.0]]}
-    # minus 2 hours is a work around #@?! timezone
-    df = pandas.DataFrame(
-        index=[datetime.strptime(t, '%Y-%m-%d %H:%M:%S') -
-               timedelta(hours=2)],
-        data=data)
+            'profile_kw': [profiles.encode_profile([0.0])]}
+    df = pandas.DataFrame(index=[removal_time(t)], data=data)
 
-    # Open connection and write to DB
-    client = DataFrameClient(host, port, user, password, dbname)
-    client.write_points(df, 'dbook')
-    client.close()
+    # Write to DB
+    orderbooks['dbook'].write(df)
 
-    # Run optimization
-    optimization()
+    # Ask for a re-optimization (coalesced in the background)
+    coordinator.request()
     return {"status": "sucess"}
 
 
@@ -276,35 +598,107 @@ def remove_deferrable_order(t: str):
 def save_total_demand():
     # Limit the number of call to avoid
     # high cardinality of influxdb tags
-    # Query total demand data
-    client = DataFrameClient(host, port, user, password, dbname)
+    # Query total demand data (current version of the schedules)
     start = datetime.now()
-    query = ("select * from contr " +
-             "WHERE time >= '" +
+    version = publisher.current()
+    query = ("select contr from contr " +
+             ("WHERE version = '" + version + "' AND "
+              if version is not None else "WHERE ") +
+             "time >= '" +
              (start).strftime("%Y-%m-%dT%H:%M:%SZ") +
              "' AND time <= '" +
              (start +
               timedelta(hours=24)).strftime("%Y-%m-%dT%H:%M:%SZ") +
              "'")
-    contr = client.query(query)['contr']
-
-    # Save it to a different measurement
-    client.write_points(
-        contr, 'versioncontr',
-        {'version': str(int(datetime.now().replace(
-            second=0, microsecond=0).timestamp() * 1000))})
-    client.close()
+    contr = db.query(query)['contr']
+    version = int(datetime.now().replace(
+        second=0, microsecond=0).timestamp() * 1000)
+
+    # Save it to the local archive (the retention and downsampling are
+    # applied in the background)
+    archive.append(version, contr['contr'])
+    if archive_influxdb:
+        # Save it to a different measurement
+        db.write_points(contr, 'versioncontr', {'version': str(version)})
+    return {"status": "sucess", "version": version}
+
+
+@app.get("/totaldemand/versions")
+def total_demand_versions(start: Optional[int] = None,
+                          end: Optional[int] = None):
+    # Archived versions (milliseconds since epoch) between start and end
+    return {"status": "sucess", "versions": archive.versions(start, end)}
+
+
+@app.get("/totaldemand/compare")
+def total_demand_compare(start: Optional[int] = None,
+                         end: Optional[int] = None):
+    # Forecast versus actual total demand of the archived versions
+    df = archive.compare(start, end)
+    return {"status": "sucess",
+            "versions": json.loads(df.to_json(orient='records'))}
+
+
+# Grafana JSON datasource of the archive (e.g. simpod-json-datasource),
+# the totaldemand target has one series per version as versioncontr had
+@app.get("/totaldemand/grafana")
+def total_demand_grafana():
+    # Connection test of the datasource
     return {"status": "sucess"}
 
 
-# Move to its own file
-def optimization():
-    # Optimization timestep
-    TIMESTEP = 12  # 5min interval (60/5)
+@app.post("/totaldemand/grafana/search")
+@app.post("/totaldemand/grafana/metrics")
+def total_demand_grafana_targets():
+    return ['totaldemand']
+
+
+@app.post("/totaldemand/grafana/query")
+def total_demand_grafana_query(query: GrafanaQuery):
+    start = pandas.Timestamp(query.range.start)
+    end = pandas.Timestamp(query.range.end)
+    series = []
+    if any(t.target == 'totaldemand' for t in query.targets):
+        for version, values in archive.snapshots(
+                start, end, timedelta(hours=horizon_hours)):
+            series.append({
+                'target': str(version),
+                'datapoints': [[value, int(t.timestamp() * 1000)]
+                               for t, value in values.items()]})
+    return series
+
+
+@app.get("/totaldemand/{version}")
+def total_demand(version: int):
+    # Archived snapshot of a version
+    series = archive.read(version)
+    if series is None:
+        raise HTTPException(status_code=404, detail="Unknown version")
+    return {"status": "sucess", "version": version,
+            "times": [t.strftime('%Y-%m-%dT%H:%M:%SZ')
+                      for t in series.index],
+            "values": series.tolist()}
+
 
+# Move to its own file
+def optimization(job=None, engine=DEFAULT_ENGINE):
+    try:
+        with metrics.phase('cycle', engine):
+            output = solve_cycle(job, engine)
+    except Exception:
+        metrics.cycles.inc(engine=engine, outcome='failed')
+        raise
+    metrics.cycles.inc(engine=engine, outcome='ok')
+    return output
+
+
+def snapshot(laps=None):
+    """
+    Uncontrolled demand and active orders (as saved to influxdb) of the
+    optimization window starting now.
+    """
     # Query uncontrolled demand
     # Note: uncontrolled demand is already on a 5min timestep
-    client = DataFrameClient(host, port, user, password, dbname)
     start = datetime.now()
     query = ("select * from uncontr " +
              "WHERE time >= '" +
@@ -312,134 +706,313 @@ def optimization():
              timedelta(minutes=5)).strftime("%Y-%m-%dT%H:%M:%SZ") +
              "' AND time <= '" +
              (start +
-             timedelta(hours=24)).strftime("%Y-%m-%dT%H:%M:%SZ") +
+             timedelta(hours=horizon_hours)).strftime("%Y-%m-%dT%H:%M:%SZ") +
              "'")
-    uncontr = client.query(query)['uncontr']
+    uncontr = db.query(query)['uncontr']
+    if laps is not None:
+        laps.lap('uncontr_query')
+
+    # Active orders from the in-memory order books (no query)
+    window = ((start + timedelta(minutes=5)).timestamp() * 1000,
+              (start + timedelta(hours=horizon_hours)).timestamp() * 1000)
+    for book in orderbooks.values():
+        if not book.loaded:
+            book.load(since=window[0])
+        # Orders which started can not be selected anymore
+        book.prune(window[0])
+    books = dict((name, book.active(*window))
+                 for name, book in orderbooks.items())
+    if laps is not None:
+        laps.lap('orderbooks')
+    return uncontr, books
+
+
+def solve_key(engine, args, kwargs):
+    """Cache key of a solve (the warm start and verbosity aside)"""
+    return solvecache.canonical_key(*args, engine=engine, **dict(
+        (k, v) for k, v in kwargs.items()
+        if k not in ['initial', 'verbose', 'incumbent']))
+
+
+def pooled_solve(job, engine, args, kwargs, phase='solve'):
+    """
+    Solve with one of the POOLED_ENGINES: coordinated in this thread,
+    its subproblems run on the job pool, the duration is added to job
+    """
+    jobs.start(job)
+    tic = datetime.now()
+    result = ENGINES[engine](*args, executor=jobs, **kwargs)
+    jobs.update(job, timings={
+        phase: (datetime.now() - tic).total_seconds()})
+    return result
+
+
+def cached(key):
+    """Cached results of a solve or None, counted in the metrics"""
+    result = solve_cache.get(key)
+    metrics.solve_cache.inc(result='miss' if result is None else 'hit')
+    return result
+
 
-    # Get the reference t=0
+def cacheable(result):
+    """
+    Results worth reusing: proven optimal (not cut by a time or
+    iteration limit) with finite schedules (see Results.has_solution)
+    """
+    return (result.get('solver') or {}).get('status') == 'optimal' and \
+        result.has_solution()
+
+
+def problem_inputs(uncontr, books):
+    """
+    maximize_self_consumption inputs of a snapshot: integer time steps
+    from the first uncontrolled demand and positions as order ids.
+    """
     first_t = uncontr.iloc[0].name
-    uncontr_t = uncontr.index
-    uncontr_index = list(range(0, len(uncontr_t)))
+    return ([pandas.DataFrame({'p': uncontr['uncontr'].values})] +
+            [orderbook.normalize(books[name], first_t, 60 / TIMESTEP)
+             for name in ['bbook', 'sbook', 'dbook']])
 
-    # Change index to integers and rename column
-    opt_uncontr = uncontr.copy()
-    opt_uncontr['index'] = uncontr_index
-    opt_uncontr.set_index('index', drop=True, inplace=True)
-    opt_uncontr.rename(columns={'uncontr': 'p'}, inplace=True)
 
-    # Query order books
-    try:
-        query = ("select * from bbook " +
-             "WHERE startby >= " +
-             str(int((start +
-             timedelta(minutes=5)).timestamp() * 1000)) +
-             " AND endby <= " +
-             str(int((start +
-             timedelta(hours=24)).timestamp() * 1000)))
-        bbook = client.query(query)['bbook']
-
-        # Set startby and endby as integers
-        opt_bbook = bbook.copy()
-        opt_bbook['startby'] -= first_t.timestamp() * 1000
-        opt_bbook['startby'] /= 60 * 1000 * 60 / TIMESTEP
-        opt_bbook['endby'] -= first_t.timestamp() * 1000
-        opt_bbook['endby'] /= 60 * 1000 * 60 / TIMESTEP
-        opt_bbook['id'] = list(range(0, len(opt_bbook)))
-        opt_bbook.set_index('id', drop=True, inplace=True)
-    except:
-        # No orders at the moment
-        opt_bbook = pandas.DataFrame()
+def order_time(text):
+    """Order time ('%Y-%m-%dT%H:%M:%SZ') in milliseconds since epoch"""
+    # minus 2 hours is a work around #@?! timezone
+    return (datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ') -
+            timedelta(hours=2)).timestamp() * 1000
 
-    try:
-        query = ("select * from sbook " +
-                 "WHERE startby >= " +
-                 str(int((start +
-                 timedelta(minutes=5)).timestamp() * 1000)) +
-                 " AND endby <= " +
-                 str(int((start +
-                 timedelta(hours=24)).timestamp() * 1000)))
-        sbook = client.query(query)['sbook']
-
-        # Set startby and endby as integers
-        opt_sbook = sbook.copy()
-        opt_sbook['startby'] -= first_t.timestamp() * 1000
-        opt_sbook['startby'] /= 60 * 1000 * 60 / TIMESTEP
-        opt_sbook['endby'] -= first_t.timestamp() * 1000
-        opt_sbook['endby'] /= 60 * 1000 * 60 / TIMESTEP
-        opt_sbook['id'] = list(range(0, len(opt_sbook)))
-        opt_sbook.set_index('id', drop=True, inplace=True)
-    except:
-        # No orders at the moment
-        opt_sbook = pandas.DataFrame()
 
+def order_times(texts):
+    """Vectorized order_time, NaN for the invalid times"""
+    times = pandas.to_datetime(pandas.Series(texts, dtype=object),
+                               format='%Y-%m-%dT%H:%M:%SZ', errors='coerce')
+    # minus 2 hours is a work around #@?! timezone, naive times are local
+    # times as for datetime.timestamp()
+    times = (times - timedelta(hours=2)).dt.tz_localize(
+        tzlocal(), ambiguous='NaT', nonexistent='NaT')
+    return ((times - pandas.Timestamp(0, tz='UTC')) /
+            pandas.Timedelta(milliseconds=1)).values
 
-    try:
-        query = ("select * from dbook " +
-                 "WHERE startby >= " +
-                 str(int((start +
-                 timedelta(minutes=5)).timestamp() * 1000)) +
-                 " AND endby <= " +
-                 str(int((start +
-                 timedelta(hours=24)).timestamp() * 1000)))
-        dbook = client.query(query)['dbook']
-
-        opt_dbook = dbook.copy()
-        opt_dbook['startby'] -= first_t.timestamp() * 1000
-        opt_dbook['startby'] /= 60 * 1000 * 60 / TIMESTEP
-        opt_dbook['endby'] -= first_t.timestamp() * 1000
-        opt_dbook['endby'] /= 60 * 1000 * 60 / TIMESTEP
-        opt_dbook['id'] = list(range(0, len(opt_dbook)))
-        opt_dbook.set_index('id', drop=True, inplace=True)
-        # Turn profile_kw from str to floats
-        opt_dbook['profile_kw'] = opt_dbook['profile_kw'].apply(
-            lambda x: [float(v) for v in
-                       x[1:][:-1].replace(" ", "").split(',')])
-    except:
-        # No orders at the moment
-        opt_dbook = pandas.DataFrame()
-
-    # Run the optimization
+
+def removal_time(text):
+    """Order time to remove ('%Y-%m-%d %H:%M:%S', fractional seconds)"""
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in text else '%Y-%m-%d %H:%M:%S'
+    # minus 2 hours is a work around #@?! timezone
+    return datetime.strptime(text, fmt) - timedelta(hours=2)
+
+
+def order_frame(kind, columns):
+    """
+    Orders of one kind from columns (see BulkOrders), validated at once.
+    Outputs:
+        - df (DataFrame): orders as saved to influxdb (no index yet)
+        - errors (list): one message per invalid order
+    """
+    lengths = set(len(values) for values in columns.values())
+    if len(lengths) > 1:
+        return None, ['{}: columns of different lengths'.format(kind)]
+    df = pandas.DataFrame(columns)
+    if len(df) == 0:
+        return df, []
+    df['startby'] = order_times(df['startby'])
+    df['endby'] = order_times(df['endby'])
+    invalid = pandas.DataFrame({
+        'time': df['startby'].isna() | df['endby'].isna(),
+        'window': df['endby'] < df['startby']})
+    numeric = [c for c in df.columns
+               if c not in ['startby', 'endby', 'profile_kw']]
+    invalid['negative'] = (df[numeric] < 0).any(axis=1)
+    if kind == 'batteries':
+        invalid['eta'] = (df['eta'] <= 0) | (df['eta'] > 1)
+        invalid['initial_kwh'] = df['initial_kwh'] > df['max_kwh']
+    errors = ['{} {}: invalid {}'.format(
+        kind, i, ', '.join(invalid.columns[invalid.loc[i].values]))
+        for i in numpy.flatnonzero(invalid.any(axis=1))]
+    if kind == 'deferrables' and not errors:
+        # Power profiles stored as packed floats
+        df['profile_kw'] = df['profile_kw'].map(profiles.encode_profile)
+    return df, errors
+
+
+def scenario_inputs(uncontr, books, scenario):
+    """Snapshot (see snapshot) with the changes of a Scenario"""
+    uncontr = uncontr.copy()
+    if scenario.forecast is not None:
+        index = pandas.DatetimeIndex(scenario.forecast.times).round('5min')
+        if index.tz is None:
+            index = index.tz_localize('UTC')
+        forecast = pandas.Series(scenario.forecast.values, index=index)
+        common = uncontr.index.intersection(forecast.index)
+        uncontr.loc[common, 'uncontr'] = forecast[common].values
+
+    added = {'bbook': scenario.batteries,
+             'sbook': scenario.shapeables,
+             'dbook': scenario.deferrables}
+    removed = {'bbook': scenario.remove_batteries,
+               'sbook': scenario.remove_shapeables,
+               'dbook': scenario.remove_deferrables}
+    changed = {}
+    for name, book in books.items():
+        book = book if scenario.base else book.iloc[:0]
+        if removed[name]:
+            book = book[~book.index.isin(pandas.DatetimeIndex([
+                removal_time(t) for t in removed[name]]).tz_localize('UTC'))]
+        if added[name]:
+            # Orders keyed after every existing order (never written)
+            orders = pandas.DataFrame(
+                [json.loads(order.json()) for order in added[name]],
+                index=pandas.date_range(pandas.Timestamp.now(tz='UTC'),
+                                        periods=len(added[name]),
+                                        freq='ms'))
+            orders['startby'] = orders['startby'].map(order_time)
+            orders['endby'] = orders['endby'].map(order_time)
+            if 'profile_kw' in orders:
+                orders['profile_kw'] = orders['profile_kw'].map(
+                    profiles.encode_profile)
+            book = pandas.concat([book, orders])
+        changed[name] = book
+    return uncontr, changed
+
+
+def solve_cycle(job, engine):
+    laps = metrics.Laps(engine)
+    uncontr, books = snapshot(laps)
+    forecast_changes.use(uncontr['uncontr'])
+    first_t = uncontr.iloc[0].name
+    opt_uncontr, opt_bbook, opt_sbook, opt_dbook = problem_inputs(
+        uncontr, books)
+    keys = {'battery': list(books['bbook'].index),
+            'shapeable': list(books['sbook'].index),
+            'deferrable': list(books['dbook'].index)}
+
+    # Previous solution moved to the new horizon as a MIP start
+    # (order ids are positions in the books, match them by order time)
+    initial = None
+    if last_solution:
+        steps = int(round((first_t - last_solution['first_t'])
+                          .total_seconds() / (60 * 60 / TIMESTEP)))
+        ids = {}
+        for key, kind in RESULT_KINDS.items():
+            new = dict((k, i) for i, k in enumerate(keys[kind]))
+            ids[key] = dict((i, new[k]) for i, k in enumerate(
+                last_solution['keys'][kind]) if k in new)
+        initial = v4norminf.shift_solution(
+            last_solution['result'], steps, ids)
+
+    # Coarser steps further in the horizon (see timegrid)
+    grid_uncontr = opt_uncontr
+    if grid is not None:
+        steps = timegrid.time_grid(len(opt_uncontr), *grid)
+        grid_uncontr = timegrid.coarsen(opt_uncontr, steps)
+        if initial is not None:
+            initial = timegrid.coarsen_solution(initial, steps)
+
+    def on_timestep(result):
+        # Schedules back on the 5min timestep
+        if grid is None:
+            return result
+        return timegrid.expand_results(
+            result, opt_uncontr, opt_bbook, opt_sbook, opt_dbook,
+            1/TIMESTEP, steps)
+
+    laps.lap('normalization')
+
+    # Run the optimization (in the live solve worker for jobs)
     tic = datetime.now()
-    result = maximize_self_consumption(
-            opt_uncontr,
-            opt_bbook,
-            opt_sbook,
-            opt_dbook,
-            timestep=1/TIMESTEP,
-            solver='glpk',
-            verbose=False, timelimit=60)
-    logger.info('GLPK time elapsed (hh:mm:ss.ms) {}'.format(
-        datetime.now() - tic))
-
-    # Save results back to influxDB (and remove previous schedule)
-    total = uncontr.copy()
-    total.rename(columns={'uncontr': 'contr'}, inplace=True)
-    total['contr'] += result['demand_controllable']
-    client.write_points(total, 'contr')
-
-    client.drop_measurement('bschedule')
-    if result['batteryin'] is not None:
-        bschedule = (result['batteryin'] - result['batteryout']).copy()
-        bschedule['index'] = uncontr_t
-        bschedule.set_index('index', drop=True, inplace=True)
-        bschedule.rename_axis(None, inplace=True)
-        client.write_points(bschedule, 'bschedule')
-
-    client.drop_measurement('sschedule')
-    if result['demandshape'] is not None:
-        sschedule = result['demandshape'].copy()
-        sschedule['index'] = uncontr_t
-        sschedule.set_index('index', drop=True, inplace=True)
-        sschedule.rename_axis(None, inplace=True)
-        client.write_points(sschedule, 'sschedule')
-
-    client.drop_measurement('dschedule')
-    if result['demanddeferr'] is not None:
-        dschedule = result['demanddeferr'].copy()
-        dschedule['index'] = uncontr_t
-        dschedule.set_index('index', drop=True, inplace=True)
-        dschedule.rename_axis(None, inplace=True)
-        client.write_points(dschedule, 'dschedule')
-
-    # Close DB connection
-    client.close()
+    args = (grid_uncontr, opt_bbook, opt_sbook, opt_dbook)
+    kwargs = dict(timestep=1/TIMESTEP, solver=solver,
+                  verbose=False, timelimit=60, initial=initial,
+                  mipgap=mipgap)
+    key = solve_key(engine, args, kwargs)
+    result = cached(key)
+    if result is None:
+        # Incumbents published while the solver runs (see anytime)
+        publication = None
+        if anytime_improvement is not None and engine in ANYTIME_ENGINES \
+                and solver == 'highs':
+            updates = queue.Queue() if job is None else jobs.queue()
+            publication = anytime.Publication(
+                updates, lambda incumbent: publish_schedules(
+                    on_timestep(incumbent), uncontr),
+                anytime_improvement, progress=None if job is None else (
+                    lambda incumbents: jobs.update(
+                        job, incumbents=incumbents)))
+            publication.start()
+            kwargs['incumbent'] = anytime.Reporter(updates)
+        try:
+            if job is None:
+                result = ENGINES[engine](*args, **kwargs)
+            elif engine in POOLED_ENGINES:
+                result = pooled_solve(job, engine, args, kwargs)
+            else:
+                result = jobs.run(job, ENGINES[engine], *args, live=True,
+                                  **kwargs)
+        finally:
+            if publication is not None:
+                publication.stop()
+        if cacheable(result):
+            solve_cache.put(key, result)
+        # Engine call (including the worker round trip), its build,
+        # solve and extraction phases and the solver statistics
+        laps.lap('engine')
+        metrics.observe_results(result, solver, engine)
+    else:
+        laps.lap('cache')
+    if grid is not None:
+        result = on_timestep(result)
+        laps.lap('expansion')
+    logger.info('{} time elapsed ({}) (hh:mm:ss.ms) {}'.format(
+        solver.upper(), engine, datetime.now() - tic))
+
+    # Publish the results as a new version of the schedules, the current
+    # version stays when there is no solution (e.g. infeasible orders)
+    version = publish_schedules(result, uncontr)
+    laps.lap('writes')
+    if version is None:
+        return {'engine': engine,
+                'version': None,
+                'status': result.get('solver', {}).get('status')}
+    last_solution.update(first_t=first_t, result=result, keys=keys)
+
+    return {'engine': engine,
+            'version': version,
+            'peakhigh': float(result['peakhigh']),
+            'peaklow': float(result['peaklow']),
+            'total_community_import': float(
+                result['total_community_import'])}
+
+
+def publish_schedules(result, uncontr):
+    """
+    Publish results as a new version of the schedules (one batched
+    write, then the current version pointer is moved), None without a
+    solution to publish (see Results.has_solution)
+    """
+    if not result.has_solution():
+        status = result.get('solver', {}).get('status', 'other')
+        logger.warning('No solution ({}), schedules not published'.format(
+            status))
+        metrics.unpublished.inc(status=status)
+        return None
+    uncontr_t = uncontr.index
+    outputs = [('contr', uncontr_t, uncontr['uncontr'].values +
+                result['demand_controllable'], ['contr'])]
+    if result.array('batteryin') is not None:
+        powerin, ids = result.array('batteryin')
+        powerout, ids = result.array('batteryout')
+        outputs.append(('bschedule', uncontr_t, powerin - powerout, ids))
+    if result.array('demandshape') is not None:
+        values, ids = result.array('demandshape')
+        outputs.append(('sschedule', uncontr_t, values, ids))
+    if result.array('demanddeferr') is not None:
+        values, ids = result.array('demanddeferr')
+        outputs.append(('dschedule', uncontr_t, values, ids))
+    return publisher.publish(outputs)
+
+
+# Single background worker running optimization() as jobs (the other
+# endpoints ask for DEFAULT_ENGINE), a solve still running at shutdown
+# is cancelled after shutdown_timeout seconds
+shutdown_timeout = 10
+jobs = JobManager()
+coordinator = SolveCoordinator(optimization, jobs=jobs,
+                               engine=DEFAULT_ENGINE)
@@ -0,0 +1,208 @@
+"""
+Prometheus metrics of the solve cycles (text exposition format).
+
+Each optimization is split into phases (queries, normalization, model
+build, solve, extraction and writes) whose durations are histograms,
+the statistics reported by the solver (status, MIP gap, nodes, time
+limit) are recorded next to them. Everything is served by /metrics.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from results import normalize_status
+import threading
+import math
+
+# Seconds, from a query to a solve hitting its time limit
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1, 2.5, 5, 10, 30, 60, 120, 300)
+GAP_BUCKETS = (0, 1e-4, 1e-3, 0.01, 0.05, 0.1, 0.25, 0.5, 1)
+NODE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for n, v in zip(names, values)) + '}'
+
+
+def _number(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """Values of a metric per label values"""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            for key in sorted(self.values):
+                lines += self._samples(key, self.values[key])
+        return lines
+
+    def _samples(self, key, value):
+        return ['{}{} {}'.format(self.name, _labels(self.labelnames, key),
+                                 _number(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=TIME_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self.values.get(
+                key, ([0] * len(self.buckets), 0.0))
+            counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value)
+
+    def _samples(self, key, value):
+        counts, total = value
+        names = self.labelnames + ('le',)
+        return (['{}_bucket{} {}'.format(
+                    self.name, _labels(names, key + (_number(b),)), c)
+                 for b, c in zip(self.buckets, counts)] +
+                ['{}_sum{} {}'.format(self.name,
+                                      _labels(self.labelnames, key),
+                                      _number(total)),
+                 '{}_count{} {}'.format(self.name,
+                                        _labels(self.labelnames, key),
+                                        counts[-1])])
+
+
+class Registry(object):
+    """Metrics served together"""
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Text exposition format of every metric"""
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+phase_seconds = registry.register(Histogram(
+    'csc_optimization_phase_seconds',
+    'Duration of each phase of a solve cycle', ['phase', 'engine']))
+cycles = registry.register(Counter(
+    'csc_optimization_cycles_total', 'Solve cycles by outcome',
+    ['engine', 'outcome']))
+solver_status = registry.register(Counter(
+    'csc_solver_status_total', 'Solves by solver reported status',
+    ['solver', 'status']))
+solver_timelimit = registry.register(Counter(
+    'csc_solver_timelimit_total', 'Solves stopped by the time limit',
+    ['solver']))
+solver_gap = registry.register(Histogram(
+    'csc_solver_mip_gap', 'Relative MIP gap of the returned schedule',
+    ['solver'], GAP_BUCKETS))
+solver_nodes = registry.register(Histogram(
+    'csc_solver_nodes', 'Branch and bound nodes explored', ['solver'],
+    NODE_BUCKETS))
+incumbents = registry.register(Counter(
+    'csc_solver_incumbents_total',
+    'Improving solutions reported while solving', ['published']))
+unpublished = registry.register(Counter(
+    'csc_schedules_unpublished_total',
+    'Schedules not published for lack of a solution', ['status']))
+solve_cache = registry.register(Counter(
+    'csc_solve_cache_total', 'Solve cache lookups by result', ['result']))
+forecast_updates = registry.register(Counter(
+    'csc_forecast_updates_total',
+    'Forecast updates by re-optimization decision', ['decision']))
+last_solve = registry.register(Gauge(
+    'csc_solver_last', 'Statistics of the last solve', ['statistic']))
+
+
+class Laps(object):
+    """
+    Consecutive phases of a solve cycle, lap(name) records the time
+    since the previous lap (or the start) as the phase name.
+    """
+    def __init__(self, engine=''):
+        self.engine = engine
+        self.tic = datetime.now()
+
+    def lap(self, name):
+        toc = datetime.now()
+        phase_seconds.observe((toc - self.tic).total_seconds(),
+                              phase=name, engine=self.engine)
+        self.tic = toc
+
+
+@contextmanager
+def phase(name, engine=''):
+    """Time the enclosed block as one phase of a solve cycle"""
+    tic = datetime.now()
+    try:
+        yield
+    finally:
+        phase_seconds.observe((datetime.now() - tic).total_seconds(),
+                              phase=name, engine=engine)
+
+
+def observe_results(results, solver, engine=''):
+    """
+    Record the engine timings (build, solve and extraction) and the
+    solver statistics of maximize_self_consumption results (statuses
+    of every engine are counted under results.STATUS).
+    """
+    for name, seconds in results.get('timings', {}).items():
+        phase_seconds.observe(seconds, phase=name, engine=engine)
+    statistics = results.get('solver') or {}
+    solver_status.inc(solver=solver, status=normalize_status(
+        statistics.get('status', 'unknown')))
+    if statistics.get('timelimit'):
+        solver_timelimit.inc(solver=solver)
+    for key, histogram in [('mipgap', solver_gap), ('nodes', solver_nodes)]:
+        value = statistics.get(key)
+        if value is not None and math.isfinite(value):
+            histogram.observe(value, solver=solver)
+            last_solve.set(value, statistic=key)
+    last_solve.set(int(bool(statistics.get('timelimit'))),
+                   statistic='timelimit')
@@ -0,0 +1,190 @@
+"""
+In-memory order books with write-through persistence.
+
+Each book mirrors one InfluxDB measurement (bbook, sbook or dbook):
+orders are keyed by their timestamp and written fields are merged into
+existing orders exactly like InfluxDB merges points. Orders are indexed
+by startby, so that the orders of an optimization window are found
+without querying the database.
+"""
+from bisect import bisect_left, bisect_right
+from publication import escape
+import threading
+import logging
+import profiles
+import pandas
+import numpy
+
+logger = logging.getLogger("api")
+
+
+def _key(t):
+    """Order key: UTC timestamp (naive times are UTC for InfluxDB)"""
+    t = pandas.Timestamp(t)
+    return t.tz_localize('UTC') if t.tzinfo is None else t.tz_convert('UTC')
+
+
+def normalize(book, first_t, timestep=5):
+    """
+    Order book as an input of maximize_self_consumption: startby and
+    endby in timesteps (minutes) from first_t, positions in the book as
+    ids, the order times (milliseconds since epoch) as `key` and decoded
+    power profiles (views of a single array).
+    """
+    if len(book) == 0:
+        # No orders at the moment
+        return pandas.DataFrame()
+    opt = book.copy()
+    for column in ['startby', 'endby']:
+        opt[column] = ((opt[column] - first_t.timestamp() * 1000) /
+                       (timestep * 60 * 1000))
+    opt['key'] = ((pandas.DatetimeIndex(opt.index) - pandas.Timestamp(
+        0, tz=opt.index.tz)) // pandas.Timedelta(milliseconds=1)).values
+    opt.index = pandas.RangeIndex(len(opt), name='id')
+    if 'profile_kw' in opt:
+        opt['profile_kw'] = profiles.profile_column(opt['profile_kw'],
+                                                    opt.index)
+    return opt
+
+
+class OrderBook(object):
+    """Orders of one measurement, indexed by startby (milliseconds)"""
+    def __init__(self, storage, measurement):
+        self.storage = storage
+        self.measurement = measurement
+        self.orders = {}
+        self.loaded = False
+        self._starts = []
+        self._keys = []
+        self._next_key = None
+        self._lock = threading.Lock()
+
+    def load(self, since=None):
+        """
+        (Re)load the orders from the database.
+        Inputs:
+            - since (float): only orders with startby >= since (ms)
+        """
+        query = 'select * from {}'.format(self.measurement)
+        if since is not None:
+            query += ' WHERE startby >= {}'.format(int(since))
+        book = self.storage.query(query).get(self.measurement)
+        with self._lock:
+            self.orders, self._starts, self._keys = {}, [], []
+            self._merge(book)
+            self.loaded = True
+        logger.info('Order book {}: {} order(s) loaded'.format(
+            self.measurement, len(self.orders)))
+
+    def write(self, df):
+        """Write orders to the database, then to the book"""
+        self.storage.write_points(df, self.measurement)
+        with self._lock:
+            self._merge(df)
+
+    def new_keys(self, n):
+        """
+        n distinct order times (one millisecond apart) from now, after
+        every time handed out before
+        """
+        with self._lock:
+            start = pandas.Timestamp.now().floor('ms')
+            if self._next_key is not None:
+                start = max(start, self._next_key)
+            keys = pandas.date_range(start, periods=n, freq='ms')
+            if n > 0:
+                self._next_key = keys[-1] + pandas.Timedelta(milliseconds=1)
+        return keys
+
+    def _merge(self, df):
+        if df is None:
+            return
+        for t, row in zip(df.index, df.to_dict('records')):
+            key = _key(t)
+            fields = dict((k, v) for k, v in row.items()
+                          if not (isinstance(v, float) and v != v))
+            if key not in self.orders and 'startby' not in fields:
+                # Removal of an order which is not in the book anymore
+                continue
+            order = self.orders.setdefault(key, {})
+            if 'startby' in fields and 'startby' in order:
+                self._unindex(key, order['startby'])
+            order.update(fields)
+            if 'startby' in fields:
+                i = bisect_right(self._starts, order['startby'])
+                self._starts.insert(i, order['startby'])
+                self._keys.insert(i, key)
+
+    def _unindex(self, key, startby):
+        i = bisect_left(self._starts, startby)
+        while self._keys[i] != key:
+            i += 1
+        del self._starts[i]
+        del self._keys[i]
+
+    def active(self, start, end):
+        """
+        Orders with start <= startby and endby <= end (ms since epoch)
+        as the DataFrame a database query would return.
+        """
+        with self._lock:
+            i = bisect_left(self._starts, start)
+            j = bisect_right(self._starts, end)
+            keys = sorted(k for k in self._keys[i:j]
+                          if self.orders[k].get('endby', end + 1) <= end)
+            rows = [self.orders[k] for k in keys]
+        return pandas.DataFrame(rows, index=pandas.DatetimeIndex(keys))
+
+    def prune(self, before):
+        """Forget the orders with startby < before (ms since epoch)"""
+        with self._lock:
+            i = bisect_left(self._starts, before)
+            for key in self._keys[:i]:
+                del self.orders[key]
+            del self._starts[:i]
+            del self._keys[:i]
+        return i
+
+
+def encode_orders(measurement, df):
+    """
+    Line protocol of orders: float, integer (duration) and string
+    (profile_kw) fields as written by DataFrameClient, NaN are skipped.
+    """
+    index = pandas.DatetimeIndex(df.index)
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    fields = []
+    for column in df.columns:
+        values = df[column]
+        if pandas.api.types.is_integer_dtype(values):
+            text = values.astype(str) + 'i'
+        elif pandas.api.types.is_numeric_dtype(values):
+            text = values.map(repr).where(values.notna(), '')
+        else:
+            text = '"' + values.astype(str).str.replace(
+                '\\', '\\\\', regex=False).str.replace(
+                    '"', '\\"', regex=False) + '"'
+        fields.append(numpy.where(text.values == '', '',
+                                  escape(column) + '=' + text.values))
+    stamps = index.values.astype('datetime64[ns]').astype(numpy.int64)
+    prefix = escape(measurement, ', ') + ' '
+    return [prefix + ','.join(filter(None, row)) + ' ' + str(stamp)
+            for row, stamp in zip(zip(*fields), stamps.tolist())]
+
+
+def write_books(storage, frames):
+    """
+    Write the orders of several books in one request, then merge them
+    into the books.
+    Inputs:
+        - storage (Storage)
+        - frames (list): (OrderBook, DataFrame of orders) pairs
+    """
+    lines = []
+    for book, df in frames:
+        lines += encode_orders(book.measurement, df)
+    storage.write_lines(lines)
+    for book, df in frames:
+        with book._lock:
+            book._merge(df)
@@ -0,0 +1,349 @@
+"""
+Long-lived version of the v4matrix model.
+
+Every order owns a block (its variables and rows) kept across calls,
+keyed by its order time. A block only covers the steps of the order
+(its time window, plus the step before it for a battery and the steps
+its profile can reach for a deferrable load), with times relative to
+its first step, so the same order keeps its block when the horizon
+moves forward or other orders are pruned. When the order books change,
+only the orders that were added, modified or removed are rebuilt and
+the blocks are stacked again under the community rows. The Pyomo kernel
+objects of the blocks are only created (once) for the solvers which are
+not called in-process.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from scipy import sparse
+from v4norminf import solve_model, solver_statistics, step_lengths
+import pyomo.kernel as pmo
+import v4matrix
+import threading
+import logging
+import numpy
+
+logger = logging.getLogger("api")
+
+BUILDERS = OrderedDict([('shapeable', v4matrix.shapeable_block),
+                        ('battery', v4matrix.battery_block),
+                        ('deferrable', v4matrix.deferrable_block)])
+
+# Columns of the normalized order books which are not order contents
+TIMES = ['startby', 'endby', 'key']
+
+
+def _value(v):
+    """Hashable value of an order book field"""
+    return tuple(v) if isinstance(v, (list, tuple, numpy.ndarray)) else v
+
+
+def order_steps(kind, steps, order):
+    """
+    Steps of the horizon a block of the order has to cover so that it is
+    the same as on the whole horizon.
+    Inputs:
+        - kind (str): shapeable, battery or deferrable
+        - steps (array): base timesteps of each step of the horizon
+        - order (dict): normalized order (startby and endby in base steps)
+    Outputs:
+        - first, last (int): steps of the horizon
+    """
+    T = len(steps)
+    first = numpy.cumsum(steps) - steps
+    N = int(numpy.sum(steps))
+    start = int(numpy.ceil(order['startby']))
+    end = int(numpy.floor(order['endby']))
+    if start > end or start > N - 1 or end < 0:
+        return 0, T - 1
+
+    def step(base):
+        return int(numpy.searchsorted(first, base, side='right')) - 1
+
+    lo, hi = step(max(start, 0)), step(min(end, N - 1))
+    if kind == 'battery' and lo > 0:
+        # The energy is initial_kwh in the step before the window
+        lo -= 1
+    if kind == 'deferrable':
+        profile = numpy.asarray(order['profile_kw'][:int(order['duration'])])
+        nonzero = numpy.flatnonzero(profile)
+        if len(nonzero) == 0 or nonzero[0] > 0:
+            # Leading zeros: starts before the window and at the end of
+            # the horizon are feasible
+            return 0, T - 1
+        hi = step(min(end + len(profile) - 1, N - 1))
+    return lo, hi
+
+
+class PersistentModel(object):
+    """
+    Order blocks updated asset by asset.
+    Assets are identified by (kind, order time).
+    """
+    def __init__(self):
+        self.horizon = None
+        self.timestep = None
+        self.steps = None
+        self.uncontrollable = None
+        self.assets = OrderedDict()
+        self.model = None
+        self._linked = False
+        self._lock = threading.Lock()
+
+    def reset(self, timestep):
+        """Drop every asset and start over with a new timestep"""
+        self.timestep = timestep
+        self.assets = OrderedDict()
+        self.model = None
+
+    def set_uncontrollable(self, uncontrollable, timestep):
+        """Update the uncontrolled demand and the horizon"""
+        if timestep != self.timestep:
+            self.reset(timestep)
+        horizon = uncontrollable.index.tolist()
+        steps = step_lengths(uncontrollable)
+        if horizon != self.horizon or not numpy.array_equal(steps,
+                                                            self.steps):
+            self.horizon = horizon
+            self.steps = steps
+            self.model = None
+        self.uncontrollable = numpy.asarray(uncontrollable.p.values,
+                                            dtype=float)
+
+    def sync(self, kind, book):
+        """
+        Add, replace or remove the orders of one kind so that the model
+        matches book. Returns the number of changed orders.
+        """
+        orders = [] if len(book) == 0 else book.to_dict('records')
+        current = set()
+        changes = 0
+        first = numpy.cumsum(self.steps) - self.steps
+        for index, order in zip(book.index, orders):
+            key = (kind, order.get('key', index))
+            current.add(key)
+            lo, hi = order_steps(kind, self.steps, order)
+
+            # Times relative to the first step of the block
+            local = dict(order, startby=int(numpy.ceil(order['startby'])) -
+                         first[lo], endby=int(numpy.floor(order['endby'])) -
+                         first[lo])
+            signature = tuple(_value(v) for k, v in sorted(local.items())
+                              if k != 'key') + (
+                                  tuple(self.steps[lo:hi + 1]),)
+            asset = self.assets.get(key)
+            if asset is None or asset['signature'] != signature:
+                frame = book.loc[[index]].drop(columns=TIMES,
+                                               errors='ignore')
+                frame['startby'] = local['startby']
+                frame['endby'] = local['endby']
+                steps = self.steps[lo:hi + 1]
+                asset = {'signature': signature, 'kernel': None,
+                         'block': BUILDERS[kind](list(range(len(steps))),
+                                                 frame, self.timestep, steps)}
+                self.assets[key] = asset
+                self._linked = False
+                changes += 1
+            # Position in the books and in the horizon of this solve
+            if asset['block'].ids != [index] or asset['block'].start != lo:
+                self._linked = False
+            asset['block'].ids = [index]
+            asset['block'].start = lo
+        for key in [k for k in self.assets if k[0] == kind]:
+            if key not in current:
+                del self.assets[key]
+                self._linked = False
+                changes += 1
+        return changes
+
+    def kernel(self):
+        """
+        Pyomo kernel model of the blocks (only the missing kernel objects
+        are created) for the solvers which are not called in-process
+        """
+        T = len(self.horizon)
+        if self.model is None:
+            m = pmo.block()
+            m.demand_controllable = pmo.variable_list(
+                pmo.variable() for t in range(T))
+            # r21, r22: peaks bounds
+            m.peakhigh = pmo.variable(lb=0)
+            m.peaklow = pmo.variable(ub=0)
+            m.assets = pmo.block_dict()
+
+            # r19, r20 over [demand_controllable, peakhigh, peaklow]
+            t = numpy.arange(T)
+            A = sparse.coo_matrix(
+                (numpy.concatenate([numpy.ones(T), -numpy.ones(T),
+                                    numpy.ones(T), -numpy.ones(T)]),
+                 (numpy.concatenate([t, t, T + t, T + t]),
+                  numpy.concatenate([t, numpy.full(T, T),
+                                     numpy.full(T, T + 1), t]))),
+                shape=(2 * T, T + 2))
+            m.peak = pmo.matrix_constraint(
+                A.tocsr(), lb=numpy.full(2 * T, -numpy.inf),
+                ub=numpy.zeros(2 * T),
+                x=list(m.demand_controllable) + [m.peakhigh, m.peaklow])
+            m.objective = pmo.objective(m.peakhigh - m.peaklow,
+                                        sense=pmo.minimize)
+            self.model = m
+            self._linked = False
+        m = self.model
+
+        for key in [k for k in m.assets if k not in self.assets]:
+            del m.assets[key]
+        for key, asset in self.assets.items():
+            if asset['kernel'] is None or key not in m.assets or \
+                    m.assets[key] is not asset['kernel']:
+                block = asset['block']
+                arrays = block.arrays()
+                sub = pmo.block()
+                sub.x = v4matrix.kernel_variables(
+                    arrays['col_lb'], arrays['col_ub'], arrays['integer'])
+                v4matrix.kernel_constraints(
+                    sub, block.matrix(), arrays['row_lb'], arrays['row_ub'],
+                    list(sub.x))
+                if key in m.assets:
+                    del m.assets[key]
+                m.assets[key] = asset['kernel'] = sub
+                self._linked = False
+        m.peak.ub = numpy.concatenate([-self.uncontrollable,
+                                       self.uncontrollable])
+        if not self._linked:
+            self.link()
+        return m
+
+    def link(self):
+        """(Re)build r15: demand_controllable[t] == sum(assets[t])"""
+        m = self.model
+        T = len(self.horizon)
+        x = list(m.demand_controllable)
+        rows, cols, vals = [numpy.arange(T)], [numpy.arange(T)], [
+            numpy.ones(T)]
+        for key, asset in self.assets.items():
+            arrays = asset['block'].arrays()
+            rows.append(arrays['link_t'] + asset['block'].start)
+            cols.append(arrays['link_cols'] + len(x))
+            vals.append(-arrays['link_vals'])
+            x.extend(asset['kernel'].x)
+        A = sparse.coo_matrix(
+            (numpy.concatenate(vals),
+             (numpy.concatenate(rows), numpy.concatenate(cols))),
+            shape=(T, len(x))).tocsr()
+        if hasattr(m, 'balance'):
+            del m.balance
+        m.balance = pmo.matrix_constraint(A, rhs=numpy.zeros(T), x=x)
+        self._linked = True
+
+    def layout(self):
+        """Layout of the kernel model as a v4matrix problem"""
+        offset = len(self.horizon) + 2
+        layout = OrderedDict()
+        for asset in self.assets.values():
+            block = asset['block']
+            for name, (start, shape) in block.variables.items():
+                layout.setdefault(name, []).append(
+                    (block.ids, offset + start, shape, block.start))
+            offset += block.ncols
+        return layout
+
+    def start(self, initial):
+        """Set a previous solution as initial values of the assets"""
+        for asset in self.assets.values():
+            block = asset['block']
+            layout = dict((name, [(block.ids, start, shape, block.start)])
+                          for name, (start, shape) in block.variables.items())
+            v4matrix.kernel_start(
+                asset['kernel'].x,
+                v4matrix.initial_values(layout, self.horizon, initial,
+                                        block.ncols),
+                block.arrays()['integer'])
+
+    def solve(self, solver='gurobi', verbose=False, solver_path=None,
+              timelimit=5*60, initial=None, mipgap=None, incumbent=None):
+        """
+        Solve the current model and return the v4norminf results
+        (incumbents are reported by the in-process solvers only)
+        """
+        tic = datetime.now()
+        blocks = [asset['block'] for asset in self.assets.values()]
+        if solver in v4matrix.IN_PROCESS:
+            # Stack the asset blocks, no kernel model is needed
+            problem = v4matrix.assemble(self.horizon, self.uncontrollable,
+                                        blocks, self.timestep, self.steps)
+            timings = {'build': (datetime.now() - tic).total_seconds()}
+            tic = datetime.now()
+            x = v4matrix.solve_problem(
+                problem, solver=solver, verbose=verbose,
+                timelimit=timelimit, initial=initial, mipgap=mipgap,
+                incumbent=v4matrix.incumbent_results(problem, incumbent))
+            timings['solve'] = (datetime.now() - tic).total_seconds()
+            tic = datetime.now()
+            results = v4matrix.extract_results(problem, x)
+            timings['extract'] = (datetime.now() - tic).total_seconds()
+            results['timings'] = timings
+            return results
+
+        m = self.kernel()
+        if initial is not None:
+            self.start(initial)
+        timings = {'build': (datetime.now() - tic).total_seconds()}
+        tic = datetime.now()
+        results = solve_model(m, solver=solver, verbose=verbose,
+                              solver_path=solver_path, timelimit=timelimit,
+                              warmstart=initial is not None, mipgap=mipgap)
+        timings['solve'] = (datetime.now() - tic).total_seconds()
+        tic = datetime.now()
+        if verbose:
+            print(results)
+
+        # Lay the solution out as a v4matrix problem
+        x = [v4matrix.kernel_values(m.demand_controllable),
+             v4matrix.kernel_values([m.peakhigh, m.peaklow])]
+        x += [v4matrix.kernel_values(asset['kernel'].x)
+              for asset in self.assets.values()]
+        problem = v4matrix.MatrixProblem(
+            self.horizon, self.uncontrollable, self.timestep * self.steps,
+            None, None,
+            None, None, None, None, None, self.layout())
+        problem.statistics = solver_statistics(results)
+        results = v4matrix.extract_results(problem, numpy.concatenate(x))
+        timings['extract'] = (datetime.now() - tic).total_seconds()
+        results['timings'] = timings
+        return results
+
+    def maximize_self_consumption(self, uncontrollable, dfbatteries,
+                                  dfshapeables, dfdeferrables,
+                                  timestep, solver='gurobi',
+                                  verbose=False, solver_path=None,
+                                  timelimit=5*60, initial=None, mipgap=None,
+                                  incumbent=None):
+        """
+        Same interface as v4matrix.maximize_self_consumption (the order
+        books have a `key` column, see orderbook.normalize), only the
+        orders that changed since the previous call are rebuilt.
+        """
+        with self._lock:
+            tic = datetime.now()
+            self.set_uncontrollable(uncontrollable, timestep)
+            changes = (self.sync('shapeable', dfshapeables) +
+                       self.sync('battery', dfbatteries) +
+                       self.sync('deferrable', dfdeferrables))
+            logger.info('Persistent model: {} order(s) rebuilt, {} in total'
+                        .format(changes, len(self.assets)))
+            sync = (datetime.now() - tic).total_seconds()
+            results = self.solve(solver=solver, verbose=verbose,
+                                 solver_path=solver_path,
+                                 timelimit=timelimit, initial=initial,
+                                 mipgap=mipgap, incumbent=incumbent)
+            # Rebuilding the changed orders is part of the build
+            results['timings']['build'] += sync
+            return results
+
+
+# Model of this process, the live solve worker keeps it between jobs
+_model = PersistentModel()
+
+
+def maximize_self_consumption(*args, **kwargs):
+    """PersistentModel.maximize_self_consumption on the process model"""
+    return _model.maximize_self_consumption(*args, **kwargs)
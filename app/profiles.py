@@ -0,0 +1,62 @@
+"""
+Compact encoding of the deferrable power profiles.
+
+A profile is stored in InfluxDB as one string field holding the base64
+of its little-endian float64 values (instead of a stringified list) and
+all the profiles of a book are decoded at once into a single array.
+Stringified lists and float32 profiles written before are still decoded.
+"""
+import base64
+import numpy
+import pandas
+
+PREFIX = 'f8:'
+
+# Profiles written as float32 before
+PREFIX32 = 'f4:'
+
+
+def encode_profile(profile):
+    """Compact string of a power profile (list, array or string)"""
+    if isinstance(profile, str):
+        if profile.startswith(PREFIX):
+            return profile
+        profile = numpy.frombuffer(_raw(profile), dtype='<f8')
+    return PREFIX + base64.b64encode(
+        numpy.asarray(profile, dtype='<f8').tobytes()).decode('ascii')
+
+
+def _raw(profile):
+    """float64 bytes of a stored profile"""
+    if profile.startswith(PREFIX):
+        return base64.b64decode(profile[len(PREFIX):])
+    if profile.startswith(PREFIX32):
+        return numpy.frombuffer(base64.b64decode(profile[len(PREFIX32):]),
+                                dtype='<f4').astype('<f8').tobytes()
+    return numpy.fromstring(profile.strip('[] '), sep=',',
+                            dtype='<f8').tobytes()
+
+
+def decode_profiles(profiles):
+    """
+    Decode stored profiles in bulk.
+    Inputs:
+        - profiles (iterable): stored profile_kw strings
+    Outputs:
+        - values (array): every profile concatenated (float)
+        - offsets (array): profile i is values[offsets[i]:offsets[i + 1]]
+    """
+    raw = [_raw(p) for p in profiles]
+    offsets = numpy.zeros(len(raw) + 1, dtype=int)
+    numpy.cumsum([len(r) // 8 for r in raw], out=offsets[1:])
+    values = numpy.frombuffer(b''.join(raw), dtype='<f8').astype(float)
+    return values, offsets
+
+
+def profile_column(profiles, index=None):
+    """Decoded profiles as a Series of views of one array"""
+    values, offsets = decode_profiles(profiles)
+    column = pandas.Series([None] * (len(offsets) - 1), index=index,
+                           dtype=object)
+    column[:] = [values[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+    return column
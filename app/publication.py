@@ -0,0 +1,156 @@
+"""
+Versioned publication of the optimization outputs.
+
+All the outputs of a solve are written in one line protocol request
+under a `version` tag, then the `schedule_version` pointer is moved to
+that version. Readers follow the pointer, so they never see a dropped or
+half written schedule. Older versions are deleted by a background
+thread, except the points of the HISTORY measurements before the first
+time of the kept versions (what was planned at the time). Points
+without a version tag are never deleted.
+"""
+from datetime import datetime
+import threading
+import logging
+import time
+import numpy
+
+logger = logging.getLogger("api")
+
+# Measurement holding the current version (field `version`)
+POINTER = 'schedule_version'
+
+# Measurements whose older versions are only deleted over the time range
+# replaced by the kept versions
+HISTORY = ['contr']
+
+
+def escape(text, special=',= '):
+    """Escape measurement names, tag and field keys/values"""
+    text = str(text).replace('\\', '\\\\')
+    for c in special:
+        text = text.replace(c, '\\' + c)
+    return text
+
+
+def encode_lines(measurement, index, values, fields, tags=None):
+    """
+    Line protocol of a (time x field) array of floats.
+    Inputs:
+        - measurement (str): measurement name
+        - index (DatetimeIndex): timestamps (T,)
+        - values (array): (T, n) float values, NaN are skipped
+        - fields (list): field keys (n,)
+        - tags (dict): tags of every point
+    Outputs:
+        - lines (list): one str per timestamp with a value
+    """
+    prefix = escape(measurement, ', ') + ''.join(
+        ',{}={}'.format(escape(k), escape(v))
+        for k, v in sorted((tags or {}).items())) + ' '
+    values = numpy.asarray(values, dtype=float).reshape(len(index), -1)
+    keys = numpy.array([escape(f) + '=' for f in fields])
+    pairs = numpy.char.add(keys[None, :], values.astype(str))
+    pairs[~numpy.isfinite(values)] = ''
+    stamps = index.values.astype('datetime64[ns]').astype(numpy.int64)
+    return [prefix + ','.join(filter(None, row)) + ' ' + str(stamp)
+            for row, stamp in zip(pairs.tolist(), stamps.tolist())
+            if any(row)]
+
+
+class Publisher(object):
+    """Publish versions of the outputs through a Storage"""
+    def __init__(self, storage, keep=2):
+        self.storage = storage
+        self.keep = keep
+        self.versions = []
+        self.starts = {}
+        self.measurements = set()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._garbage = False
+
+    def current(self):
+        """Current version (from the pointer after a restart) or None"""
+        with self._condition:
+            if self.versions:
+                return self.versions[-1]
+        try:
+            pointer = self.storage.query(
+                'select last(version) from {}'.format(POINTER))[POINTER]
+            return str(pointer['last'].iloc[-1])
+        except Exception:
+            return None
+
+    def publish(self, outputs):
+        """
+        Write a new version and make it current.
+        Inputs:
+            - outputs (list): (measurement, index, values, fields)
+        Outputs:
+            - version (str)
+        """
+        version = str(int(time.time() * 1000))
+        lines = []
+        for measurement, index, values, fields in outputs:
+            lines += encode_lines(measurement, index, values, fields,
+                                  {'version': version})
+        self.storage.write_lines(lines)
+
+        # Flip the pointer once everything is written
+        previous = self.current()
+        self.storage.write_lines(['{} version="{}" {}'.format(
+            POINTER, version, int(time.time() * 1e9))])
+        with self._condition:
+            if not self.versions and previous is not None:
+                self.versions.append(previous)
+            self.versions = (self.versions + [version])[-self.keep:]
+            self.starts[version] = min(o[1][0] for o in outputs
+                                       if len(o[1]) > 0)
+            self.starts = dict((v, t) for v, t in self.starts.items()
+                               if v in self.versions)
+            self.measurements.update(o[0] for o in outputs)
+            self._garbage = True
+            self._condition.notify()
+        self.start()
+        return version
+
+    def start(self):
+        """Start the garbage collection thread (once)"""
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._collect, name='schedule-gc', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        while True:
+            with self._condition:
+                while not self._garbage:
+                    self._condition.wait()
+                self._garbage = False
+                versions = list(self.versions)
+                measurements = sorted(self.measurements)
+                # Start of the kept versions (the previous version of a
+                # restart is unknown, the newer ones start later)
+                replaced = min(self.starts.values())
+
+            # Everything but the kept versions (points without a version
+            # tag are left alone), the history only from where the kept
+            # versions replace it, and old pointers
+            tic = datetime.now()
+            condition = '"version" =~ /./ AND ' + ' AND '.join(
+                '"version" != \'{}\''.format(v) for v in versions)
+            try:
+                for measurement in measurements:
+                    self.storage.execute('DELETE FROM "{}" WHERE {}'.format(
+                        measurement, condition + (
+                            ' AND time >= {}'.format(replaced.value)
+                            if measurement in HISTORY else '')))
+                self.storage.execute(
+                    'DELETE FROM "{}" WHERE time < {}'.format(
+                        POINTER, int(versions[0]) * 1000000))
+                logger.info('Schedule versions before {} deleted ({})'
+                            .format(versions[0], datetime.now() - tic))
+            except Exception:
+                logger.exception('Schedule garbage collection failed')
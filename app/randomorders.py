@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+import profiles
 import random
 import pandas
 import numpy
@@ -84,9 +85,106 @@ def random_deferrable_orderbook(timestep):
 
     # Random power profile
     profile = numpy.random.randint(1, 10, size=(duration,))
-    data['profile_kw'].append(list(profile))
+    data['profile_kw'].append(profiles.encode_profile(profile))
 
     df = pandas.DataFrame(
         index=[datetime.now().replace(second=0, microsecond=0)],
         data=data)
     return df
+
+def _windows(n, start, hours, rng, step=5):
+    """
+    startby and endby (ms since epoch) of n orders on the optimization
+    timestep (step minutes from start), so that every order is feasible
+    """
+    step = step * 60 * 1000
+    first = int(start.replace(second=0, microsecond=0).timestamp() * 1000)
+    last = first + hours * 3600 * 1000
+    startby = first + rng.random_sample(n) * (last - first)
+    endby = startby + rng.random_sample(n) * (last - startby)
+    return (first + numpy.floor((startby - first) / step) * step,
+            first + numpy.floor((endby - first) / step) * step)
+
+def _index(n, start):
+    """Distinct order times (one millisecond apart)"""
+    return pandas.date_range(start.replace(second=0, microsecond=0),
+                             periods=n, freq='ms')
+
+def random_battery_orderbooks(n, start=None, hours=20, rng=None):
+    """
+    n batteries at once, same distributions as random_battery_orderbook.
+    Inputs:
+        - n (int): number of orders
+        - start (datetime): first possible startby (now by default)
+        - hours (float): startby and endby are within start + hours
+        - rng (RandomState): random generator (numpy.random by default)
+    Outputs:
+        - df (DataFrame): order book as saved to influxdb
+    """
+    rng = numpy.random if rng is None else rng
+    start = datetime.now() if start is None else start
+    startby, endby = _windows(n, start, hours, rng)
+    data = {'startby': startby,
+            'endby': endby,
+            'min_kw': rng.randint(2, 10, n),
+            'max_kw': rng.randint(2, 10, n),
+            'max_kwh': rng.randint(10, 100, n),
+            'initial_kwh': rng.randint(30, 100, n),
+            'eta': rng.randint(85, 100, n) / 100}
+    data['initial_kwh'] = numpy.minimum(data['initial_kwh'], data['max_kwh'])
+    data['end_kwh'] = data['initial_kwh'].copy()
+    return pandas.DataFrame(index=_index(n, start), data=data)
+
+def random_shapeable_orderbooks(n, start=None, hours=20, rng=None):
+    """n shapeables at once (see random_battery_orderbooks)"""
+    rng = numpy.random if rng is None else rng
+    start = datetime.now() if start is None else start
+    startby, endby = _windows(n, start, hours, rng)
+    duration = (endby - startby) / (3600 * 1000)
+    data = {'startby': startby,
+            'endby': endby,
+            'max_kw': rng.randint(2, 10, n)}
+    data['end_kwh'] = numpy.minimum(numpy.minimum(
+        rng.randint(10, 100, n), duration), duration * data['max_kw'])
+    return pandas.DataFrame(index=_index(n, start), data=data)
+
+def random_deferrable_orderbooks(n, timestep, start=None, hours=20,
+                                 rng=None):
+    """
+    n deferrables at once (see random_battery_orderbooks), timestep is
+    in minutes.
+    """
+    rng = numpy.random if rng is None else rng
+    start = datetime.now() if start is None else start
+    startby, endby = _windows(n, start, hours, rng, timestep)
+    duration = numpy.minimum(
+        ((endby - startby) / (timestep * 60 * 1000)).astype(int),
+        rng.randint(1, 6, n))
+    power = rng.randint(1, 10, size=(n, 5))
+    data = {'startby': startby,
+            'endby': endby,
+            'duration': duration,
+            'profile_kw': [profiles.encode_profile(power[i, :d])
+                           for i, d in enumerate(duration)]}
+    return pandas.DataFrame(index=_index(n, start), data=data)
+
+def random_uncontrollable(start=None, hours=24, timestep=5, rng=None):
+    """
+    Synthetic uncontrolled demand: daily cycle around the forecast level
+    with noise.
+    Inputs:
+        - start (datetime): first time (now by default)
+        - hours (float): length of the profile
+        - timestep (int): minutes
+    Outputs:
+        - df (DataFrame): uncontr column as saved to influxdb
+    """
+    rng = numpy.random if rng is None else rng
+    start = datetime.now() if start is None else start
+    index = pandas.date_range(
+        start.replace(second=0, microsecond=0), periods=int(
+            hours * 60 / timestep), freq='{}min'.format(timestep))
+    hour = index.hour + index.minute / 60
+    values = (5 * numpy.sin(2 * numpy.pi * (hour - 9) / 24) +
+              rng.normal(0, 1, len(index)))
+    return pandas.DataFrame(index=index, data={'uncontr': values})
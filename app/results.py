@@ -0,0 +1,145 @@
+"""
+Results of maximize_self_consumption.
+
+Schedules are kept as dense (time x asset) NumPy arrays with their asset
+ids. The DataFrames of the dictionary interface are only built (once)
+when they are accessed, frame() builds them directly on another time
+axis (e.g. timestamps) for writing.
+"""
+from collections.abc import MutableMapping
+import numpy
+import pandas
+
+# Results kept as (time x asset) arrays
+SCHEDULES = ['demandshape', 'batteryin',
+             'batteryout', 'batteryenergy',
+             'demanddeferr', 'deferrschedule']
+
+# Solver status of every engine (Pyomo termination conditions, HiGHS
+# model status strings, ...) in lower case without separators, and the
+# shared status it is reported as
+STATUS = {'optimal': 'optimal', 'globallyoptimal': 'optimal',
+          'locallyoptimal': 'optimal', 'feasible': 'feasible',
+          'converged': 'converged',
+          'maxtimelimit': 'timelimit', 'timelimitreached': 'timelimit',
+          'timelimit': 'timelimit', 'maxiterations': 'maxiterations',
+          'iterationlimitreached': 'maxiterations',
+          'maxevaluations': 'maxiterations', 'infeasible': 'infeasible',
+          'infeasibleorunbounded': 'infeasible',
+          'primalinfeasibleorunbounded': 'infeasible',
+          'unbounded': 'unbounded', 'userinterrupt': 'interrupted',
+          'resourceinterrupt': 'interrupted',
+          'interruptedbyuser': 'interrupted',
+          'interruptedbyhighs': 'interrupted', 'error': 'error',
+          'solverfailure': 'error', 'internalsolvererror': 'error',
+          'loaderror': 'error', 'modelerror': 'error',
+          'presolveerror': 'error', 'solveerror': 'error',
+          'postsolveerror': 'error'}
+
+# Shared statuses of solves without a solution
+NO_SOLUTION = ['infeasible', 'unbounded', 'error']
+
+
+def normalize_status(status):
+    """Shared lower case status (see STATUS) of a solver status"""
+    key = ''.join(c for c in str(status).lower() if c.isalpha())
+    return STATUS.get(key, 'other')
+
+
+class Results(MutableMapping):
+    """
+    Same keys as the dictionary of v4norminf.maximize_self_consumption,
+    schedules are None when there is no asset of their kind.
+    """
+    def __init__(self, horizon, timestep):
+        # timestep: hours of each step (float or array for a
+        # non-uniform horizon)
+        self.horizon = list(horizon)
+        self.timestep = timestep
+        self.arrays = dict((key, None) for key in SCHEDULES)
+        self.values = {}
+        self._frames = {}
+
+    def set_array(self, key, values, ids):
+        """Set a (time x asset) schedule, assets are sorted by id"""
+        if values is None or len(ids) == 0:
+            self.arrays[key] = None
+        else:
+            ids = pandas.Index(ids)
+            order = ids.argsort()
+            self.arrays[key] = (
+                numpy.asarray(values, dtype=float)[:, order], ids[order])
+        self._frames.pop(key, None)
+
+    def array(self, key):
+        """(values (T, n), asset ids) of a schedule or None"""
+        return self.arrays[key]
+
+    def frame(self, key, index=None):
+        """DataFrame of a schedule on the horizon (or on index)"""
+        if self.arrays[key] is None:
+            return None
+        values, ids = self.arrays[key]
+        return pandas.DataFrame(
+            values, index=self.horizon if index is None else index,
+            columns=ids, copy=False)
+
+    def set_community(self, uncontrollable, demand_controllable,
+                      peakhigh, peaklow):
+        """Community demand and import from the controllable demand"""
+        demand = numpy.asarray(demand_controllable, dtype=float)
+        imports = numpy.maximum(
+            0, numpy.asarray(uncontrollable, dtype=float) + demand)
+        self.values['demand_controllable'] = demand
+        self.values['community_import'] = imports
+        self.values['peakhigh'] = peakhigh
+        self.values['peaklow'] = peaklow
+        self.values['total_community_import'] = float(
+            numpy.sum(imports * self.timestep))
+
+    def has_solution(self):
+        """
+        False when the solver reported no solution (see NO_SOLUTION) or
+        the peaks or schedules are missing (None or NaN)
+        """
+        status = (self.values.get('solver') or {}).get('status')
+        if status in NO_SOLUTION:
+            return False
+        values = [self.values.get(key) for key in
+                  ['peakhigh', 'peaklow', 'demand_controllable']]
+        values += [array[0] for array in self.arrays.values()
+                   if array is not None]
+        for value in values:
+            try:
+                if not numpy.isfinite(numpy.asarray(value,
+                                                    dtype=float)).all():
+                    return False
+            except (TypeError, ValueError):
+                return False
+        return True
+
+    def __getitem__(self, key):
+        if key in self.arrays:
+            if key not in self._frames:
+                self._frames[key] = self.frame(key)
+            return self._frames[key]
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        if key in self.arrays:
+            self.set_array(key, None if value is None else value.values,
+                           [] if value is None else value.columns)
+        else:
+            self.values[key] = value
+
+    def __delitem__(self, key):
+        if key in self.arrays:
+            self.set_array(key, None, [])
+        else:
+            del self.values[key]
+
+    def __iter__(self):
+        return iter(list(self.arrays) + list(self.values))
+
+    def __len__(self):
+        return len(self.arrays) + len(self.values)
@@ -0,0 +1,138 @@
+"""
+Memoized results of maximize_self_consumption.
+
+A solve only depends on the uncontrolled demand, the three normalized
+order books, the timestep and the solver settings. These are hashed
+into a canonical key (column order, dtypes and -0.0 do not matter) and
+the last results are kept in a bounded LRU cache, optionally saved to a
+directory to survive restarts. The warm start does not change the key.
+"""
+from collections import OrderedDict
+import threading
+import hashlib
+import logging
+import pickle
+import copy
+import glob
+import os
+import numpy
+import pandas
+
+logger = logging.getLogger("api")
+
+
+def _feed(h, value):
+    """Add a canonical encoding of value to the hash h"""
+    if isinstance(value, pandas.DataFrame):
+        h.update(b'frame%d' % len(value))
+        _feed(h, value.index)
+        for column in sorted(value.columns, key=str):
+            _feed(h, str(column))
+            _feed(h, value[column])
+    elif isinstance(value, (pandas.Series, pandas.Index)):
+        _feed(h, value.to_numpy())
+    elif isinstance(value, numpy.ndarray) and value.dtype.kind in 'biuf':
+        h.update(b'array' + repr(value.shape).encode())
+        # + 0.0 turns -0.0 into 0.0
+        h.update((numpy.ascontiguousarray(value, dtype=float) +
+                  0.0).tobytes())
+    elif isinstance(value, numpy.ndarray):
+        h.update(b'objects%d' % len(value))
+        for v in value:
+            _feed(h, v)
+    elif isinstance(value, dict):
+        h.update(b'dict%d' % len(value))
+        for key in sorted(value, key=str):
+            _feed(h, str(key))
+            _feed(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update(b'list%d' % len(value))
+        for v in value:
+            _feed(h, v)
+    elif isinstance(value, (float, int, numpy.number)) and not isinstance(
+            value, bool):
+        h.update(b'n' + repr(float(value) + 0.0).encode())
+    else:
+        h.update(b's' + repr(value).encode())
+
+
+def canonical_key(*inputs, **settings):
+    """
+    Hash of the inputs of a solve.
+    Inputs:
+        - inputs: uncontrollable, dfbatteries, dfshapeables, dfdeferrables
+        - settings: engine, timestep, solver, mipgap, ...
+    Outputs:
+        - key (str)
+    """
+    h = hashlib.sha256()
+    _feed(h, list(inputs))
+    _feed(h, settings)
+    return h.hexdigest()
+
+
+class SolveCache(object):
+    """
+    LRU cache of the results of the last `size` solves, saved to
+    directory (last `size` files kept) if not None.
+    """
+    def __init__(self, size=32, directory=None):
+        self.size = size
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        """Copy of the cached results or None"""
+        with self._lock:
+            results = self.entries.get(key)
+            if results is not None:
+                self.entries.move_to_end(key)
+        if results is None and self.directory is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    results = pickle.load(f)
+                os.utime(self._path(key))
+                self._remember(key, results)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                results = None
+        with self._lock:
+            if results is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return copy.deepcopy(results)
+
+    def put(self, key, results):
+        """Cache the results of a solve"""
+        results = copy.deepcopy(results)
+        self._remember(key, results)
+        if self.directory is not None:
+            try:
+                with open(self._path(key), 'wb') as f:
+                    pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+                files = sorted(glob.glob(os.path.join(self.directory,
+                                                      '*.pkl')),
+                               key=os.path.getmtime)
+                for path in files[:max(len(files) - self.size, 0)]:
+                    os.remove(path)
+            except OSError:
+                logger.exception('Solve cache not saved')
+
+    def _remember(self, key, results):
+        with self._lock:
+            self.entries[key] = results
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
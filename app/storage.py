@@ -0,0 +1,87 @@
+"""
+Shared InfluxDB access for the API.
+
+A single DataFrameClient (keep-alive HTTP session with a connection
+pool, timeouts and retries) is reused by every endpoint instead of
+opening a client per request. Call counts, errors and latencies are
+recorded per operation.
+"""
+from influxdb import DataFrameClient
+import threading
+import time
+
+
+class Storage(object):
+    """Thread-safe wrapper around one pooled DataFrameClient"""
+    def __init__(self, host, port, user, password, dbname,
+                 timeout=10, retries=3, pool_size=10):
+        self.dbname = dbname
+        self.client = DataFrameClient(host, port, user, password, dbname,
+                                      timeout=timeout, retries=retries,
+                                      pool_size=pool_size)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _timed(self, name, fn, *args, **kwargs):
+        tic = time.time()
+        error = False
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed = time.time() - tic
+            with self._lock:
+                stats = self._stats.setdefault(name, {
+                    'calls': 0, 'errors': 0, 'seconds': 0.0,
+                    'max_seconds': 0.0, 'last_seconds': None})
+                stats['calls'] += 1
+                stats['errors'] += int(error)
+                stats['seconds'] += elapsed
+                stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+                stats['last_seconds'] = elapsed
+
+    def query(self, query):
+        return self._timed('query', self.client.query, query)
+
+    def write_points(self, dataframe, measurement, tags=None):
+        return self._timed('write_points', self.client.write_points,
+                           dataframe, measurement, tags)
+
+    def write_lines(self, lines):
+        """Write line protocol strings (ns timestamps) in one request"""
+        return self._timed('write_lines', self.client.write, lines,
+                           {'db': self.dbname, 'precision': 'n'},
+                           protocol='line')
+
+    def execute(self, query):
+        """Run a statement that changes data (DELETE, DROP...)"""
+        return self._timed('execute', self.client.query, query,
+                           method='POST')
+
+    def drop_measurement(self, measurement):
+        return self._timed('drop_measurement', self.client.drop_measurement,
+                           measurement)
+
+    def connections(self):
+        """Number of HTTP connections opened by the pool so far"""
+        try:
+            pools = self.client._session.get_adapter(
+                self.client._baseurl).poolmanager.pools
+            return sum(pools[key].num_connections for key in pools.keys())
+        except Exception:
+            return None
+
+    def stats(self):
+        """Per operation counters and latencies"""
+        with self._lock:
+            operations = dict((name, dict(stats))
+                              for name, stats in self._stats.items())
+        for stats in operations.values():
+            stats['mean_seconds'] = stats['seconds'] / stats['calls']
+        return {'connections': self.connections(),
+                'operations': operations}
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,64 @@
+"""
+The modules of the app import each other by name (as in the container),
+the tests import them the same way.
+"""
+from datetime import datetime, timedelta
+import os
+import sys
+
+import numpy
+import pandas
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import orderbook  # noqa: E402
+import randomorders  # noqa: E402
+import v4matrix  # noqa: E402
+
+TIMESTEP = 1 / 12
+
+
+@pytest.fixture(scope='session')
+def fleet():
+    """
+    Small fixture: 4 hours of 5 minute steps (5 hours of uncontrolled
+    demand), two orders of each kind and the raw order books.
+    """
+    rng = numpy.random.RandomState(3)
+    start = datetime(2020, 6, 1)
+    hours = 4
+    uncontr = randomorders.random_uncontrollable(start, hours + 1, 5, rng)
+    books = [randomorders.random_battery_orderbooks(2, start, hours, rng),
+             randomorders.random_shapeable_orderbooks(2, start, hours, rng),
+             randomorders.random_deferrable_orderbooks(2, 5, start, hours,
+                                                       rng)]
+    return {'start': pandas.Timestamp(start), 'steps': hours * 12,
+            'uncontr': uncontr['uncontr'].values, 'books': books}
+
+
+@pytest.fixture(scope='session')
+def inputs(fleet):
+    """
+    maximize_self_consumption inputs of the fleet, inputs(shift) starts
+    the horizon shift steps later.
+    """
+    def inputs(shift=0):
+        first = fleet['start'] + timedelta(minutes=5 * shift)
+        T = fleet['steps']
+        uncontrollable = pandas.DataFrame(
+            {'p': fleet['uncontr'][shift:shift + T]})
+        books = [book[book.startby >= first.timestamp() * 1000]
+                 for book in fleet['books']]
+        return [uncontrollable] + [orderbook.normalize(book, first, 5)
+                                   for book in books]
+    return inputs
+
+
+@pytest.fixture(scope='session')
+def reference(inputs):
+    """Results of the matrix engine solved in-process by HiGHS"""
+    pytest.importorskip('highspy')
+    return v4matrix.maximize_self_consumption(
+        *inputs(), timestep=TIMESTEP, solver='highs')
@@ -0,0 +1,87 @@
+"""
+Round trips of the archive chunks, retention and downsampling of the
+total demand archive.
+"""
+from datetime import datetime, timedelta
+
+import numpy
+import pandas
+
+import archive
+
+
+def snapshot(version, points=288, freq='5min'):
+    index = pandas.date_range(pandas.Timestamp(version, unit='ms',
+                                               tz='UTC'),
+                              periods=points, freq=freq)
+    return pandas.Series(numpy.random.RandomState(0).normal(50, 5, points),
+                         index=index, name='contr')
+
+
+def test_chunk_round_trip():
+    series = snapshot(1591000000000)
+    chunk = archive.encode_chunk(1591000000000, series)
+    header = archive.HEADER.unpack_from(chunk)
+    assert header[0] == archive.MAGIC
+    assert header[3] == 1591000000000
+    assert header[5] == 5 * 60 * 1000  # regular step
+    decoded = archive.decode_chunk(header, chunk[archive.HEADER.size:])
+    pandas.testing.assert_series_equal(decoded, series, check_freq=False)
+
+
+def test_chunk_irregular_times():
+    series = snapshot(1591000000000, 10)
+    series = series.iloc[[0, 1, 3, 4, 8]]
+    chunk = archive.encode_chunk(1, series)
+    header = archive.HEADER.unpack_from(chunk)
+    assert header[5] == 0
+    decoded = archive.decode_chunk(header, chunk[archive.HEADER.size:])
+    pandas.testing.assert_series_equal(decoded, series, check_freq=False)
+
+
+def test_archive_survives_reopening(tmp_path):
+    versions = [1591000000000, 1591000600000, 1591090000000]
+    store = archive.SnapshotArchive(str(tmp_path), retention=None)
+    for version in versions:
+        store.append(version, snapshot(version))
+    reopened = archive.SnapshotArchive(str(tmp_path), retention=None)
+    assert reopened.versions() == versions
+    assert reopened.versions(versions[1], versions[1]) == [versions[1]]
+    for version in versions:
+        pandas.testing.assert_series_equal(
+            reopened.read(version), snapshot(version), check_freq=False)
+    assert reopened.read(1) is None
+
+
+def test_archive_downsampling_and_retention(tmp_path):
+    old, recent = 1591000000000, 1591864000000  # ten days apart
+    store = archive.SnapshotArchive(
+        str(tmp_path), retention=timedelta(days=30),
+        downsample_after=timedelta(days=7), downsample_step=60)
+    store.append(old, snapshot(old))
+    store.append(recent, snapshot(recent))
+    now = datetime.utcfromtimestamp(recent / 1000) + timedelta(days=1)
+    store.maintain(now)
+    hourly = snapshot(old).resample('60min').mean()
+    pandas.testing.assert_series_equal(store.read(old), hourly,
+                                       check_freq=False)
+    pandas.testing.assert_series_equal(
+        store.read(recent), snapshot(recent), check_freq=False)
+
+    store.maintain(now + timedelta(days=25))
+    assert store.versions() == [recent]
+
+
+
+def test_archive_snapshots_in_range(tmp_path):
+    versions = [1590969600000, 1591012800000, 1591099200000]
+    store = archive.SnapshotArchive(str(tmp_path), retention=None)
+    for version in versions:
+        store.append(version, snapshot(version))
+    start = pandas.Timestamp(versions[1], unit='ms', tz='UTC')
+    snapshots = store.snapshots(start, start + timedelta(hours=12))
+    assert [version for version, series in snapshots] == versions[:2]
+    for version, series in snapshots:
+        assert series.index[0] == start
+        pandas.testing.assert_series_equal(
+            series, snapshot(version)[series.index], check_freq=False)
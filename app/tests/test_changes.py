@@ -0,0 +1,91 @@
+"""
+Decisions of the forecast change detection.
+"""
+from datetime import datetime, timedelta
+import time
+
+import pandas
+import pytest
+
+from changes import ForecastChanges
+
+INDEX = pandas.date_range('2020-06-01', periods=48, freq='5min', tz='UTC')
+START, END = INDEX[0], INDEX[-1]
+
+
+@pytest.fixture
+def changes():
+    changes = ForecastChanges(energy=1.0, peak=1.0,
+                              max_delay=timedelta(hours=3), timestep=1/12)
+    changes.use(pandas.Series(50.0, index=INDEX))
+    return changes
+
+
+def test_no_schedule_solves():
+    decision = ForecastChanges().check(pandas.Series(50.0, index=INDEX),
+                                       START, END)
+    assert decision['solve']
+
+
+def test_same_forecast_skipped(changes):
+    values = pandas.Series(50.0, index=INDEX)
+    assert not changes.check(values, START, END)['solve']
+    decision = changes.check(values, START, END)
+    assert not decision['solve']
+    assert decision['reason'] == 'same forecast as the previous update'
+
+
+def test_large_changes_solve(changes):
+    energy = changes.check(pandas.Series(52.0, index=INDEX), START, END)
+    assert energy['solve'] and energy['energy'] == pytest.approx(8.0)
+    values = pandas.Series(50.0, index=INDEX)
+    values.iloc[10] = 53.0  # 0.25 kWh, 3 kW peak
+    peak = changes.check(values, START, END)
+    assert peak['solve'] and peak['peak'] == pytest.approx(3.0)
+
+
+def test_new_times_solve(changes):
+    decision = changes.check(
+        pandas.Series(50.0, index=INDEX + timedelta(days=1)),
+        START + timedelta(days=1), END + timedelta(days=1))
+    assert decision['solve']
+    assert decision['reason'] == 'no overlap with the last schedule'
+
+
+def test_small_changes_deferred(changes):
+    values = pandas.Series(50.1, index=INDEX)
+    decision = changes.check(values, START, END)
+    assert not decision['solve']
+    assert changes.deferred_since is not None
+    assert changes.due() is None
+
+    # Due once deferred for max_delay, without a new forecast
+    assert changes.due(changes.deferred_since + timedelta(hours=3))
+    changes.deferred_since -= timedelta(hours=3)
+    assert changes.check(pandas.Series(50.2, index=INDEX), START,
+                         END)['solve']
+
+    # A solve with the new demand ends the deferral
+    changes.use(values)
+    assert changes.deferred_since is None and changes.due() is None
+
+
+def test_naive_times_are_utc(changes):
+    values = pandas.Series(52.0, index=INDEX.tz_localize(None))
+    decision = changes.check(values, START, END)
+    assert decision['solve'] and decision['energy'] == pytest.approx(8.0)
+
+
+def test_watch_solves_due_changes(changes):
+    solved = []
+    changes.max_delay = timedelta(0)
+    changes.check(pandas.Series(50.1, index=INDEX), START, END)
+    changes.watch(solved.append, interval=0.01)
+    try:
+        deadline = datetime.now() + timedelta(seconds=5)
+        while not solved and datetime.now() < deadline:
+            time.sleep(0.01)
+    finally:
+        changes.stop()
+    assert solved and solved[0].startswith('changes deferred since')
+
@@ -0,0 +1,23 @@
+"""
+The engines solve the same formulation: on a small fixture they reach
+the same objective.
+"""
+import pytest
+
+import v4norminf
+
+pytest.importorskip('highspy')
+
+TIMESTEP = 1 / 12
+
+
+def objective(results):
+    return results['peakhigh'] - results['peaklow']
+
+
+def test_pyomo_same_as_matrix(inputs, reference):
+    results = v4norminf.maximize_self_consumption(
+        *inputs(), timestep=TIMESTEP, solver='highs')
+    assert objective(results) == pytest.approx(objective(reference),
+                                               abs=1e-6)
+    assert results['solver']['status'] == reference['solver']['status']
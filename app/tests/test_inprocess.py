@@ -0,0 +1,40 @@
+"""
+In-process solves from the sparse arrays: HiGHS and SciPy agree, the
+solver status is reported.
+"""
+import pytest
+
+import v4matrix
+import v4norminf
+
+pytest.importorskip('highspy')
+
+TIMESTEP = 1 / 12
+
+
+def objective(results):
+    return results['peakhigh'] - results['peaklow']
+
+
+def test_matrix_status(reference):
+    assert reference['solver']['status'] == 'optimal'
+    assert not reference['solver']['timelimit']
+
+
+def test_scipy_same_as_highs(inputs, reference):
+    results = v4matrix.maximize_self_consumption(
+        *inputs(), timestep=TIMESTEP, solver='scipy')
+    assert objective(results) == pytest.approx(objective(reference),
+                                               abs=1e-6)
+    assert results['solver']['status'] == 'optimal'
+
+
+@pytest.mark.parametrize('engine', [v4matrix, v4norminf])
+def test_infeasible_status(inputs, engine):
+    uncontrollable, batteries, shapeables, deferrables = inputs()
+    batteries = batteries.copy()
+    batteries['end_kwh'] = batteries['max_kwh'] + 5
+    results = engine.maximize_self_consumption(
+        uncontrollable, batteries, shapeables, deferrables,
+        timestep=TIMESTEP, solver='highs')
+    assert results['solver']['status'] == 'infeasible'
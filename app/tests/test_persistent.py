@@ -0,0 +1,57 @@
+"""
+The persistent model, kept between solves, gives the results of a
+model built from scratch.
+"""
+import numpy
+import pytest
+
+import persistent
+import v4matrix
+
+pytest.importorskip('highspy')
+
+TIMESTEP = 1 / 12
+
+
+def objective(results):
+    return results['peakhigh'] - results['peaklow']
+
+
+def test_persistent_same_as_matrix(inputs):
+    model = persistent.PersistentModel()
+    for shift in [0, 0, 1, 3]:
+        args = inputs(shift)
+        expected = v4matrix.maximize_self_consumption(
+            *args, timestep=TIMESTEP, solver='highs')
+        results = model.maximize_self_consumption(
+            *args, timestep=TIMESTEP, solver='highs')
+        assert objective(results) == pytest.approx(objective(expected),
+                                                   abs=1e-6)
+        assert results['presolve']['rows'][0] == \
+            expected['presolve']['rows'][0]
+        assert results['presolve']['columns'][0] == \
+            expected['presolve']['columns'][0]
+
+
+def test_persistent_schedule_feasible(inputs):
+    # The schedule of the order blocks satisfies the whole problem
+    args = inputs(2)
+    model = persistent.PersistentModel()
+    model.maximize_self_consumption(*inputs(), timestep=TIMESTEP,
+                                    solver='highs')
+    results = model.maximize_self_consumption(*args, timestep=TIMESTEP,
+                                              solver='highs')
+    problem = v4matrix.build_problem(*args, timestep=TIMESTEP)
+    T = len(problem.horizon)
+    x = v4matrix.initial_values(
+        problem.layout, problem.horizon,
+        dict((key, results[key]) for key in v4matrix.KEYS
+             if results[key] is not None), problem.shape[1])
+    x[:T] = results['demand_controllable']
+    x[T], x[T + 1] = results['peakhigh'], results['peaklow']
+    assert not numpy.isnan(x).any()
+    ax = problem.A @ x
+    assert (ax >= problem.row_lb - 1e-6).all()
+    assert (ax <= problem.row_ub + 1e-6).all()
+    assert (x >= problem.col_lb - 1e-6).all()
+    assert (x <= problem.col_ub + 1e-6).all()
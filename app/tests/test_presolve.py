@@ -0,0 +1,31 @@
+"""
+Order windows and limits presolved into variable bounds: same optimum,
+same model sizes in every engine.
+"""
+import pytest
+
+import v4norminf
+
+pytest.importorskip('highspy')
+
+TIMESTEP = 1 / 12
+
+
+def objective(results):
+    return results['peakhigh'] - results['peaklow']
+
+
+def test_presolve_keeps_objective(inputs, reference):
+    results = v4norminf.maximize_self_consumption(
+        *inputs(), timestep=TIMESTEP, solver='highs', presolve=False)
+    assert objective(results) == pytest.approx(objective(reference),
+                                               abs=1e-6)
+
+
+def test_presolve_sizes(inputs, reference):
+    results = v4norminf.maximize_self_consumption(
+        *inputs(), timestep=TIMESTEP, solver='highs')
+    assert results['presolve'] == reference['presolve']
+    rows, columns = reference['presolve']['rows'], \
+        reference['presolve']['columns']
+    assert rows[1] < rows[0] and columns[1] < columns[0]
@@ -0,0 +1,46 @@
+"""
+Round trips of the stored power profiles of the deferrable orders.
+"""
+import base64
+
+import numpy
+import pandas
+
+import profiles
+
+
+def test_profile_round_trip():
+    profile = [0.0, 1.5, 2.25, 3.0]
+    encoded = profiles.encode_profile(profile)
+    assert encoded.startswith(profiles.PREFIX)
+    assert profiles.encode_profile(encoded) == encoded
+    values, offsets = profiles.decode_profiles(
+        [encoded, profiles.encode_profile(numpy.array([4.0]))])
+    assert values.tolist() == profile + [4.0]
+    assert offsets.tolist() == [0, 4, 5]
+
+
+def test_profile_stringified_lists():
+    # Profiles written as stringified lists before the compact encoding
+    column = profiles.profile_column(['[1.0, 2.0]', profiles.encode_profile(
+        [3.0, 4.0, 5.0])], pandas.RangeIndex(2))
+    assert [p.tolist() for p in column] == [[1.0, 2.0], [3.0, 4.0, 5.0]]
+    assert profiles.encode_profile('[1.0, 2.0]') == \
+        profiles.encode_profile([1.0, 2.0])
+
+
+def test_profile_full_precision():
+    profile = [0.1, 1 / 3, 2.7182818284590451]
+    values, offsets = profiles.decode_profiles(
+        [profiles.encode_profile(profile)])
+    assert values.tolist() == profile
+
+
+def test_profile_float32():
+    # Profiles written as float32 before
+    legacy = profiles.PREFIX32 + base64.b64encode(
+        numpy.array([1.5, 2.25], dtype='<f4').tobytes()).decode('ascii')
+    values, offsets = profiles.decode_profiles([legacy])
+    assert values.tolist() == [1.5, 2.25]
+    assert profiles.encode_profile(legacy) == \
+        profiles.encode_profile([1.5, 2.25])
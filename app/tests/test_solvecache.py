@@ -0,0 +1,57 @@
+"""
+Keys and storage of the solve cache.
+"""
+import numpy
+import pandas
+
+from solvecache import SolveCache, canonical_key
+
+
+def book(columns=('startby', 'endby', 'max_kw')):
+    data = {'startby': [0.0, 12.0], 'endby': [24.0, 36.0],
+            'max_kw': [1.0, 2.5]}
+    return pandas.DataFrame(dict((c, data[c]) for c in columns))
+
+
+def test_key_canonical():
+    u = pandas.DataFrame({'p': numpy.linspace(0, 1, 5)})
+    key = canonical_key(u, book(), engine='matrix', timestep=1/12)
+    assert key == canonical_key(u, book(('max_kw', 'endby', 'startby')),
+                                timestep=1/12, engine='matrix')
+    zero = u.copy()
+    zero.loc[0, 'p'] = -0.0
+    assert key == canonical_key(zero, book(), engine='matrix',
+                                timestep=1/12)
+    other = u.copy()
+    other.loc[4, 'p'] = 1.5
+    assert key != canonical_key(other, book(), engine='matrix',
+                                timestep=1/12)
+    assert key != canonical_key(u, book(), engine='pyomo', timestep=1/12)
+
+
+def test_cache_lru():
+    cache = SolveCache(size=2)
+    cache.put('a', {'peakhigh': 1.0})
+    cache.put('b', {'peakhigh': 2.0})
+    assert cache.get('a') == {'peakhigh': 1.0}
+    cache.put('c', {'peakhigh': 3.0})  # b is the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_cache_returns_copies():
+    cache = SolveCache()
+    results = {'schedule': [1.0, 2.0]}
+    cache.put('a', results)
+    results['schedule'].append(3.0)
+    cached = cache.get('a')
+    cached['schedule'].append(4.0)
+    assert cache.get('a') == {'schedule': [1.0, 2.0]}
+
+
+def test_cache_directory(tmp_path):
+    SolveCache(size=2, directory=str(tmp_path)).put('a', {'x': 1})
+    cache = SolveCache(size=2, directory=str(tmp_path))
+    assert cache.get('a') == {'x': 1}
+    assert cache.get('missing') is None
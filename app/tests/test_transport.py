@@ -0,0 +1,30 @@
+"""
+Round trip of the binary forecast body.
+"""
+import numpy
+import pandas
+import pytest
+
+import transport
+
+
+def test_forecast_body_round_trip():
+    times = numpy.arange(1591000000000, 1591000000000 + 10 * 300000, 300000)
+    values = numpy.linspace(40, 50, 10)
+    index, decoded = transport.decode_forecast(
+        transport.encode_forecast(times, values))
+    assert (index == pandas.to_datetime(times, unit='ms', utc=True)).all()
+    assert decoded.tolist() == values.tolist()
+
+
+@pytest.mark.parametrize('body', [
+    b'', b'XXXX' + bytes(12),
+    transport.encode_forecast([1, 2], [1.0, 2.0])[:-8]])
+def test_forecast_body_malformed(body):
+    with pytest.raises(ValueError):
+        transport.decode_forecast(body)
+
+
+def test_forecast_body_lengths():
+    with pytest.raises(ValueError):
+        transport.encode_forecast([1, 2], [1.0])
@@ -0,0 +1,24 @@
+"""
+A MIP start from the previous schedule does not change the optimum.
+"""
+import pytest
+
+import v4matrix
+
+pytest.importorskip('highspy')
+
+TIMESTEP = 1 / 12
+
+
+def objective(results):
+    return results['peakhigh'] - results['peaklow']
+
+
+def test_warm_start_keeps_objective(inputs, reference):
+    initial = dict((key, reference[key]) for key in v4matrix.KEYS
+                   if reference[key] is not None)
+    results = v4matrix.maximize_self_consumption(
+        *inputs(), timestep=TIMESTEP, solver='highs', initial=initial)
+    assert objective(results) == pytest.approx(objective(reference),
+                                               abs=1e-6)
+
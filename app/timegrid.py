@@ -0,0 +1,154 @@
+"""
+Non-uniform time grid of the optimization horizon.
+
+The near future is optimized on the 5 minute base timestep and the rest
+of the horizon on coarser steps (e.g. 5 min for 2h then 30 min), which
+keeps 48h horizons affordable. A coarse horizon is an uncontrollable
+demand with a `steps` column (base timesteps of each step) that every
+engine accepts, startby and endby stay in base timesteps. The schedules
+are expanded back to the base timestep before they are published.
+"""
+from v4norminf import deferrable_placements
+from results import Results
+import numpy
+import pandas
+
+# Results of the power kind, averaged over a step
+POWERS = ['demandshape', 'batteryin', 'batteryout', 'demanddeferr']
+
+
+def time_grid(T, fine, coarse):
+    """
+    Base timesteps of each step of the horizon.
+    Inputs:
+        - T (int): number of base timesteps
+        - fine (int): base timesteps kept at the start (at least one)
+        - coarse (int): base timesteps per step afterwards
+    Outputs:
+        - steps (array): the last step is truncated at T
+    """
+    fine = min(max(int(fine), 1), T)
+    rest = T - fine
+    steps = [1] * fine + [int(coarse)] * (rest // int(coarse))
+    if rest % int(coarse):
+        steps.append(rest % int(coarse))
+    return numpy.array(steps, dtype=int)
+
+
+def _first(steps):
+    return numpy.cumsum(steps) - steps
+
+
+def coarsen(uncontrollable, steps):
+    """Uncontrollable demand (index 0 ... T-1) averaged over the steps"""
+    p = numpy.asarray(uncontrollable.p.values, dtype=float)
+    return pandas.DataFrame({'p': numpy.add.reduceat(p, _first(steps)) /
+                             steps, 'steps': steps})
+
+
+def coarsen_solution(initial, steps):
+    """
+    Previous solution (see v4norminf.shift_solution) on the base
+    timestep moved to the steps: powers are averaged, the energy is
+    taken at the end of each step and the starts at its beginning.
+    """
+    first = _first(steps)
+    horizon = range(int(numpy.sum(steps)))
+    coarse = {}
+    for key, frame in initial.items():
+        values = frame.reindex(index=horizon).values
+        if key in POWERS:
+            values = numpy.add.reduceat(values, first) / steps[:, None]
+        elif key == 'batteryenergy':
+            values = values[first + steps - 1]
+        else:
+            values = values[first]
+        coarse[key] = pandas.DataFrame(
+            values, columns=frame.columns).dropna(how='all')
+    return coarse
+
+
+def _spread(values, steps, inside):
+    """
+    Coarse powers (K, n) on the base timestep: the energy of a step is
+    spread over its base timesteps within the order window (T, n).
+    """
+    step = numpy.repeat(numpy.arange(len(steps)), steps)
+    count = numpy.add.reduceat(inside.astype(int), _first(steps), axis=0)
+    scale = numpy.where(count > 0, steps[:, None] / numpy.maximum(count, 1),
+                        0)
+    return (values * scale)[step] * inside
+
+
+def expand_results(results, uncontrollable, dfbatteries, dfshapeables,
+                   dfdeferrables, timestep, steps):
+    """
+    Results of a coarse horizon on the base timestep.
+    Inputs:
+        - results (Results): solution on the steps
+        - uncontrollable (DataFrame): uncontrollable demand on the base
+          timestep (index 0 ... T-1)
+        - dfbatteries, dfshapeables, dfdeferrables: order books of the
+          solve
+        - timestep (float): base timestep (one is hourly)
+        - steps (array): base timesteps of each step
+    Outputs:
+        - Results on the base timestep, consistent energies and peaks
+    """
+    horizon = uncontrollable.index.tolist()
+    T = len(horizon)
+    t = numpy.arange(T)[:, None]
+    expanded = Results(horizon, timestep)
+    demand = numpy.zeros(T)
+    books = {'demandshape': dfshapeables, 'batteryin': dfbatteries,
+             'batteryout': dfbatteries}
+    for key, sign in [('demandshape', 1), ('batteryin', 1),
+                      ('batteryout', -1)]:
+        if results.array(key) is None:
+            continue
+        values, ids = results.array(key)
+        book = books[key].loc[ids]
+        inside = ((t >= numpy.ceil(book['startby'].values)[None, :]) &
+                  (t <= numpy.floor(book['endby'].values)[None, :]))
+        values = _spread(values, steps, inside)
+        expanded.set_array(key, values, ids)
+        demand += sign * values.sum(axis=1)
+
+    # Energy from the base timestep powers (r9)
+    if results.array('batteryin') is not None:
+        powerin, ids = expanded.array('batteryin')
+        powerout, ids = expanded.array('batteryout')
+        book = dfbatteries.loc[ids]
+        eta = book['eta'].values.astype(float)[None, :]
+        flow = (powerin * eta - powerout / eta) * timestep
+        expanded.set_array(
+            'batteryenergy', book['initial_kwh'].values.astype(float) +
+            numpy.cumsum(flow, axis=0) - flow[0], ids)
+
+    # Deferrables start at the beginning of their step
+    if results.array('deferrschedule') is not None:
+        schedule, ids = results.array('deferrschedule')
+        first = _first(steps)
+        power = numpy.zeros((T, len(ids)))
+        start = numpy.zeros((T, len(ids)))
+        for d, i in enumerate(ids):
+            starts, placements = deferrable_placements(
+                T, dfdeferrables.loc[i, 'startby'],
+                dfdeferrables.loc[i, 'endby'],
+                dfdeferrables.loc[i, 'duration'],
+                dfdeferrables.loc[i, 'profile_kw'])
+            s = first[int(numpy.argmax(schedule[:, d]))]
+            power[:, d] = placements[numpy.searchsorted(starts, s)]
+            start[s, d] = 1
+        expanded.set_array('demanddeferr', power, ids)
+        expanded.set_array('deferrschedule', start, ids)
+        demand += power.sum(axis=1)
+
+    total = numpy.asarray(uncontrollable.p.values, dtype=float) + demand
+    expanded.set_community(uncontrollable.p.values, demand,
+                           max(float(total.max()), 0),
+                           min(float(total.min()), 0))
+    for key, value in results.values.items():
+        if key not in expanded.values:
+            expanded[key] = value
+    return expanded
@@ -0,0 +1,57 @@
+"""
+Columnar binary body of the /forecast upload.
+
+Instead of JSON lists of formatted dates and floats, a forecast can be
+sent as (content-type application/octet-stream):
+    - header: magic b'CSCF', version (uint32) and number of points n
+      (uint64), little-endian
+    - n times in milliseconds since epoch (int64, little-endian)
+    - n values (float64, little-endian)
+Both arrays are read in place from the body (numpy.frombuffer).
+"""
+import struct
+import numpy
+import pandas
+
+MAGIC = b'CSCF'
+VERSION = 1
+HEADER = struct.Struct('<4sIQ')
+CONTENT_TYPE = 'application/octet-stream'
+
+
+def encode_forecast(times, values):
+    """
+    Binary body of a forecast.
+    Inputs:
+        - times (array): milliseconds since epoch (int64)
+        - values (array): float
+    Outputs:
+        - body (bytes)
+    """
+    times = numpy.ascontiguousarray(times, dtype='<i8')
+    values = numpy.ascontiguousarray(values, dtype='<f8')
+    if len(times) != len(values):
+        raise ValueError('Times and values of different lengths')
+    return b''.join([HEADER.pack(MAGIC, VERSION, len(times)),
+                     memoryview(times), memoryview(values)])
+
+
+def decode_forecast(body):
+    """
+    Forecast of a binary body.
+    Outputs:
+        - times (DatetimeIndex): UTC
+        - values (array): float64
+    """
+    if len(body) < HEADER.size:
+        raise ValueError('Forecast body too short')
+    magic, version, n = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a forecast body (version {})'.format(VERSION))
+    if len(body) != HEADER.size + 16 * n:
+        raise ValueError('Forecast body of {} bytes for {} points'.format(
+            len(body), n))
+    times = numpy.frombuffer(body, dtype='<i8', count=n, offset=HEADER.size)
+    values = numpy.frombuffer(body, dtype='<f8', count=n,
+                              offset=HEADER.size + 8 * n)
+    return pandas.to_datetime(times, unit='ms', utc=True), values
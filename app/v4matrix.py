@@ -0,0 +1,761 @@
+"""
+Matrix version of v4norminf.
+
+Same formulation as v4norminf.maximize_self_consumption, but the
+constraints are assembled as sparse coefficient arrays directly from
+NumPy vectors of the order books instead of one Pyomo rule call per
+(t, asset) pair.
+"""
+from collections import OrderedDict
+from results import Results, normalize_status
+from datetime import datetime
+from scipy import sparse
+from v4norminf import (solve_model, solver_statistics, grid_placements,
+                       inside_steps, step_lengths, model_size)
+import pyomo.kernel as pmo
+import logging
+import numpy
+
+logger = logging.getLogger("api")
+
+INF = numpy.inf
+
+# Solvers called in-process on the sparse arrays (no files, no process)
+IN_PROCESS = ['highs', 'scipy']
+
+# scipy.optimize.milp status (see results.normalize_status)
+SCIPY_STATUS = {0: 'optimal', 1: 'timelimit', 2: 'infeasible',
+                3: 'unbounded', 4: 'other'}
+
+# Variables returned as (time x asset) DataFrames
+KEYS = ['demandshape', 'batteryin',
+        'batteryout', 'batteryenergy',
+        'demanddeferr', 'deferrschedule']
+
+# Variables which are states (constant outside of the steps of a block)
+HELD = ['batteryenergy']
+
+
+class Block(object):
+    """
+    Columns and rows contributed by a group of assets.
+    Column and row indices are local to the block, `link` holds the
+    (t, column, coefficient) triplets entering the controllable demand
+    balance (r15). Single column constraints are kept as column bounds,
+    `outside` counts the (t, asset) pairs outside of startby - endby
+    (see v4norminf.model_size). The T steps of a block are the steps of
+    the horizon from `start` (all of them unless it only covers part of
+    the horizon, see persistent).
+    """
+    def __init__(self, ids, kind=None, T=0, start=0):
+        self.ids = list(ids)
+        self.kind = kind
+        self.T = T
+        self.start = start
+        self.outside = 0
+        self.variables = OrderedDict()
+        self.ncols = 0
+        self.nrows = 0
+        self._cols = []
+        self._bounds = []
+        self._rows = []
+        self._link = []
+        self._arrays = None
+
+    def add_variable(self, name, shape, lb=-INF, ub=INF, integer=False):
+        """Add a block of variables and return their column indices"""
+        size = int(numpy.prod(shape))
+        index = numpy.arange(self.ncols, self.ncols + size).reshape(shape)
+        self._arrays = None
+        self.variables[name] = (self.ncols, shape)
+        self._cols.append((numpy.full(size, lb, dtype=float),
+                           numpy.full(size, ub, dtype=float),
+                           numpy.full(size, integer, dtype=bool)))
+        self.ncols += size
+        return index
+
+    def add_rows(self, rows, cols, vals, lb, ub, nrows):
+        """Add nrows rows given as local (row, column, value) triplets"""
+        self._arrays = None
+        rows = numpy.asarray(rows).ravel()
+        cols, vals = numpy.broadcast_arrays(
+            numpy.asarray(cols).ravel(),
+            numpy.asarray(vals, dtype=float).ravel())
+        self._rows.append((rows + self.nrows, cols, vals,
+                           numpy.broadcast_to(lb, (nrows,)).astype(float),
+                           numpy.broadcast_to(ub, (nrows,)).astype(float)))
+        self.nrows += nrows
+
+    def add_bounds(self, cols, lb, ub):
+        """Tighten the bounds of columns to lb <= x <= ub (no rows)"""
+        self._arrays = None
+        cols = numpy.asarray(cols)
+        self._bounds.append((
+            cols.ravel(),
+            numpy.broadcast_to(lb, cols.shape).astype(float).ravel(),
+            numpy.broadcast_to(ub, cols.shape).astype(float).ravel()))
+
+    def link(self, cols, coef):
+        """Add (T, n) columns to the controllable demand balance"""
+        self._arrays = None
+        cols = numpy.asarray(cols)
+        t = numpy.repeat(numpy.arange(cols.shape[0]), cols.shape[1])
+        self._link.append((t, cols.ravel(),
+                           numpy.full(cols.size, coef, dtype=float)))
+
+    def arrays(self):
+        """Concatenate everything that was added so far"""
+        def cat(parts, i, dtype):
+            if not parts:
+                return numpy.zeros(0, dtype=dtype)
+            return numpy.concatenate([p[i] for p in parts]).astype(dtype)
+        if self._arrays is not None:
+            return self._arrays
+        self._arrays = {
+            'col_lb': cat(self._cols, 0, float),
+            'col_ub': cat(self._cols, 1, float),
+            'integer': cat(self._cols, 2, bool),
+            'rows': cat(self._rows, 0, int),
+            'cols': cat(self._rows, 1, int),
+            'vals': cat(self._rows, 2, float),
+            'row_lb': cat(self._rows, 3, float),
+            'row_ub': cat(self._rows, 4, float),
+            'link_t': cat(self._link, 0, int),
+            'link_cols': cat(self._link, 1, int),
+            'link_vals': cat(self._link, 2, float)}
+
+        # Presolve: intersect the bounds added to each column
+        cols = cat(self._bounds, 0, int)
+        numpy.maximum.at(self._arrays['col_lb'], cols,
+                         cat(self._bounds, 1, float))
+        numpy.minimum.at(self._arrays['col_ub'], cols,
+                         cat(self._bounds, 2, float))
+        return self._arrays
+
+    def matrix(self):
+        """Local constraint matrix (nrows x ncols)"""
+        arrays = self.arrays()
+        return sparse.coo_matrix(
+            (arrays['vals'], (arrays['rows'], arrays['cols'])),
+            shape=(self.nrows, self.ncols)).tocsr()
+
+
+def _steps(horizon, steps):
+    """Base steps of each step (ones for a uniform horizon)"""
+    if steps is None:
+        return numpy.ones(len(horizon), dtype=int)
+    return numpy.asarray(steps, dtype=int)
+
+
+def _fraction(steps, book):
+    """(T, n) fraction of each step within startby - endby"""
+    return inside_steps(steps, book['startby'].values,
+                        book['endby'].values) / steps[:, None]
+
+
+def shapeable_block(horizon, dfshapeables, timestep, steps=None):
+    """Shapeable loads (r1 - r4)"""
+    T = len(horizon)
+    steps = _steps(horizon, steps)
+    block = Block(dfshapeables.index, 'shapeable', T)
+    n = len(block.ids)
+    shape = block.add_variable('demandshape', (T, n))
+    max_kw = dfshapeables['max_kw'].values.astype(float)
+    end_kwh = dfshapeables['end_kwh'].values.astype(float)
+
+    # r1, r2: the power bounds are defined by the load characteristics
+    block.add_bounds(shape, 0, INF)
+    block.add_bounds(shape, -INF, numpy.broadcast_to(max_kw, (T, n)))
+
+    # r4: outside of startby - endby we enforce zero power, steps partly
+    # inside of it are limited to their average over the step
+    fraction = _fraction(steps, dfshapeables)
+    block.outside = int(numpy.count_nonzero(fraction == 0))
+    partial = fraction < 1
+    block.add_bounds(shape[partial], 0,
+                     (max_kw[None, :] * fraction)[partial])
+
+    # r3: at the end the energy asked by the load is satisfied
+    block.add_rows(numpy.broadcast_to(numpy.arange(n), (T, n)), shape,
+                   numpy.broadcast_to(timestep * steps[:, None], (T, n)),
+                   end_kwh, end_kwh, n)
+
+    block.link(shape, 1.0)
+    return block
+
+
+def battery_block(horizon, dfbatteries, timestep, steps=None):
+    """Batteries (r5 - r14)"""
+    T = len(horizon)
+    steps = _steps(horizon, steps)
+    block = Block(dfbatteries.index, 'battery', T)
+    n = len(block.ids)
+    powerin = block.add_variable('batteryin', (T, n))
+    powerout = block.add_variable('batteryout', (T, n))
+    energy = block.add_variable('batteryenergy', (T, n))
+    eta = dfbatteries['eta'].values.astype(float)
+
+    # r5 - r8: the power bounds are defined by the battery characteristics
+    max_kw = dfbatteries['max_kw'].values.astype(float)
+    min_kw = dfbatteries['min_kw'].values.astype(float)
+    block.add_bounds(powerin, 0, INF)
+    block.add_bounds(powerin, -INF, numpy.broadcast_to(max_kw, (T, n)))
+    block.add_bounds(powerout, 0, INF)
+    block.add_bounds(powerout, -INF, numpy.broadcast_to(min_kw, (T, n)))
+
+    # r9: SOC considering charge/discharge efficiency
+    dt = timestep * steps[1:, None]
+    rows = numpy.arange(T * n).reshape(T, n)
+    rhs = numpy.zeros((T, n))
+    rhs[0, :] = dfbatteries['initial_kwh'].values.astype(float)
+    block.add_rows(
+        numpy.concatenate([rows.ravel(), rows[1:].ravel(),
+                           rows[1:].ravel(), rows[1:].ravel()]),
+        numpy.concatenate([energy.ravel(), energy[:-1].ravel(),
+                           powerin[1:].ravel(), powerout[1:].ravel()]),
+        numpy.concatenate([
+            numpy.ones(T * n), -numpy.ones((T - 1) * n),
+            (-dt * eta[None, :]).ravel(), (dt / eta[None, :]).ravel()]),
+        rhs.ravel(), rhs.ravel(), T * n)
+
+    # r10, r11: energy bound during operation
+    block.add_bounds(energy, 0, INF)
+    block.add_bounds(energy, -INF, numpy.broadcast_to(
+        dfbatteries['max_kwh'].values.astype(float), (T, n)))
+
+    # r12: energy status at the end
+    block.add_bounds(energy[-1], dfbatteries['end_kwh'].values.astype(float),
+                     INF)
+
+    # r13, r14: outside of startby - endby no operation, steps partly
+    # inside of it are limited to their average over the step
+    fraction = _fraction(steps, dfbatteries)
+    block.outside = int(numpy.count_nonzero(fraction == 0))
+    partial = fraction < 1
+    block.add_bounds(powerin[partial], 0,
+                     (max_kw[None, :] * fraction)[partial])
+    block.add_bounds(powerout[partial], 0,
+                     (min_kw[None, :] * fraction)[partial])
+
+    block.link(powerin, 1.0)
+    block.link(powerout, -1.0)
+    return block
+
+
+def deferrable_block(horizon, dfdeferrables, timestep, steps=None):
+    """
+    Deferrable loads (r16 - r18): binary starts at the feasible start
+    times only (the other starts are fixed to zero), the power profile
+    only covers the steps reachable from them.
+    """
+    T = len(horizon)
+    steps = _steps(horizon, steps)
+    block = Block(dfdeferrables.index, 'deferrable', T)
+    n = len(block.ids)
+    block.outside = int(numpy.count_nonzero(
+        _fraction(steps, dfdeferrables) == 0))
+    demand = block.add_variable('demanddeferr', (T, n))
+    schedule = block.add_variable('deferrschedule', (T, n), lb=0, ub=1,
+                                  integer=True)
+
+    # r16: demanddeferr[t] == sum(profile of start s at t * schedule[s])
+    # over the reachable steps, the other powers are zero (r18)
+    rows, cols, vals = [], [], []  # rows given by their demand column
+    reachable = numpy.zeros((T, n), dtype=bool)
+    feasible = numpy.zeros((T, n), dtype=bool)
+    for d, i in enumerate(block.ids):
+        starts, placements = grid_placements(
+            steps, dfdeferrables.loc[i, 'startby'],
+            dfdeferrables.loc[i, 'endby'], dfdeferrables.loc[i, 'duration'],
+            dfdeferrables.loc[i, 'profile_kw'])
+        if len(starts) == 0:
+            raise ValueError('Deferrable {} has no feasible start'.format(i))
+        feasible[starts, d] = True
+        reachable[:, d] = (placements != 0).any(axis=0)
+        s, t = numpy.nonzero(placements)
+        rows += [demand[t, d], demand[reachable[:, d], d]]
+        cols += [schedule[starts[s], d], demand[reachable[:, d], d]]
+        vals += [-placements[s, t], numpy.ones(reachable[:, d].sum())]
+    # One row per reachable (t, d), numbered in (t, d) order
+    row = numpy.full(T * n, -1)
+    row[demand[reachable]] = numpy.arange(reachable.sum())
+    block.add_rows(row[numpy.concatenate(rows)],
+                   numpy.concatenate(cols), numpy.concatenate(vals), 0, 0,
+                   int(reachable.sum()))
+    block.add_bounds(demand[~reachable], 0, 0)
+    block.add_bounds(schedule[~feasible], 0, 0)
+
+    # r17: we can only schedule a load once within the time horizon
+    block.add_rows(numpy.broadcast_to(numpy.arange(n), (T, n)), schedule,
+                   1.0, 1, 1, n)
+
+    block.link(demand, 1.0)
+    return block
+
+
+class MatrixProblem(object):
+    """
+    min c'x  s.t.  row_lb <= A x <= row_ub,  col_lb <= x <= col_ub
+    with x[integer] integral. `layout` maps every variable name to
+    (ids, first column, shape, first step), `presolve` holds the rows
+    and columns of the problem without and with presolve and
+    `statistics` those of the last solve (see v4norminf.solver_statistics).
+    """
+    def __init__(self, horizon, uncontrollable, timestep, c, A,
+                 row_lb, row_ub, col_lb, col_ub, integer, layout,
+                 presolve=None):
+        self.horizon = horizon
+        self.uncontrollable = uncontrollable
+        self.timestep = timestep
+        self.c = c
+        self.A = A
+        self.row_lb = row_lb
+        self.row_ub = row_ub
+        self.col_lb = col_lb
+        self.col_ub = col_ub
+        self.integer = integer
+        self.layout = layout
+        self.presolve = presolve
+        self.statistics = None
+
+    @property
+    def shape(self):
+        return self.A.shape
+
+
+def assemble(horizon, uncontrollable, blocks, timestep, steps=None):
+    """
+    Stack the asset blocks under the community helper rows (r15, r19,
+    r20), r21 and r22 are bounds of the peaks.
+    Inputs:
+        - horizon (list): time steps 0 ... T-1
+        - uncontrollable (array): uncontrollable demand (T,)
+        - blocks (list): Block of each group of assets
+        - timestep (float): one is equivalent to hourly timestep
+        - steps (array): base timesteps of each step (None if uniform)
+    Outputs:
+        - MatrixProblem
+    """
+    u = numpy.asarray(uncontrollable, dtype=float)
+    T = len(horizon)
+    t = numpy.arange(T)
+
+    # Community columns: demand_controllable, peakhigh, peaklow
+    demand, peakhigh, peaklow = t, T, T + 1
+    ncols = T + 2
+    col_lb = [numpy.concatenate([numpy.full(T, -INF), [0, -INF]])]
+    col_ub = [numpy.concatenate([numpy.full(T, INF), [INF, 0]])]
+    integer = [numpy.zeros(ncols, dtype=bool)]
+    c = numpy.zeros(ncols)
+    c[peakhigh], c[peaklow] = 1, -1
+
+    # r15: demand_controllable[t] - sum(assets[t]) == 0 is row t
+    # r19: demand_controllable[t] - peakhigh <= -u[t]
+    # r20: peaklow - demand_controllable[t] <= u[t]
+    # r21: peaklow <= 0, r22: 0 <= peakhigh are column bounds
+    rows = [t, T + t, T + t, 2 * T + t, 2 * T + t]
+    cols = [demand, demand, numpy.full(T, peakhigh), numpy.full(T, peaklow),
+            demand]
+    vals = [numpy.ones(T), numpy.ones(T), -numpy.ones(T), numpy.ones(T),
+            -numpy.ones(T)]
+    row_lb = [numpy.zeros(T), numpy.full(T, -INF), numpy.full(T, -INF)]
+    row_ub = [numpy.zeros(T), -u, u]
+    nrows = 3 * T
+    full = [model_size(T)]
+
+    layout = OrderedDict()
+    for block in blocks:
+        arrays = block.arrays()
+        rows.append(arrays['rows'] + nrows)
+        cols.append(arrays['cols'] + ncols)
+        vals.append(arrays['vals'])
+        rows.append(arrays['link_t'] + block.start)
+        cols.append(arrays['link_cols'] + ncols)
+        vals.append(-arrays['link_vals'])
+        row_lb.append(arrays['row_lb'])
+        row_ub.append(arrays['row_ub'])
+        col_lb.append(arrays['col_lb'])
+        col_ub.append(arrays['col_ub'])
+        integer.append(arrays['integer'])
+        for name, (offset, shape) in block.variables.items():
+            layout.setdefault(name, []).append(
+                (block.ids, ncols + offset, shape, block.start))
+        nrows += block.nrows
+        ncols += block.ncols
+        # Full size on the whole horizon: the steps the block does not
+        # cover are outside of the time windows
+        n = len(block.ids)
+        full.append(model_size(T, block.kind, n,
+                               block.outside + (T - block.T) * n))
+
+    A = sparse.coo_matrix(
+        (numpy.concatenate(vals),
+         (numpy.concatenate(rows), numpy.concatenate(cols))),
+        shape=(nrows, ncols)).tocsr()
+    c = numpy.concatenate([c, numpy.zeros(ncols - len(c))])
+    col_lb, col_ub = numpy.concatenate(col_lb), numpy.concatenate(col_ub)
+
+    # Columns fixed by their bounds are not handed to the in-process
+    # solvers (see solve_inprocess), the kernel writers substitute them
+    fixed = int(numpy.count_nonzero(col_lb == col_ub))
+    presolve = {'rows': [sum(r for r, c in full), nrows],
+                'columns': [sum(c for r, c in full), ncols - fixed]}
+    if steps is not None:
+        timestep = timestep * numpy.asarray(steps, dtype=float)
+    return MatrixProblem(horizon, u, timestep, c, A,
+                         numpy.concatenate(row_lb), numpy.concatenate(row_ub),
+                         col_lb, col_ub, numpy.concatenate(integer), layout,
+                         presolve)
+
+
+def build_problem(uncontrollable, dfbatteries, dfshapeables,
+                  dfdeferrables, timestep):
+    """Same inputs as maximize_self_consumption, returns a MatrixProblem"""
+    horizon = uncontrollable.index.tolist()
+    steps = step_lengths(uncontrollable)
+    blocks = []
+    if len(dfshapeables) > 0:
+        blocks.append(shapeable_block(horizon, dfshapeables, timestep, steps))
+    if len(dfbatteries) > 0:
+        blocks.append(battery_block(horizon, dfbatteries, timestep, steps))
+    if len(dfdeferrables) > 0:
+        blocks.append(deferrable_block(horizon, dfdeferrables, timestep,
+                                       steps))
+    return assemble(horizon, uncontrollable.p.values, blocks, timestep,
+                    steps)
+
+
+def write_mps(problem, filename):
+    """Write the problem as a free MPS file in one go"""
+    nrows, ncols = problem.shape
+    lb, ub = problem.row_lb, problem.row_ub
+    kind = numpy.where(lb == ub, 'E', numpy.where(
+        numpy.isinf(lb), 'L', 'G'))
+    rhs = numpy.where(kind == 'L', ub, lb)
+    ranged = (kind == 'G') & numpy.isfinite(ub)
+
+    lines = ['NAME v4matrix', 'ROWS', ' N obj']
+    lines += [' {} r{}'.format(k, i) for i, k in enumerate(kind)]
+
+    # Columns, integer ones surrounded by markers
+    lines.append('COLUMNS')
+    A = problem.A.tocsc()
+    marker = False
+    for j in range(ncols):
+        if problem.integer[j] != marker:
+            marker = problem.integer[j]
+            lines.append(" M{} 'MARKER' '{}'".format(
+                j, 'INTORG' if marker else 'INTEND'))
+        if problem.c[j] != 0:
+            lines.append(' c{} obj {:.17g}'.format(j, problem.c[j]))
+        start, end = A.indptr[j], A.indptr[j + 1]
+        lines += [' c{} r{} {:.17g}'.format(j, i, v) for i, v in zip(
+            A.indices[start:end], A.data[start:end])]
+    if marker:
+        lines.append(" M{} 'MARKER' 'INTEND'".format(ncols))
+
+    lines.append('RHS')
+    lines += [' rhs r{} {:.17g}'.format(i, rhs[i])
+              for i in numpy.flatnonzero(rhs != 0)]
+    lines.append('RANGES')
+    lines += [' rng r{} {:.17g}'.format(i, ub[i] - lb[i])
+              for i in numpy.flatnonzero(ranged)]
+
+    # Default MPS bounds are [0, inf), write everything else
+    lines.append('BOUNDS')
+    for j in range(ncols):
+        clb, cub = problem.col_lb[j], problem.col_ub[j]
+        if clb == cub:
+            lines.append(' FX bnd c{} {:.17g}'.format(j, clb))
+            continue
+        if clb == -INF and cub == INF:
+            lines.append(' FR bnd c{}'.format(j))
+            continue
+        if clb == -INF:
+            lines.append(' MI bnd c{}'.format(j))
+        elif clb != 0:
+            lines.append(' LO bnd c{} {:.17g}'.format(j, clb))
+        if cub != INF:
+            lines.append(' UP bnd c{} {:.17g}'.format(j, cub))
+        elif problem.integer[j]:
+            # Some readers default integer columns to binaries
+            lines.append(' PL bnd c{}'.format(j))
+    lines.append('ENDATA')
+
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def kernel_variables(col_lb, col_ub, integer):
+    """
+    Pyomo kernel variables with the given bounds and domains, variables
+    with equal bounds are fixed (the writers substitute them).
+    """
+    def bound(v):
+        return None if numpy.isinf(v) else float(v)
+
+    def variable(lb, ub, i):
+        if lb == ub:
+            return pmo.variable(value=float(lb), fixed=True)
+        return pmo.variable(lb=bound(lb), ub=bound(ub),
+                            domain_type=pmo.IntegerSet if i else pmo.RealSet)
+
+    return pmo.variable_list(
+        variable(lb, ub, i) for lb, ub, i in zip(col_lb, col_ub, integer))
+
+
+def kernel_constraints(b, A, row_lb, row_ub, x):
+    """Add equalities and inequalities to b as two matrix constraints"""
+    A = sparse.csr_matrix(A)
+    equal = row_lb == row_ub
+    if equal.any():
+        b.equal = pmo.matrix_constraint(A[equal], rhs=row_lb[equal], x=x)
+    if (~equal).any():
+        b.inequal = pmo.matrix_constraint(
+            A[~equal], lb=row_lb[~equal], ub=row_ub[~equal], x=x)
+
+
+def kernel_values(x):
+    """Solution of a list of kernel variables (nan if missing)"""
+    return numpy.array([numpy.nan if v.value is None else v.value
+                        for v in x], dtype=float)
+
+
+def initial_values(layout, horizon, initial, ncols):
+    """Columns of a previous solution (see v4norminf.shift_solution)"""
+    x0 = numpy.full(ncols, numpy.nan)
+    for key, frame in initial.items():
+        for ids, offset, shape, start in layout.get(key, []):
+            values = frame.reindex(index=horizon[start:start + shape[0]],
+                                   columns=ids).values
+            x0[offset:offset + values.size] = values.ravel()
+    return x0
+
+
+def kernel_start(x, x0, integer):
+    """Set the known values of x0 as initial values of x"""
+    for j in numpy.flatnonzero(numpy.isfinite(x0)):
+        if not x[j].fixed:
+            x[j].value = float(round(x0[j]) if integer[j] else x0[j])
+
+
+def solve_inprocess(problem, solver='highs', verbose=False, timelimit=5*60,
+                    mipgap=None, initial=None, incumbent=None):
+    """
+    Solve a MatrixProblem in-process from its sparse arrays.
+    Inputs:
+        - problem (MatrixProblem)
+        - solver (str): highs (highspy) or scipy (scipy.optimize.milp,
+          scipy >= 1.9, no warm start)
+        - timelimit (float): time limit in seconds
+        - mipgap (float): relative MIP gap (solver default if None)
+        - initial (dict): previous solution used as a MIP start
+        - incumbent (function): called with (x, info) on every improving
+          MIP solution while highs runs, info holds the objective, the
+          mipgap, the dual bound and the seconds since the start
+    Outputs:
+        - x (array): solution (nan if none was found), the solver
+          statistics are set on the problem
+    """
+    nrows, ncols = problem.shape
+    # Columns fixed by their bounds become constants of the rows
+    fixed = problem.col_lb == problem.col_ub
+    free = numpy.flatnonzero(~fixed)
+    A = problem.A.tocsc()
+    shift = A[:, fixed] @ problem.col_lb[fixed]
+    A = A[:, free]
+    c, integer = problem.c[free], problem.integer[free]
+    col_lb, col_ub = problem.col_lb[free], problem.col_ub[free]
+    row_lb, row_ub = problem.row_lb - shift, problem.row_ub - shift
+
+    def expand(y):
+        """Solution of every column from the one of the free columns"""
+        x = problem.col_lb.copy()
+        x[free] = y
+        return x
+
+    if solver == 'scipy':
+        from scipy.optimize import milp, Bounds, LinearConstraint
+        options = {'disp': verbose, 'time_limit': timelimit}
+        if mipgap is not None:
+            options['mip_rel_gap'] = mipgap
+        res = milp(c, integrality=integer.astype(int),
+                   bounds=Bounds(col_lb, col_ub),
+                   constraints=LinearConstraint(A, row_lb, row_ub),
+                   options=options)
+        problem.statistics = {
+            'status': SCIPY_STATUS.get(res.status, 'other'),
+            'mipgap': getattr(res, 'mip_gap', None),
+            'nodes': getattr(res, 'mip_node_count', None),
+            'timelimit': res.status == 1}
+        return numpy.full(ncols, numpy.nan) if res.x is None else \
+            expand(res.x)
+
+    import highspy
+    lp = highspy.HighsLp()
+    lp.num_col_, lp.num_row_ = len(free), nrows
+    lp.col_cost_ = c
+    lp.offset_ = float(problem.c[fixed] @ problem.col_lb[fixed])
+    lp.col_lower_, lp.col_upper_ = col_lb, col_ub
+    lp.row_lower_, lp.row_upper_ = row_lb, row_ub
+    lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+    lp.a_matrix_.start_ = A.indptr
+    lp.a_matrix_.index_ = A.indices
+    lp.a_matrix_.value_ = A.data
+    lp.integrality_ = [highspy.HighsVarType.kInteger if i else
+                       highspy.HighsVarType.kContinuous
+                       for i in integer]
+
+    h = highspy.Highs()
+    h.setOptionValue('output_flag', bool(verbose))
+    h.setOptionValue('time_limit', float(timelimit))
+    if mipgap is not None:
+        h.setOptionValue('mip_rel_gap', float(mipgap))
+    h.passModel(lp)
+    if initial is not None:
+        x0 = initial_values(problem.layout, problem.horizon, initial,
+                            ncols)[free]
+        x0[integer] = numpy.round(x0[integer])
+        known = numpy.flatnonzero(numpy.isfinite(x0))
+        h.setSolution(len(known), known.astype(numpy.int32), x0[known])
+    if incumbent is not None and integer.any():
+        watch_incumbents(h, lambda y, info: incumbent(expand(y), info))
+    h.run()
+    info, status = h.getInfo(), h.getModelStatus()
+    problem.statistics = {
+        'status': normalize_status(h.modelStatusToString(status)),
+        'mipgap': float(info.mip_gap) if integer.any() else None,
+        'nodes': int(info.mip_node_count) if integer.any() else None,
+        'timelimit': status == highspy.HighsModelStatus.kTimeLimit}
+    if info.primal_solution_status != 2:  # no feasible solution
+        return numpy.full(ncols, numpy.nan)
+    return expand(numpy.array(h.getSolution().col_value))
+
+
+def watch_incumbents(h, incumbent):
+    """Call incumbent(x, info) on the improving solutions of highspy h"""
+    def improving(data):
+        info = {'objective': float(data.objective_function_value),
+                'mipgap': float(data.mip_gap),
+                'bound': float(data.mip_dual_bound),
+                'seconds': float(data.running_time)}
+        try:
+            incumbent(numpy.array(data.mip_solution), info)
+        except Exception:
+            # Reporting must not stop the solve
+            logger.exception('Incumbent not reported')
+
+    import highspy
+    if hasattr(h, 'cbMipImprovingSolution'):
+        # highspy >= 1.8
+        h.cbMipImprovingSolution.subscribe(lambda e: improving(e.data_out))
+    else:
+        h.setCallback(lambda kind, message, data_out, data_in, user_data:
+                      improving(data_out), None)
+        h.startCallback(
+            highspy.cb.HighsCallbackType.kCallbackMipImprovingSolution)
+
+
+def solve_problem(problem, solver='gurobi', verbose=False,
+                  solver_path=None, timelimit=5*60, initial=None,
+                  mipgap=None, incumbent=None):
+    """
+    Solve a MatrixProblem in-process (see IN_PROCESS) or through a
+    Pyomo kernel model (incumbents are only reported by highs)
+    """
+    if solver in IN_PROCESS:
+        return solve_inprocess(problem, solver=solver, verbose=verbose,
+                               timelimit=timelimit, mipgap=mipgap,
+                               initial=initial, incumbent=incumbent)
+    b = pmo.block()
+    b.x = kernel_variables(problem.col_lb, problem.col_ub, problem.integer)
+    if initial is not None:
+        kernel_start(b.x, initial_values(problem.layout, problem.horizon,
+                                         initial, problem.shape[1]),
+                     problem.integer)
+    kernel_constraints(b, problem.A, problem.row_lb, problem.row_ub,
+                       list(b.x))
+    b.objective = pmo.objective(
+        sum(problem.c[j] * b.x[j] for j in numpy.flatnonzero(problem.c)),
+        sense=pmo.minimize)
+
+    results = solve_model(b, solver=solver, verbose=verbose,
+                          solver_path=solver_path, timelimit=timelimit,
+                          warmstart=initial is not None, mipgap=mipgap)
+    problem.statistics = solver_statistics(results)
+    if verbose:
+        print(results)
+    return kernel_values(b.x)
+
+
+def incumbent_results(problem, incumbent):
+    """Incumbent callback of solve_problem giving the results of x"""
+    if incumbent is None:
+        return None
+    return lambda x, info: incumbent(extract_results(problem, x), info)
+
+
+def extract_results(problem, x):
+    """Same results as v4norminf.maximize_self_consumption (Results)"""
+    results = Results(problem.horizon, problem.timestep)
+    T = len(problem.horizon)
+    for key in KEYS:
+        # Blocks covering part of the horizon only: zero powers outside,
+        # the states (HELD) keep their first and last values
+        parts = [(numpy.pad(
+            x[offset:offset + numpy.prod(shape)].reshape(shape),
+            ((start, T - start - shape[0]), (0, 0)),
+            'edge' if key in HELD else 'constant'), ids)
+                 for ids, offset, shape, start in problem.layout.get(key, [])
+                 if len(ids) > 0]
+        if parts:
+            results.set_array(
+                key, numpy.hstack([values for values, ids in parts]),
+                [i for values, ids in parts for i in ids])
+
+    results.set_community(problem.uncontrollable, x[:T], x[T], x[T + 1])
+    if problem.presolve is not None:
+        results['presolve'] = problem.presolve
+    if problem.statistics is not None:
+        results['solver'] = problem.statistics
+    return results
+
+
+def maximize_self_consumption(uncontrollable, dfbatteries,
+                              dfshapeables, dfdeferrables,
+                              timestep, solver='gurobi',
+                              verbose=False, solver_path=None,
+                              timelimit=5*60, initial=None, mipgap=None,
+                              incumbent=None):
+    """
+    Drop-in replacement of v4norminf.maximize_self_consumption building
+    the constraint matrix in bulk.
+    Inputs:
+        - uncontrollable (DataFrame): uncontrollable load demand
+        - dfbatteries (DataFrame): order book
+        - dfshapeables (DataFrame): order book
+        - dfdeferrables (DataFrame): order book
+        - timestep (float): one is equivalent to hourly timestep
+        - initial (dict): previous solution used as a MIP start
+        - solver (str): also highs or scipy, solved in-process
+        - mipgap (float): relative MIP gap (solver default if None)
+        - incumbent (function): called with (results, info) on every
+          improving solution found by highs (see solve_inprocess)
+    Outputs:
+        - same dictionary as v4norminf.maximize_self_consumption
+    """
+    tic = datetime.now()
+    problem = build_problem(uncontrollable, dfbatteries, dfshapeables,
+                            dfdeferrables, timestep)
+    timings = {'build': (datetime.now() - tic).total_seconds()}
+    tic = datetime.now()
+    x = solve_problem(problem, solver=solver, verbose=verbose,
+                      solver_path=solver_path, timelimit=timelimit,
+                      initial=initial, mipgap=mipgap,
+                      incumbent=incumbent_results(problem, incumbent))
+    timings['solve'] = (datetime.now() - tic).total_seconds()
+    tic = datetime.now()
+    results = extract_results(problem, x)
+    timings['extract'] = (datetime.now() - tic).total_seconds()
+    results['timings'] = timings
+    return results
@@ -1,22 +1,143 @@
 from pyomo.opt import SolverFactory
 from pyomo.environ import *
-import pandas
+from results import Results, normalize_status
+from datetime import datetime
+import logging
+import numpy
+
+logger = logging.getLogger("api")
+
+
+def step_lengths(uncontrollable):
+    """
+    Base time steps covered by each step of the horizon, given by the
+    optional `steps` column of the uncontrollable demand (all ones for
+    a uniform horizon, see timegrid)
+    """
+    if 'steps' in uncontrollable:
+        return uncontrollable['steps'].values.astype(int)
+    return numpy.ones(len(uncontrollable), dtype=int)
+
+
+def inside_steps(steps, startby, endby):
+    """
+    (T, n) number of base steps of each step within startby - endby,
+    startby and endby are in base steps (n,)
+    """
+    first = (numpy.cumsum(steps) - steps)[:, None]
+    low = numpy.maximum(first, numpy.ceil(
+        numpy.asarray(startby, dtype=float))[None, :])
+    high = numpy.minimum(first + steps[:, None] - 1, numpy.floor(
+        numpy.asarray(endby, dtype=float))[None, :])
+    return numpy.maximum(0, high - low + 1).astype(int)
+
+
+def window_fractions(steps, book, ids):
+    """
+    Fraction of each step within startby - endby of each order
+    Inputs:
+        - steps (array): base steps of each step of the horizon
+        - book (DataFrame): order book with startby and endby
+        - ids (list): orders of the book
+    Outputs:
+        - fractions (dict): (t, id) -> fraction, for the steps which are
+          (partly) within the window, ordered by order then time
+    """
+    if not ids:
+        return {}
+    fraction = inside_steps(steps, book.loc[ids, 'startby'].values,
+                            book.loc[ids, 'endby'].values) / steps[:, None]
+    return dict(((t, i), fraction[t, j])
+                for j, i in enumerate(ids)
+                for t in numpy.flatnonzero(fraction[:, j]).tolist())
+
+
+# Rows and columns per (t, asset) of the model without presolve, number
+# of rows per (t, asset) outside of startby - endby (r4, r13 - r14, r18)
+FULL_SIZE = {'shapeable': (2, 1, 1), 'battery': (7, 3, 2),
+             'deferrable': (1, 2, 1)}
+
+
+def model_size(T, kind=None, n=0, outside=0):
+    """
+    Rows and columns of the model without presolve (shared by the
+    engines to report the presolve)
+    Inputs:
+        - T (int): steps of the horizon
+        - kind (str): shapeable, battery or deferrable, None for the
+          community rows and columns (r15, r19 - r22)
+        - n (int): number of assets
+        - outside (int): (t, asset) pairs outside of startby - endby
+    Outputs:
+        - rows, columns (int)
+    """
+    if kind is None:
+        return 5 * T, T + 2
+    rows, columns, windows = FULL_SIZE[kind]
+    return rows * T * n + n + windows * outside, columns * T * n
+
+
+def deferrable_placements(T, startby, endby, duration, profile):
+    """
+    Feasible start times of a deferrable load and the (starts x T)
+    power profile of each start (truncated at the end of the horizon).
+    """
+    profile = numpy.asarray(profile[:int(duration)], dtype=float)
+    L = len(profile)
+    t = numpy.arange(T)[:, None] + numpy.arange(L)[None, :]
+    ok = (t >= T) | (profile[None, :] == 0) | (
+        (t >= startby) & (t <= endby))
+    starts = numpy.flatnonzero(ok.all(axis=1))
+    placements = numpy.zeros((len(starts), T))
+    t = t[starts]
+    inside = t < T
+    placements[numpy.nonzero(inside)[0], t[inside]] = numpy.broadcast_to(
+        profile, t.shape)[inside]
+    return starts, placements
+
+
+def grid_placements(steps, startby, endby, duration, profile):
+    """
+    deferrable_placements on a horizon of (possibly) coarse steps: the
+    load starts at the beginning of a step and the profile is averaged
+    over each step. Returns (start steps, (starts x T) profiles).
+    """
+    first = numpy.cumsum(steps) - steps
+    starts, placements = deferrable_placements(
+        int(numpy.sum(steps)), startby, endby, duration, profile)
+    keep = numpy.isin(starts, first)
+    placements = numpy.add.reduceat(placements[keep], first, axis=1)
+    return (numpy.searchsorted(first, starts[keep]),
+            placements / steps[None, :])
+
 
 def maximize_self_consumption(uncontrollable, dfbatteries,
                               dfshapeables, dfdeferrables,
                               timestep, solver='gurobi',
                               verbose=False, solver_path=None,
-                              timelimit=5*60):
+                              timelimit=5*60, initial=None, presolve=True,
+                              mipgap=None):
     """
     Version v001 Minimize \sum_{t}^T peak^+ - peak^-
     Optimize batteries, shapeable and deferrable loads to maximize
     collective self-consumption.
     Inputs:
-        - uncontrollable (DataFrame): uncontrollable load demand
+        - uncontrollable (DataFrame): uncontrollable load demand, with
+          an optional `steps` column for a non-uniform horizon (base
+          steps per step, see timegrid, requires presolve)
         - dfbatteries (DataFrame): order book
         - dfshapeables (DataFrame): order book
         - dfdeferrables (DataFrame): order book
         - timestep (float): one is equivalent to hourly timestep
+          (of a base step)
+        - initial (dict): previous solution used as a MIP start
+          (see shift_solution), ignored by solvers without warm start
+        - presolve (bool): power and energy limits become variable
+          bounds and the powers outside of startby - endby are not
+          created (r1, r2, r4 - r8, r10 - r14, r18, r21, r22 are not
+          emitted as rows), deferrable loads only have binary starts
+          at their feasible start times
+        - mipgap (float): relative MIP gap (solver default if None)
     Outputs:
         - demandshape
         - batteryin
@@ -29,35 +150,111 @@ def maximize_self_consumption(uncontrollable, dfbatteries,
         - total community_import
         - peakhigh
         - peaklow
+        - presolve: rows and columns of the full and of the solved model
+        - timings: seconds spent to build, solve and extract the results
+        - solver: statistics reported by the solver (solver_statistics)
     """
     # Inputs
+    tic = datetime.now()
     horizon = uncontrollable.index.tolist()
     demand_uncontrollable = uncontrollable.p.to_list()
     batteries = dfbatteries.index.tolist()
     shapeables = dfshapeables.index.tolist()
     deferrables = dfdeferrables.index.tolist()
+    steps = step_lengths(uncontrollable)
+    if not presolve and (steps != 1).any():
+        raise ValueError('A non-uniform horizon requires presolve')
     m = ConcreteModel()
 
+    # Index of the powers, only within the time windows with presolve
+    # (power bounds are scaled by the fraction of a step in the window)
+    windows = (window_fractions(steps, dfshapeables, shapeables),
+               window_fractions(steps, dfbatteries, batteries),
+               window_fractions(steps, dfdeferrables, deferrables))
+    if presolve:
+        shape_index, battery_index = list(windows[0]), list(windows[1])
+
+        # Deferrables: feasible starts and the steps they can reach
+        starts, terms, start_index, deferr_index = {}, {}, [], []
+        for d in deferrables:
+            start, placements = grid_placements(
+                steps, dfdeferrables.loc[d, 'startby'],
+                dfdeferrables.loc[d, 'endby'],
+                dfdeferrables.loc[d, 'duration'],
+                dfdeferrables.loc[d, 'profile_kw'])
+            if len(start) == 0:
+                raise ValueError('Deferrable {} has no feasible start'
+                                 .format(d))
+            starts[d] = [horizon[i] for i in start]
+            for t in numpy.flatnonzero((placements != 0).any(axis=0)):
+                i = numpy.flatnonzero(placements[:, t])
+                terms[horizon[t], d] = list(zip(
+                    [starts[d][j] for j in i], placements[i, t].tolist()))
+                deferr_index.append((horizon[t], d))
+            start_index.extend((t, d) for t in starts[d])
+    else:
+        shape_index = [(t, s) for s in shapeables for t in horizon]
+        battery_index = [(t, b) for b in batteries for t in horizon]
+        deferr_index = [(t, d) for d in deferrables for t in horizon]
+        start_index = [(t, d) for d in deferrables for t in horizon]
+
     ###################################################### Set
     m.horizon = Set(initialize=horizon, ordered=True)
     last = m.horizon.last()
     m.batteries = Set(initialize=batteries, ordered=True)
     m.shapeables = Set(initialize=shapeables, ordered=True)
     m.deferrables = Set(initialize=deferrables, ordered=True)
+    m.shape_index = Set(initialize=shape_index, dimen=2, ordered=True)
+    m.battery_index = Set(initialize=battery_index, dimen=2, ordered=True)
+    m.deferr_index = Set(initialize=deferr_index, dimen=2, ordered=True)
+    m.start_index = Set(initialize=start_index, dimen=2, ordered=True)
+
+    ##################################################### Bounds
+    # Power and energy limits (r1, r2, r5 - r8, r10 - r12, r21, r22)
+    shape_max_kw = dfshapeables['max_kw'].to_dict() if shapeables else {}
+    battery_max_kw = dfbatteries['max_kw'].to_dict() if batteries else {}
+    battery_min_kw = dfbatteries['min_kw'].to_dict() if batteries else {}
+    battery_max_kwh = dfbatteries['max_kwh'].to_dict() if batteries else {}
+    battery_end_kwh = dfbatteries['end_kwh'].to_dict() if batteries else {}
+
+    def b_shape(m, t, s):
+        return (0, shape_max_kw[s] * windows[0][t, s])
+
+    def b_batteryin(m, t, b):
+        return (0, battery_max_kw[b] * windows[1][t, b])
+
+    def b_batteryout(m, t, b):
+        return (0, battery_min_kw[b] * windows[1][t, b])
+
+    def b_batteryenergy(m, t, b):
+        if t == last:
+            return (max(0, battery_end_kwh[b]), battery_max_kwh[b])
+        return (0, battery_max_kwh[b])
+
+    def bounds(rule):
+        return rule if presolve else None
 
     ##################################################### Var
     m.demand_controllable = Var(m.horizon, domain=Reals)
-    m.peakhigh = Var(domain=Reals)
-    m.peaklow = Var(domain=Reals)
+    m.peakhigh = Var(domain=Reals, bounds=(0, None) if presolve else None)
+    m.peaklow = Var(domain=Reals, bounds=(None, 0) if presolve else None)
 
     # Equipment specifics
-    m.demandshape = Var(m.horizon, m.shapeables, domain=Reals)
-    m.batteryin = Var(m.horizon, m.batteries, domain=Reals)
-    m.batteryout = Var(m.horizon, m.batteries, domain=Reals)
-    m.batteryenergy = Var(m.horizon, m.batteries, domain=Reals)
-    m.demanddeferr = Var(m.horizon, m.deferrables, domain=Reals)
-    m.deferrschedule = Var(m.horizon, m.deferrables,
-                           domain=NonNegativeIntegers)
+    m.demandshape = Var(m.shape_index, domain=Reals,
+                        bounds=bounds(b_shape))
+    m.batteryin = Var(m.battery_index, domain=Reals,
+                      bounds=bounds(b_batteryin))
+    m.batteryout = Var(m.battery_index, domain=Reals,
+                       bounds=bounds(b_batteryout))
+    m.batteryenergy = Var(m.horizon, m.batteries, domain=Reals,
+                          bounds=bounds(b_batteryenergy))
+    m.demanddeferr = Var(m.deferr_index, domain=Reals)
+    m.deferrschedule = Var(m.start_index,
+                           domain=Binary if presolve else NonNegativeIntegers)
+
+    # Powers which are not created are zero
+    def power(var, t, i):
+        return var[t, i] if (t, i) in var else 0
 
     #################################################### Rules
     # --------------------------------------------------------
@@ -73,7 +270,7 @@ def maximize_self_consumption(uncontrollable, dfbatteries,
 
     # At the end the energy asked by the load is satisfied
     def r_shape_energy(m, s):
-        return (sum(m.demandshape[i, s] for i in m.horizon) * timestep ==
+        return (sum(power(m.demandshape, i, s) * steps[i] for i in m.horizon) * timestep ==
                 dfshapeables.loc[s, 'end_kwh'])
 
     # If we are outside of startby - endby, we enforce zero power
@@ -108,8 +305,8 @@ def maximize_self_consumption(uncontrollable, dfbatteries,
         else:
             return (m.batteryenergy[t, b] ==
                     m.batteryenergy[t-1, b] +
-                    m.batteryin[t, b] * timestep * dfbatteries.loc[b, 'eta']
-                    - m.batteryout[t, b] * timestep / dfbatteries.loc[b, 'eta'])
+                    power(m.batteryin, t, b) * timestep * steps[t] * dfbatteries.loc[b, 'eta']
+                    - power(m.batteryout, t, b) * timestep * steps[t] / dfbatteries.loc[b, 'eta'])
                     # 0.25 pour un quart d'heure
 
     # Energy bound during operation
@@ -154,6 +351,15 @@ def maximize_self_consumption(uncontrollable, dfbatteries,
     def r_deferrable_schedule_sum(m, d):
         return (sum(m.deferrschedule[i, d] for i in m.horizon) == 1)
 
+    # With presolve, the power profile only covers the reachable steps
+    # and the load only starts at its feasible start times
+    def r_deferrable_start(m, t, d):
+        return (m.demanddeferr[t, d] ==
+                sum(m.deferrschedule[s, d] * kw for s, kw in terms[t, d]))
+
+    def r_deferrable_start_sum(m, d):
+        return (sum(m.deferrschedule[s, d] for s in starts[d]) == 1)
+
     # If we are outside of startby - endby, we enforce no operation
     def r_deferrable_timebounds(m, t, d):
         if t < dfdeferrables.loc[d, 'startby']:
@@ -169,9 +375,10 @@ def maximize_self_consumption(uncontrollable, dfbatteries,
     # Useless step which seems to be necessary
     def r_demand_total(m, t):
         return (m.demand_controllable[t] ==
-                sum(m.demandshape[t, s] for s in m.shapeables) +
-                sum(m.batteryin[t, b] - m.batteryout[t, b] for b in m.batteries) +
-                sum(m.demanddeferr[t, d] for d in m.deferrables))
+                sum(power(m.demandshape, t, s) for s in m.shapeables) +
+                sum(power(m.batteryin, t, b) - power(m.batteryout, t, b)
+                    for b in m.batteries) +
+                sum(power(m.demanddeferr, t, d) for d in m.deferrables))
 
     # Limit maximum peak
     def r_peak_high(m, t):
@@ -192,31 +399,50 @@ def maximize_self_consumption(uncontrollable, dfbatteries,
         return (m.peaklow <= 0)
 
     # Shapeable
-    m.r1 = Constraint(m.horizon, m.shapeables, rule=r_shape_min_power)
-    m.r2 = Constraint(m.horizon, m.shapeables, rule=r_shape_max_power)
     m.r3 = Constraint(m.shapeables, rule=r_shape_energy)
-    m.r4 = Constraint(m.horizon, m.shapeables, rule=r_shape_timebounds)
     # Battery
-    m.r5 = Constraint(m.horizon, m.batteries, rule=r_battery_min_powerin)
-    m.r6 = Constraint(m.horizon, m.batteries, rule=r_battery_max_powerin)
-    m.r7 = Constraint(m.horizon, m.batteries, rule=r_battery_min_powerout)
-    m.r8 = Constraint(m.horizon, m.batteries, rule=r_battery_max_powerout)
     m.r9 = Constraint(m.horizon, m.batteries, rule=r_battery_energy)
-    m.r10 = Constraint(m.horizon, m.batteries, rule=r_battery_min_energy)
-    m.r11 = Constraint(m.horizon, m.batteries, rule=r_battery_max_energy)
-    m.r12 = Constraint(m.batteries, rule=r_battery_end_energy)
-    m.r13 = Constraint(m.horizon, m.batteries, rule=r_batteryin_timebounds)
-    m.r14 = Constraint(m.horizon, m.batteries, rule=r_batteryout_timebounds)
     # Deferrable
-    m.r16 = Constraint(m.horizon, m.deferrables, rule=r_deferrable_schedule)
-    m.r17 = Constraint(m.deferrables, rule=r_deferrable_schedule_sum)
-    m.r18 = Constraint(m.horizon, m.deferrables, rule=r_deferrable_timebounds)
+    if presolve:
+        m.r16 = Constraint(m.deferr_index, rule=r_deferrable_start)
+        m.r17 = Constraint(m.deferrables, rule=r_deferrable_start_sum)
+    else:
+        m.r16 = Constraint(m.horizon, m.deferrables,
+                           rule=r_deferrable_schedule)
+        m.r17 = Constraint(m.deferrables, rule=r_deferrable_schedule_sum)
     # Helper
     m.r15 = Constraint(m.horizon, rule=r_demand_total)
     m.r19 = Constraint(m.horizon, rule=r_peak_high)
     m.r20 = Constraint(m.horizon, rule=r_peak_low)
-    m.r21 = Constraint(m.horizon, rule=r_peak_low_zero)
-    m.r22 = Constraint(m.horizon, rule=r_peak_high_zero)
+
+    # Without presolve the bounds and time windows are rows
+    if not presolve:
+        m.r1 = Constraint(m.horizon, m.shapeables, rule=r_shape_min_power)
+        m.r2 = Constraint(m.horizon, m.shapeables, rule=r_shape_max_power)
+        m.r4 = Constraint(m.horizon, m.shapeables, rule=r_shape_timebounds)
+        m.r5 = Constraint(m.horizon, m.batteries, rule=r_battery_min_powerin)
+        m.r6 = Constraint(m.horizon, m.batteries, rule=r_battery_max_powerin)
+        m.r7 = Constraint(m.horizon, m.batteries, rule=r_battery_min_powerout)
+        m.r8 = Constraint(m.horizon, m.batteries, rule=r_battery_max_powerout)
+        m.r10 = Constraint(m.horizon, m.batteries, rule=r_battery_min_energy)
+        m.r11 = Constraint(m.horizon, m.batteries, rule=r_battery_max_energy)
+        m.r12 = Constraint(m.batteries, rule=r_battery_end_energy)
+        m.r13 = Constraint(m.horizon, m.batteries, rule=r_batteryin_timebounds)
+        m.r14 = Constraint(m.horizon, m.batteries, rule=r_batteryout_timebounds)
+        m.r18 = Constraint(m.horizon, m.deferrables, rule=r_deferrable_timebounds)
+        m.r21 = Constraint(m.horizon, rule=r_peak_low_zero)
+        m.r22 = Constraint(m.horizon, rule=r_peak_high_zero)
+
+    # Size of the full model (no presolve) and of the one solved
+    T, S, B, D = (len(horizon), len(shapeables), len(batteries),
+                  len(deferrables))
+    full = [model_size(T)] + [
+        model_size(T, kind, n, T * n - len(w)) for kind, n, w in zip(
+            ('shapeable', 'battery', 'deferrable'), (S, B, D), windows)]
+    size = {'rows': [sum(r for r, c in full), m.nconstraints()],
+            'columns': [sum(c for r, c in full), m.nvariables()]}
+    logger.info('Presolve: {} -> {} rows, {} -> {} columns'.format(
+        *(size['rows'] + size['columns'])))
 
     ##################################################### Objective function
     # Linear objective function
@@ -225,57 +451,178 @@ def maximize_self_consumption(uncontrollable, dfbatteries,
     m.objective = Objective(rule=objective_function, sense=minimize)
 
     #################################################### Run
+    # Initial incumbent from the previous schedule
+    if initial is not None:
+        for key, frame in initial.items():
+            var = getattr(m, key)
+            for (t, i), value in frame.stack().items():
+                if (t, i) in var:
+                    var[t, i].value = (round(value) if key == 'deferrschedule'
+                                       else value)
+
     # Solve optimization problem
+    timings = {'build': (datetime.now() - tic).total_seconds()}
+    tic = datetime.now()
+    results = solve_model(m, solver=solver, verbose=verbose,
+                          solver_path=solver_path, timelimit=timelimit,
+                          warmstart=initial is not None, mipgap=mipgap)
+    timings['solve'] = (datetime.now() - tic).total_seconds()
+    tic = datetime.now()
+    statistics = solver_statistics(results)
+
+    if verbose:
+        print(results)
+
+    #################################################### Results
+    # Results as (time x asset) arrays
+    results = Results(horizon, timestep * steps)
+    keys = {'demandshape': shapeables, 'batteryin': batteries,
+            'batteryout': batteries, 'batteryenergy': batteries,
+            'demanddeferr': deferrables, 'deferrschedule': deferrables}
+    rows = dict((t, i) for i, t in enumerate(horizon))
+
+    for key, ids in keys.items():
+        if not ids:
+            continue
+        # Powers which were not created are zero
+        columns = dict((a, j) for j, a in enumerate(ids))
+        values = getattr(m, key).get_values()
+        array = numpy.zeros((len(horizon), len(ids)))
+        if values:
+            t, a = zip(*values.keys())
+            array[[rows[i] for i in t], [columns[j] for j in a]] = (
+                numpy.array(list(values.values()), dtype=float))
+        results.set_array(key, array, ids)
+
+    # demand_controllable, community_import and peaks
+    results.set_community(
+        demand_uncontrollable,
+        numpy.array(list(m.demand_controllable.get_values().values()),
+                    dtype=float),
+        m.peakhigh.get_values()[None], m.peaklow.get_values()[None])
+
+    # Reduction of the model
+    results['presolve'] = size
+    results['solver'] = statistics
+    timings['extract'] = (datetime.now() - tic).total_seconds()
+    results['timings'] = timings
+    return results
+
+
+def solve_model(m, solver='gurobi', verbose=False, solver_path=None,
+                timelimit=5*60, warmstart=False, mipgap=None):
+    """
+    Solve a Pyomo model with the solver specific time limit option.
+    Inputs:
+        - m (ConcreteModel or kernel block): model to solve
+        - solver (str): glpk, gurobi, cbc or highs (in-process through
+          its Python bindings, ConcreteModel only)
+        - timelimit (float): time limit in seconds
+        - warmstart (bool): use the current variable values as an
+          initial incumbent (cbc, gurobi, highs)
+        - mipgap (float): relative MIP gap (solver default if None)
+    Outputs:
+        - solver results
+    """
+    if solver == 'highs':
+        opt = SolverFactory('appsi_highs')
+        if mipgap is not None:
+            opt.config.mip_gap = mipgap
+        # Loading a missing solution raises, the variables are left
+        # without values when no solution was found (as with glpk)
+        results = opt.solve(m, tee=verbose, timelimit=timelimit,
+                            warmstart=warmstart, load_solutions=False)
+        status = normalize_status(results.solver.termination_condition)
+        if status not in ['infeasible', 'unbounded', 'error'] and \
+                len(results.solution) > 0:
+            m.solutions.load_from(results)
+        return results
+
+    results = None
     with SolverFactory(solver, executable=solver_path) as opt:
+        # Only pass the flag to solvers which accept it (not glpk)
+        kwargs = {}
+        if warmstart and opt.warm_start_capable():
+            kwargs['warmstart'] = True
         if solver in 'glpk':
             opt.options['tmlim'] = timelimit
-            results = opt.solve(m, tee=verbose)
+            if mipgap is not None:
+                opt.options['mipgap'] = mipgap
+            results = opt.solve(m, tee=verbose, **kwargs)
         if solver in 'gurobi':
             opt.options['TimeLimit'] = timelimit
-            results = opt.solve(m, tee=verbose)
+            if mipgap is not None:
+                opt.options['MIPGap'] = mipgap
+            results = opt.solve(m, tee=verbose, **kwargs)
         if solver in 'cbc':
-            results = opt.solve(m, timelimit=timelimit, tee=verbose)
-#         else:
-#             results = opt.solve(m, tee=verbose)
+            if mipgap is not None:
+                opt.options['ratioGap'] = mipgap
+            results = opt.solve(m, timelimit=timelimit, tee=verbose,
+                                **kwargs)
+        if results is None:
+            results = opt.solve(m, tee=verbose, **kwargs)
+    return results
 
-    if verbose:
-        print(results)
 
-    #################################################### Results
-    # A Dictionnary contains all the results
-    results = {}
-    keys = ['demandshape', 'batteryin',
-            'batteryout', 'batteryenergy',
-            'demanddeferr', 'deferrschedule']
-
-    for key in keys:
-        try:
-            tmp = pandas.DataFrame(index=['none'],
-                    data=getattr(m, key).get_values())
-            tmp = tmp.transpose()
-            tmp = tmp.unstack(level=1)
-            tmp.columns = tmp.columns.levels[1]
-            results[key] = tmp.copy()
-        except:
-            results[key] = None
-
-    # demand_controllable
-    results['demand_controllable'] = list(
-        m.demand_controllable.get_values().values())
-
-    # community_import
-    results['community_import'] = [ max(0, a + b)
-                                  for a, b in zip(
-                                  demand_uncontrollable,
-                                  results['demand_controllable'])]
-
-    # High peak
-    results['peakhigh'] = m.peakhigh.get_values()[None]
-
-    # Low peak
-    results['peaklow'] = m.peaklow.get_values()[None]
-
-    # Total import from the community
-    results['total_community_import'] = sum(
-        results['community_import'] ) * timestep
-    return results
+def _number(value):
+    """Finite float of a solver reported value or None"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if numpy.isfinite(value) else None
+
+
+def solver_statistics(results):
+    """
+    Statistics of Pyomo solver results.
+    Outputs:
+        - statistics (dict): status (termination condition, see
+          results.normalize_status), mipgap
+          (relative gap of the bounds), nodes (None when the solver does
+          not report them) and timelimit (stopped by the time limit)
+    """
+    status = normalize_status(results.solver.termination_condition)
+    upper = _number(results.problem.upper_bound)
+    lower = _number(results.problem.lower_bound)
+    try:
+        nodes = _number(results.solver.statistics.branch_and_bound
+                        .number_of_bounded_subproblems)
+    except AttributeError:
+        nodes = None
+    mipgap = None
+    if upper is not None and lower is not None:
+        mipgap = abs(upper - lower) / max(abs(upper), 1e-10)
+    return {'status': status, 'mipgap': mipgap, 'nodes': nodes,
+            'timelimit': status == 'timelimit'}
+
+
+def shift_solution(results, steps, ids=None):
+    """
+    Move a previous solution to a new horizon start so that it can be
+    used as the initial incumbent of the next solve.
+    Inputs:
+        - results (dict): output of maximize_self_consumption
+        - steps (int): number of time steps between the two horizon starts
+        - ids (dict): per result key, {previous id: new id}, assets
+          missing from the mapping are dropped
+    Outputs:
+        - initial (dict): DataFrames (time x asset) on the new horizon
+    """
+    initial = {}
+    for key in ['demandshape', 'batteryin',
+                'batteryout', 'batteryenergy',
+                'demanddeferr', 'deferrschedule']:
+        frame = results.get(key)
+        if frame is None:
+            continue
+        frame = frame.copy()
+        frame.index = frame.index - int(steps)
+        frame = frame[frame.index >= 0]
+        if ids is not None:
+            mapping = ids.get(key, {})
+            frame = frame[[c for c in frame.columns if c in mapping]]
+            frame = frame.rename(columns=mapping)
+        if frame.size > 0:
+            initial[key] = frame
+    return initial
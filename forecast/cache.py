@@ -0,0 +1,150 @@
+"""
+On-disk cache of the ENTSO-E load forecast.
+
+The retrieved points are kept with the time they were fetched, so that
+only the hours missing from the cache (or fetched too long ago) are
+queried again. The values sent to the server are kept as well, only the
+points that changed beyond a tolerance are uploaded. Every response is
+recorded, RecordedClient replays them when the API is unreachable. The
+cached points and the recordings are only kept for a retention period.
+"""
+from datetime import datetime, timedelta
+import os
+import glob
+import pandas
+
+
+def _read(path):
+    try:
+        return pandas.read_pickle(path)
+    except (OSError, EOFError, ValueError):
+        return None
+
+
+class ForecastCache(object):
+    """
+    Retrieved forecast (column value) and fetch time of each point
+    (column fetched), indexed by the forecast time. Points older than
+    retention (timedelta) are dropped on update.
+    """
+    def __init__(self, directory, name='load_forecast',
+                 retention=timedelta(days=1)):
+        self.directory = directory
+        self.retention = retention
+        self.path = os.path.join(directory, name + '.pkl')
+        self.sent_path = os.path.join(directory, name + '_sent.pkl')
+        os.makedirs(directory, exist_ok=True)
+        self.points = _read(self.path)
+        self.sent = _read(self.sent_path)
+
+    def missing(self, start, end, max_age):
+        """
+        Range to query so that every hour of [start, end] is in the cache
+        and was fetched less than max_age ago.
+        Inputs:
+            - start, end (Timestamp): tz aware
+            - max_age (timedelta)
+        Outputs:
+            - (start, end) to query or None
+        """
+        hours = pandas.date_range(start.floor('h'), end, freq='h')
+        if self.points is None or len(self.points) == 0:
+            return start, end
+        fresh = self.points[self.points.fetched >=
+                            pandas.Timestamp.now(tz='UTC') - max_age]
+        covered = fresh.index.tz_convert(start.tz).floor('h')
+        missing = hours[~hours.isin(covered)]
+        if len(missing) == 0:
+            return None
+        return (max(missing[0], start),
+                min(missing[-1] + pandas.Timedelta(hours=1), end))
+
+    def update(self, ts):
+        """Add a retrieved forecast (Series) to the cache"""
+        new = pandas.DataFrame({'value': ts.astype(float),
+                                'fetched': pandas.Timestamp.now(tz='UTC')})
+        if self.points is not None and len(self.points) > 0:
+            new.index = new.index.tz_convert(self.points.index.tz)
+            new = pandas.concat([self.points[~self.points.index.isin(
+                new.index)], new]).sort_index()
+        self.points = new[new.index >= pandas.Timestamp.now(tz='UTC') -
+                          self.retention]
+        self.points.to_pickle(self.path)
+
+    def window(self, start, end):
+        """Cached forecast (Series) between start and end"""
+        if self.points is None:
+            return pandas.Series(dtype=float)
+        index = self.points.index.tz_convert(start.tz)
+        values = self.points.value.copy()
+        values.index = index
+        return values[(index >= start) & (index <= end)]
+
+    def changed(self, values, tolerance):
+        """Points of values (Series) never sent or differing by more"""
+        if self.sent is None:
+            return values
+        previous = self.sent.reindex(values.index)
+        return values[previous.isna() |
+                      ((values - previous).abs() > tolerance)]
+
+    def mark_sent(self, values, since):
+        """Remember the uploaded values, forget the points before since"""
+        sent = values if self.sent is None else pandas.concat(
+            [self.sent[~self.sent.index.isin(values.index)], values])
+        self.sent = sent[sent.index >= since].sort_index()
+        self.sent.to_pickle(self.sent_path)
+
+    def clear_sent(self):
+        """Upload everything next time (e.g. server database reset)"""
+        self.sent = None
+        if os.path.exists(self.sent_path):
+            os.remove(self.sent_path)
+
+
+def record(directory, ts, start, end, retention=None):
+    """
+    Save one API response to be replayed by RecordedClient, the
+    recordings made more than retention (timedelta) ago are deleted
+    """
+    os.makedirs(directory, exist_ok=True)
+    ts.to_pickle(os.path.join(directory, '{}_{}_{}.pkl'.format(
+        datetime.now().strftime('%Y%m%d%H%M%S'),
+        start.strftime('%Y%m%d%H%M'), end.strftime('%Y%m%d%H%M'))))
+    if retention is not None:
+        oldest = (datetime.now() - retention).strftime('%Y%m%d%H%M%S')
+        for path in glob.glob(os.path.join(directory, '*.pkl')):
+            if os.path.basename(path)[:14] < oldest:
+                os.remove(path)
+
+
+class RecordedClient(object):
+    """
+    Local stand-in of EntsoePandasClient answering from the recorded
+    responses (the latest recording of each point is used).
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def query_load_forecast(self, country_code, start, end):
+        recordings = [_read(path) for path in sorted(
+            glob.glob(os.path.join(self.directory, '*.pkl')))]
+        recordings = [ts for ts in recordings if ts is not None and len(ts)]
+        if not recordings:
+            raise LookupError('No recorded forecast in ' + self.directory)
+        tz = recordings[-1].index.tz
+        ts = pandas.concat([r.tz_convert(tz) for r in recordings])
+        ts = ts[~ts.index.duplicated(keep='last')].sort_index()
+        if ts.index[-1] < end:
+            # Recordings too old: replay the last days shifted by whole
+            # days over the window (the load is roughly daily periodic)
+            days = -(-(end - ts.index[-1]) // pandas.Timedelta(days=1))
+            shifted = ts.copy()
+            shifted.index = shifted.index + pandas.Timedelta(days=days)
+            ts = pandas.concat([ts, shifted])
+            ts = ts[~ts.index.duplicated(keep='last')].sort_index()
+        ts = ts[(ts.index >= start) & (ts.index <= end)]
+        if len(ts) == 0:
+            raise LookupError('No recorded forecast from {} to {}'.format(
+                start, end))
+        return ts
@@ -1,43 +1,116 @@
 from entsoe import EntsoePandasClient
 from datetime import datetime, timedelta
+from cache import ForecastCache, RecordedClient, record
 import setting
 import pandas
 import schedule
 import time
 import requests
+import transport
 import json
 
+# Local cache of the forecast and recorded API responses (optional
+# settings: cache_directory, recordings_directory, max_age_hours,
+# recordings_days to keep, tolerance and replay to always use the
+# recorded responses)
+CACHE = getattr(setting, 'cache_directory', 'cache')
+RECORDINGS = getattr(setting, 'recordings_directory', 'recordings')
+RECORDINGS_RETENTION = timedelta(days=getattr(setting, 'recordings_days', 7))
+MAX_AGE = timedelta(hours=getattr(setting, 'max_age_hours', 6))
+TOLERANCE = getattr(setting, 'tolerance', 1e-3)
+REPLAY = getattr(setting, 'replay', False)
+# Columnar binary upload, JSON otherwise
+BINARY = getattr(setting, 'binary', True)
+TIMEZONE = 'Europe/Paris'
+
+cache = ForecastCache(CACHE)
+
+def pack(values):
+    # Columnar binary body of /forecast (app/transport.py, copied in the
+    # image). As the JSON times, the local times are sent as if they
+    # were UTC
+    times = ((values.index.tz_localize(None) - pandas.Timestamp(0)) //
+             pandas.Timedelta(milliseconds=1))
+    return transport.encode_forecast(times, values.to_numpy())
+
+def query(country_code, start, end):
+    # ENTSO-E or, when unreachable, the recorded responses
+    if not REPLAY:
+        try:
+            client = EntsoePandasClient(api_key=setting.key)
+            ts = client.query_load_forecast(country_code, start=start,
+                                            end=end)
+            record(RECORDINGS, ts, start, end, RECORDINGS_RETENTION)
+            return ts
+        except requests.exceptions.RequestException as e:
+            print('ENTSO-E unreachable (' + str(e) + '), using recordings')
+    return RecordedClient(RECORDINGS).query_load_forecast(
+        country_code, start=start, end=end)
+
 def forecast():
     # Input
-    start = datetime.now() - timedelta(hours=5)
-    end = datetime.now() + timedelta(hours=24)
+    start = pandas.Timestamp.now(tz=TIMEZONE) - timedelta(hours=5)
+    end = pandas.Timestamp.now(tz=TIMEZONE) + timedelta(hours=24)
     country_code = 'FR'  # France
 
     # Print attempt time
     print('Job executed at ' + str(datetime.now()))
-    print('Fetching forecast from ' + str(start)+ ' to ' + str(end))
 
-    # Query data
-    client = EntsoePandasClient(api_key=setting.key)
-    ts = client.query_load_forecast(country_code, start=start,end=end)
+    # Query the hours missing from the cache (or fetched too long ago)
+    missing = cache.missing(start, end, MAX_AGE)
+    if missing is not None:
+        print('Fetching forecast from ' + str(missing[0]) + ' to ' +
+              str(missing[1]))
+        ts = query(country_code, missing[0], missing[1])
+        cache.update(ts)
+
+        # Print sucess time range
+        print('Retrieved forecast from ' + str(ts.index[0]) + ' to ' +
+              str(ts.index[-1]))
+    else:
+        print('Forecast from ' + str(start) + ' to ' + str(end) +
+              ' already cached')
     # We could concat historical data to have an accurate curve afterward
     #client.query_load(country_code, start=start - timedelta(hours=24),end=end)
 
-    # Print sucess time range
-    print('Retrieved forecast from ' + str(ts.index[0]) + ' to ' + str(ts.index[-1]))
-
     # Resample data (make sure time ends in 0 or 5)
+    ts = cache.window(start - timedelta(hours=1), end + timedelta(hours=1))
     forecast = ts.resample('5T').interpolate()
+    forecast = forecast[(forecast.index >= start.floor('5T')) &
+                        (forecast.index <= end)]
+
+    # Only send the points that changed
+    values = forecast / 1000 - 42.5
+    changed = cache.changed(values, TOLERANCE)
+    if len(changed) == 0:
+        print('Forecast unchanged, nothing sent')
+        return
+    print('Sending ' + str(len(changed)) + ' of ' + str(len(values)) +
+          ' points')
 
     # Send data over to server
     url = 'http://fastapi/forecast'
-    data = {'times': [d.strftime('%Y-%m-%dT%H:%M:%SZ')
-                      for d in forecast.index],
-            'values': list((forecast / 1000 - 42.5).tolist())}
-    headers = {"Content-Type": "application/json"}
-    response = requests.put(url, data=json.dumps(data), headers=headers)
-    res = response.json()
-    print('Forecast request result ' + str(res))
+    if BINARY:
+        data = pack(changed)
+        headers = {"Content-Type": transport.CONTENT_TYPE}
+    else:
+        data = json.dumps({'times': [d.strftime('%Y-%m-%dT%H:%M:%SZ')
+                                     for d in changed.index],
+                           'values': list(changed.tolist())})
+        headers = {"Content-Type": "application/json"}
+    try:
+        response = requests.put(url, data=data, headers=headers)
+    except requests.exceptions.RequestException as e:
+        # The server may come back with an empty database
+        print('Forecast not sent (' + str(e) + ')')
+        cache.clear_sent()
+        return
+    print('Forecast request result ' + response.text)
+    if response.ok:
+        cache.mark_sent(changed, start.floor('5T'))
+    else:
+        # Unknown state of the server: upload everything next time
+        cache.clear_sent()
 
 def backup_totaldemand():
     # Ask server for backup
@@ -53,13 +126,14 @@ def trigger_random_orders():
 
 
 # Schedule forecast
-time.sleep(15) # wait until fastapi is up
-forecast()  # do it once before
-schedule.every().hour.do(forecast)
-schedule.every().hour.do(backup_totaldemand)
-
-while True:
-    schedule.run_pending()
-    # Wake up every 10 min
-    # to run what ever task
-    time.sleep(10 * 60)
+if __name__ == '__main__':
+    time.sleep(15) # wait until fastapi is up
+    forecast()  # do it once before
+    schedule.every().hour.do(forecast)
+    schedule.every().hour.do(backup_totaldemand)
+
+    while True:
+        schedule.run_pending()
+        # Wake up every 10 min
+        # to run what ever task
+        time.sleep(10 * 60)